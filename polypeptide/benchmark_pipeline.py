@@ -0,0 +1,318 @@
+"""
+benchmark_pipeline.py
+
+Times each step of going from fasta files to reduced SMIRKS patterns
+so we can see how the pipeline scales with the number of molecules and
+the number of residues, catch performance regressions, and decide
+how big to make batch jobs.
+
+Two kinds of inputs are used:
+* subsets of the dipeptides and tripeptides in other_fasta_files
+* random synthetic sequences with a range of lengths
+
+Every input is written to a fasta file and goes through the same steps:
+reading the fasta files, preparing molecules, createSystem, extracting parameters,
+convert_for_smirksifying, each ordering function, SMIRKSifier, the Reducer,
+and clusters_to_files. The times (in seconds) are saved to a json report
+with a log-log scaling exponent for each step.
+
+Example:
+python benchmark_pipeline.py -m 1,5,25 -l 5,10,20 -o benchmark.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import contextlib
+import numpy as np
+from making_proteins import iter_fasta_records, parameterize_sequence, parameter_arrays, \
+    get_forcefield, ParameterSystem, order_types_dict, order_clusters, make_smirksifier, \
+    clusters_to_files, write_run_store, mol_to_idx_smi, cluster_graphs
+from reducing_protein_smirks import ValidatedReducer
+from smirks_validation import SMIRKSValidator
+
+# one letter codes for the standard amino acids
+amino_acids = 'ACDEFGHIKLMNPQRSTVWY'
+
+# steps in the order they happen, used for the scaling table
+stage_names = ['ingestion', 'prepare_molecule', 'create_system',
+               'parameter_extraction', 'add_parameters', 'convert_for_smirksifying',
+               'ordering', 'smirksifier', 'reducer', 'clusters_to_files']
+
+
+@contextlib.contextmanager
+def timed(stages, name):
+    """
+    Adds the wall time for the with block to stages[name]
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[name] = stages.get(name, 0.) + time.perf_counter() - start
+
+
+def synthetic_sequences(length, n_mols, seed=0):
+    """
+    Random amino acid sequences, the same seed always gives the same sequences
+
+    Returns
+    -------
+    list of (mol_id, sequence)
+    """
+    rng = random.Random('%i_%i' % (seed, length))
+    return [('synthetic_%i_%i' % (length, i), ''.join([rng.choice(amino_acids) for r in range(length)]))
+            for i in range(n_mols)]
+
+
+def write_fasta(records, fasta):
+    with open(fasta, 'w') as output:
+        for mol_id, sequence in records:
+            output.write('>%s\n%s\n' % (mol_id, sequence))
+
+
+def benchmark_run(fasta, openmm_xml, fragments, order_names, reducer_iterations, work_dir):
+    """
+    Runs every step of the pipeline for one fasta file
+
+    Parameters
+    ----------
+    fasta: str, fasta file with the molecules for this run
+    openmm_xml: str, OpenMM force field
+    fragments: list of fragment types to SMIRKSify and reduce
+    order_names: list of ordering names from order_types_dict
+    reducer_iterations: int, iterations for each Reducer run, 0 to skip the Reducer
+    work_dir: directory for the output files
+
+    Returns
+    -------
+    result: dictionary with the size of this run and time for each step
+    """
+    stages = dict()
+
+    with timed(stages, 'ingestion'):
+        records = list(iter_fasta_records(fasta))
+
+    # createSystem is timed separately from the rest of parameterize_sequence
+    ff = get_forcefield(openmm_xml)
+    create_system = ff.createSystem
+
+    def timed_create_system(*args, **kwargs):
+        with timed(stages, 'create_system'):
+            return create_system(*args, **kwargs)
+
+    ff.createSystem = timed_create_system
+    system = ParameterSystem(openmm_xml)
+    n_atoms = 0
+    try:
+        for mol_id, sequence in records:
+            with timed(stages, 'prepare_molecule'):
+                parm, m = parameterize_sequence(mol_id, sequence, openmm_xml)
+            with timed(stages, 'parameter_extraction'):
+                arrays = parameter_arrays(parm)
+            with timed(stages, 'add_parameters'):
+                system.add_prepared_system(mol_id, m, arrays, parm)
+            n_atoms += m.NumAtoms()
+    finally:
+        del ff.createSystem
+    stages['prepare_molecule'] -= stages.get('create_system', 0.)
+
+    with timed(stages, 'convert_for_smirksifying'):
+        mols, clusters = system.convert_for_smirksifying()
+
+    result = {
+        'fasta': os.path.basename(fasta),
+        'n_mols': len(records),
+        'n_residues': sum([len(s) for _, s in records]),
+        'n_atoms': n_atoms,
+        'n_clusters': {frag: len(c) for frag, c in clusters.items()},
+        'ordering': dict(),
+        'fragments': dict(),
+    }
+
+    # the ordering functions share the cluster_graphs cache, clear it
+    # so each ordering pays for building its own graphs and SMIRKS
+    for order_name in order_names:
+        cluster_graphs.clear()
+        o_stages = dict()
+        for frag, frag_clusters in clusters.items():
+            with timed(o_stages, frag):
+                order_clusters(frag_clusters, mols, frag, order_name, order_types_dict[order_name])
+        result['ordering'][order_name] = o_stages
+        stages['ordering'] = stages.get('ordering', 0.) + sum(o_stages.values())
+
+    smirks_order_types = {order_names[0]: dict()}
+    for frag in fragments:
+        o_clusters = order_clusters(clusters[frag], mols, frag, order_names[0],
+                                    order_types_dict[order_names[0]])
+        cluster_graphs.clear()
+        frag_stages = dict()
+        with timed(frag_stages, 'smirksifier'):
+            smirksifier = make_smirksifier(mols, o_clusters)
+        smirks_order_types[order_names[0]][frag] = smirksifier
+        frag_result = {'checked': smirksifier.checks, 'n_smirks': len(smirksifier.current_smirks)}
+
+        if smirksifier.checks and reducer_iterations > 0:
+            with timed(frag_stages, 'reducer'):
+                validator = SMIRKSValidator.from_type_list(smirksifier.current_smirks, mols,
+                                                           'improper' in frag)
+                red = ValidatedReducer(smirksifier.current_smirks, mols, validator)
+                reduced = red.run(reducer_iterations)
+            frag_result['n_reduced_smirks'] = len(reduced)
+
+        frag_result.update(frag_stages)
+        result['fragments'][frag] = frag_result
+        for stage, seconds in frag_stages.items():
+            stages[stage] = stages.get(stage, 0.) + seconds
+
+    with timed(stages, 'clusters_to_files'):
+        store = os.path.join(work_dir, 'benchmark_%imols' % len(mols))
+        write_run_store(store, mols, clusters, [mol_to_idx_smi(m) for m in mols])
+        for frag in fragments:
+            smirks = {o: {frag: d[frag]} for o, d in smirks_order_types.items()}
+            clusters_to_files(mols, clusters, smirks, os.path.join(work_dir, 'benchmark_%s.json' % frag),
+                              store=store)
+
+    result['stages'] = stages
+    return result
+
+
+def scaling_exponents(runs, size_key):
+    """
+    Fits time = a * size^b for each step with a least squares fit in log-log space.
+
+    Returns
+    -------
+    exponents: {stage: b}, stages with less than two nonzero times are left out
+    """
+    exponents = dict()
+    for stage in stage_names:
+        points = [(r[size_key], r['stages'][stage]) for r in runs
+                  if r['stages'].get(stage, 0.) > 0 and r[size_key] > 0]
+        if len(set([p[0] for p in points])) < 2:
+            continue
+        x = np.log([p[0] for p in points])
+        y = np.log([p[1] for p in points])
+        exponents[stage] = float(np.polyfit(x, y, 1)[0])
+    return exponents
+
+
+def print_report(report):
+    table_form = "%-22s" + " %12s" * len(report['runs'])
+    print('=' * 80)
+    print(table_form % tuple(['stage'] + ['%s:%i' % (r['dataset'], r['n_mols']) for r in report['runs']]))
+    print('-' * 80)
+    for stage in stage_names:
+        print(table_form % tuple([stage] + ['%.3f' % r['stages'].get(stage, 0.) for r in report['runs']]))
+    print('=' * 80)
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser()
+
+    parser.add_option('-f', '--fastas',
+                      action='store', type='string', dest='fastas',
+                      default='other_fasta_files',
+                      help="fasta files or directory used for the peptide runs")
+
+    parser.add_option('-m', '--mol_counts',
+                      action='store', type='string', dest='mol_counts',
+                      default='1,5,25,100',
+                      help="comma separated numbers of peptides to use for each peptide run")
+
+    parser.add_option('-l', '--lengths',
+                      action='store', type='string', dest='lengths',
+                      default='5,10,20,40',
+                      help="comma separated lengths for synthetic sequences, empty to skip them")
+
+    parser.add_option('-k', '--synthetic_mols',
+                      action='store', type='int', dest='synthetic_mols',
+                      default=5,
+                      help="number of synthetic sequences for each length")
+
+    parser.add_option('-x', '--xml',
+                      action='store', type='string', dest='xml',
+                      default='amber99sbildn.xml',
+                      help="OpenMM force field")
+
+    parser.add_option('-p', '--fragments',
+                      action='store', type='string', dest='fragments',
+                      default='bond,charge',
+                      help="comma separated fragment types to SMIRKSify and reduce")
+
+    parser.add_option('-r', '--reducer_iterations',
+                      action='store', type='int', dest='reducer_iterations',
+                      default=100,
+                      help="Reducer iterations for each fragment, 0 to skip the Reducer")
+
+    parser.add_option('-s', '--seed',
+                      action='store', type='int', dest='seed',
+                      default=0,
+                      help="seed for picking peptides, making synthetic sequences, and SMIRKSifying")
+
+    parser.add_option('-o', '--output',
+                      action='store', type='string', dest='output',
+                      default='benchmark.json',
+                      help="json file for the report")
+
+    (opt, args) = parser.parse_args()
+
+    fragments = [f for f in opt.fragments.split(',') if f]
+    order_names = ['biggest_size'] + [n for n in sorted(order_types_dict) if n != 'biggest_size']
+
+    # peptides are picked in a random (but repeatable) order so small runs aren't
+    # all the same first residue
+    peptides = list(iter_fasta_records(opt.fastas.split(',')))
+    random.Random(opt.seed).shuffle(peptides)
+
+    datasets = list()
+    for n in [int(n) for n in opt.mol_counts.split(',') if n]:
+        datasets.append(('peptides', peptides[:n]))
+    for length in [int(l) for l in opt.lengths.split(',') if l]:
+        datasets.append(('synthetic_%i' % length, synthetic_sequences(length, opt.synthetic_mols, opt.seed)))
+
+    load_stages = dict()
+    with timed(load_stages, 'load_forcefield'):
+        get_forcefield(opt.xml)
+
+    work_dir = tempfile.mkdtemp(prefix='benchmark_')
+    runs = list()
+    try:
+        for name, records in datasets:
+            print(name, len(records))
+            fasta = os.path.join(work_dir, '%s_%i.fasta' % (name, len(records)))
+            write_fasta(records, fasta)
+            random.seed(opt.seed)
+            np.random.seed(opt.seed)
+            run = benchmark_run(fasta, opt.xml, fragments, order_names, opt.reducer_iterations, work_dir)
+            run['dataset'] = name
+            runs.append(run)
+    finally:
+        shutil.rmtree(work_dir)
+
+    report = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'settings': vars(opt),
+        'environment': {
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'load_forcefield': load_stages['load_forcefield'],
+        'runs': runs,
+        'scaling': {
+            'n_mols': scaling_exponents([r for r in runs if r['dataset'] == 'peptides'], 'n_mols'),
+            'n_residues': scaling_exponents([r for r in runs if r['dataset'] != 'peptides'], 'n_residues'),
+        },
+    }
+
+    print_report(report)
+    with open(opt.output, 'w') as output:
+        json.dump(report, output, indent=2)
@@ -0,0 +1,413 @@
+"""
+job_queue.py
+
+A work queue for every SMIRKSifier and Reducer job in a study.
+
+making_proteins.py and reducing_protein_smirks.py run their jobs in
+loops with a fixed order on one machine, so the slowest jobs (usually
+charge and proper torsions) are often started last and the rest of the
+allocation sits idle while they finish. Here each job is one
+(force field, fragment, ordering, stage) where stage is 'smirksify' or 'reduce'.
+A reduce job depends on the smirksify job with the same force field,
+fragment, and ordering so the jobs form a DAG.
+
+Every job gets a cost estimate from its clusters (see estimate_cost) and
+workers always claim the most expensive job whose dependencies are done,
+so long jobs start first.
+
+The queue is a single SQLite file. Any number of worker processes on any
+number of nodes can share it as long as it is on a file system with working
+file locks. Jobs are claimed in a BEGIN IMMEDIATE transaction so only one
+worker gets each job. The default rollback journal is used because
+WAL mode doesn't work on network file systems.
+
+See queue_worker.py for running jobs from a queue.
+"""
+
+import os
+import json
+import time
+import socket
+import collections
+import sqlite3
+import contextlib
+
+# bump this if the tables change
+QUEUE_VERSION = 1
+
+stages = ['smirksify', 'reduce']
+
+# Reducer settings used for reduce jobs unless others are given,
+# these match reducing_protein_smirks.py
+default_reduce_settings = {
+    'orders': ['big_smirks', 'biggest_size', 'small_smirks', 'small_size'],
+    'chains': 1,
+    'seed': 0,
+    'chunk': 500,
+    'schedule': [['output_1k', 1000], ['output_5k', 5000]],
+}
+
+_schema = """
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    stage TEXT NOT NULL,
+    forcefield TEXT NOT NULL,
+    fragment TEXT NOT NULL,
+    ordering TEXT NOT NULL,
+    cost REAL NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    claimed REAL,
+    heartbeat REAL,
+    finished REAL,
+    result TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS dependencies (
+    job_id TEXT NOT NULL,
+    depends_on TEXT NOT NULL,
+    PRIMARY KEY (job_id, depends_on)
+);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, cost);
+"""
+
+
+def job_id(stage, forcefield, fragment, ordering):
+    return '%s:%s:%s:%s' % (stage, forcefield, fragment, ordering)
+
+
+def default_worker_name():
+    return '%s:%i' % (socket.gethostname(), os.getpid())
+
+
+def estimate_cost(clusters, mol_sizes, stage='smirksify', iterations=0):
+    """
+    Rough relative cost of a job, only the order of the costs matters.
+
+    SMIRKSifier makes a cluster graph for each cluster and checks the
+    SMIRKS against every fragment, each check is a substructure search
+    on a molecule, so the cost goes with
+    clusters * fragments * atoms per molecule.
+    Each Reducer iteration changes one SMIRKS and matches it against
+    every molecule with a fragment, so that goes with
+    iterations * molecules * atoms per molecule.
+
+    Parameters
+    ----------
+    clusters: list of (label, [[(atoms), ] for each molecule])
+    mol_sizes: number of atoms in each molecule
+    stage: 'smirksify' or 'reduce'
+    iterations: total Reducer iterations for every chain in a reduce job
+
+    Returns
+    -------
+    cost: float
+    """
+    n_tuples = 0
+    n_atoms = 0
+    used_mols = set()
+    for _, cluster in clusters:
+        for mol_idx, fragments in enumerate(cluster):
+            if len(fragments) == 0:
+                continue
+            n_tuples += len(fragments)
+            n_atoms += len(fragments) * mol_sizes[mol_idx]
+            used_mols.add(mol_idx)
+    if n_tuples == 0:
+        return 0.
+    mean_atoms = float(n_atoms) / n_tuples
+
+    if stage == 'smirksify':
+        return len(clusters) * n_tuples * mean_atoms
+    if stage == 'reduce':
+        return iterations * len(used_mols) * mean_atoms
+    raise ValueError("Unknown stage %s, stage must be in %s" % (stage, stages))
+
+
+class JobQueue:
+    """
+    Jobs stored in a SQLite file shared by every worker.
+
+    Parameters
+    ----------
+    path: str, SQLite file, it is created if it doesn't exist
+    timeout: float, seconds to wait for another worker's lock before giving up
+    """
+    def __init__(self, path, timeout=120.):
+        self.path = os.path.abspath(path)
+        # autocommit mode, transactions are started explicitly
+        self.connection = sqlite3.connect(self.path, timeout=timeout, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(_schema)
+        with self.transaction():
+            self.connection.execute("INSERT OR IGNORE INTO settings VALUES ('version', ?)",
+                                    (str(QUEUE_VERSION),))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Locks the database for writing until the with block is done
+        """
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    def close(self):
+        self.connection.close()
+
+    def add_job(self, stage, forcefield, fragment, ordering, cost, payload, depends_on=None):
+        """
+        Adds a job unless a job with the same id is already in the queue,
+        so adding the jobs for a study again won't redo finished jobs.
+
+        Parameters
+        ----------
+        stage: 'smirksify' or 'reduce'
+        forcefield: str, label for the force field
+        fragment: str, fragment type
+        ordering: str, ordering type
+        cost: float, from estimate_cost
+        payload: dictionary with everything the worker needs to run this job
+        depends_on: list of job ids that have to be done first
+
+        Returns
+        -------
+        job_id: str
+        """
+        if stage not in stages:
+            raise ValueError("Unknown stage %s, stage must be in %s" % (stage, stages))
+        new_id = job_id(stage, forcefield, fragment, ordering)
+        with self.transaction() as db:
+            db.execute("INSERT OR IGNORE INTO jobs (job_id, stage, forcefield, fragment, ordering, cost, payload) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (new_id, stage, forcefield, fragment, ordering, float(cost), json.dumps(payload)))
+            for dep in ([] if depends_on is None else depends_on):
+                db.execute("INSERT OR IGNORE INTO dependencies VALUES (?, ?)", (new_id, dep))
+        return new_id
+
+    def claim(self, worker=None, stage=None):
+        """
+        Marks the most expensive pending job whose dependencies
+        are all done as running.
+
+        Parameters
+        ----------
+        worker: str, name saved with the job, defaults to host:pid
+        stage: str, only claim jobs for this stage
+
+        Returns
+        -------
+        job: dictionary with the job's columns (payload decoded)
+             or None if no job is ready
+        """
+        if worker is None:
+            worker = default_worker_name()
+        query = ("SELECT * FROM jobs AS j WHERE status = 'pending' "
+                 "AND NOT EXISTS (SELECT 1 FROM dependencies AS d JOIN jobs AS p ON p.job_id = d.depends_on "
+                 "WHERE d.job_id = j.job_id AND p.status != 'done')")
+        args = tuple()
+        if stage is not None:
+            query += " AND stage = ?"
+            args = (stage,)
+        query += " ORDER BY cost DESC, job_id LIMIT 1"
+
+        now = time.time()
+        with self.transaction() as db:
+            row = db.execute(query, args).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, "
+                       "claimed = ?, heartbeat = ?, error = NULL WHERE job_id = ?",
+                       (worker, now, now, row['job_id']))
+        job = self._decode(row)
+        job.update(status='running', worker=worker, attempts=job['attempts'] + 1, claimed=now, heartbeat=now)
+        return job
+
+    def heartbeat(self, job_id):
+        """
+        Called by long jobs to show their worker is still alive
+        """
+        with self.transaction() as db:
+            db.execute("UPDATE jobs SET heartbeat = ? WHERE job_id = ?", (time.time(), job_id))
+
+    def finish(self, job_id, result):
+        """
+        Marks a job as done and saves its result (anything json can save)
+        """
+        with self.transaction() as db:
+            db.execute("UPDATE jobs SET status = 'done', finished = ?, result = ? WHERE job_id = ?",
+                       (time.time(), json.dumps(result), job_id))
+
+    def fail(self, job_id, error):
+        """
+        Marks a job as failed, jobs that depend on it won't be started
+        """
+        with self.transaction() as db:
+            db.execute("UPDATE jobs SET status = 'failed', finished = ?, error = ? WHERE job_id = ?",
+                       (time.time(), str(error), job_id))
+
+    def requeue(self, stale_time=None, failed=False, max_attempts=None):
+        """
+        Puts jobs back in the queue.
+
+        Parameters
+        ----------
+        stale_time: float, running jobs without a heartbeat for this many seconds
+                    are assumed to be from a worker that died (workers save
+                    a heartbeat every minute by default)
+        failed: bool, if True failed jobs are also put back
+        max_attempts: int, jobs that have been claimed this many times are left alone
+
+        Returns
+        -------
+        n_jobs: number of jobs put back in the queue
+        """
+        conditions = list()
+        args = list()
+        if stale_time is not None:
+            conditions.append("(status = 'running' AND heartbeat < ?)")
+            args.append(time.time() - stale_time)
+        if failed:
+            conditions.append("status = 'failed'")
+        if len(conditions) == 0:
+            return 0
+
+        query = ("UPDATE jobs SET status = 'pending', worker = NULL, claimed = NULL, "
+                 "heartbeat = NULL, finished = NULL WHERE (%s)" % ' OR '.join(conditions))
+        if max_attempts is not None:
+            query += " AND attempts < ?"
+            args.append(max_attempts)
+        with self.transaction() as db:
+            return db.execute(query, args).rowcount
+
+    def job(self, job_id):
+        row = self.connection.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return None if row is None else self._decode(row)
+
+    def jobs(self, status=None):
+        """
+        Returns
+        -------
+        jobs: list of job dictionaries, most expensive first
+        """
+        query = "SELECT * FROM jobs"
+        args = tuple()
+        if status is not None:
+            query += " WHERE status = ?"
+            args = (status,)
+        query += " ORDER BY cost DESC, job_id"
+        return [self._decode(row) for row in self.connection.execute(query, args)]
+
+    def dependencies(self, job_id):
+        return [row[0] for row in self.connection.execute(
+            "SELECT depends_on FROM dependencies WHERE job_id = ?", (job_id,))]
+
+    def counts(self):
+        """
+        Returns
+        -------
+        counts: dictionary {status: number of jobs}
+        """
+        return dict([(row[0], row[1]) for row in self.connection.execute(
+            "SELECT status, COUNT(*) FROM jobs GROUP BY status")])
+
+    def unfinished(self):
+        """
+        True if there are running jobs or pending jobs that could still be run,
+        pending jobs that depend (directly or not) on a failed job are not counted
+        """
+        status = dict([(row[0], row[1]) for row in self.connection.execute(
+            "SELECT job_id, status FROM jobs")])
+        depends_on = collections.defaultdict(list)
+        for job, dep in self.connection.execute("SELECT job_id, depends_on FROM dependencies"):
+            depends_on[job].append(dep)
+
+        blocked = dict()
+
+        def is_blocked(job):
+            if job not in blocked:
+                blocked[job] = any([status.get(d, None) == 'failed' or is_blocked(d)
+                                    for d in depends_on[job]])
+            return blocked[job]
+
+        for job, job_status in status.items():
+            if job_status == 'running' or (job_status == 'pending' and not is_blocked(job)):
+                return True
+        return False
+
+    @staticmethod
+    def _decode(row):
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        if job['result'] is not None:
+            job['result'] = json.loads(job['result'])
+        return job
+
+
+def add_pipeline_jobs(job_queue, forcefield, store, mols, clusters, orderings, json_format,
+                      options=None, warm_start=None, reduce_settings=None):
+    """
+    Adds a smirksify job for every (fragment, ordering) and a reduce job
+    that depends on it for the orderings in reduce_settings['orders'].
+
+    Parameters
+    ----------
+    job_queue: JobQueue
+    forcefield: str, label for this force field
+    store: str, prefix of the run store (see run_store.py) with these molecules and clusters
+    mols: list of OEMols in the store, only used for their sizes
+    clusters: {fragment: cluster list} as stored in the store
+    orderings: list of (order type, name in making_proteins.order_types_dict, json name)
+               like making_proteins.numbered_orderings gives with the name of its
+               set of orderings ('big', 'small', or 'shuffle'). Orderings listed
+               more than once are numbered (shuffle, shuffle_1) and each one gets its own seed.
+    json_format: str, output json file name with %(name)s and %(fragment)s,
+                 every ordering with the same json name is saved in the same file
+    options: SMIRKSifier options for run_smirksifier_job (like 'dedupe_radius' or 'subsample')
+    warm_start: {order: {fragment: type_list}} with SMIRKS from a previous run
+    reduce_settings: settings for reduce jobs, defaults to default_reduce_settings
+
+    Returns
+    -------
+    job_ids: list of the job ids that were added
+    """
+    if options is None:
+        options = dict()
+    settings = dict(default_reduce_settings)
+    if reduce_settings is not None:
+        settings.update(reduce_settings)
+
+    mol_sizes = [m.NumAtoms() for m in mols]
+    seeds = list(range(settings['seed'], settings['seed'] + settings['chains']))
+    iterations = max([t for _, t in settings['schedule']]) * len(seeds)
+
+    job_ids = list()
+    for fragment, frag_clusters in clusters.items():
+        smirksify_cost = estimate_cost(frag_clusters, mol_sizes, 'smirksify')
+        reduce_cost = estimate_cost(frag_clusters, mol_sizes, 'reduce', iterations)
+        for order_seed, (order, order_function, json_name) in enumerate(orderings):
+            json_file = json_format % {'name': json_name, 'fragment': fragment}
+            job_options = dict(options)
+            if warm_start is not None:
+                job_options['warm_start'] = warm_start.get(order, dict()).get(fragment, None)
+            smirksify_id = job_queue.add_job('smirksify', forcefield, fragment, order, smirksify_cost,
+                                             {'store': store, 'json_file': json_file, 'options': job_options,
+                                              'order_function': order_function, 'order_seed': order_seed})
+            job_ids.append(smirksify_id)
+            if order not in settings['orders']:
+                continue
+            job_ids.append(job_queue.add_job('reduce', forcefield, fragment, order, reduce_cost,
+                                             {'json_file': json_file, 'seeds': seeds,
+                                              'chunk': settings['chunk'], 'schedule': settings['schedule']},
+                                             depends_on=[smirksify_id]))
+    return job_ids
@@ -14,7 +14,9 @@ The ultimate goal is this:
    these were chosen as the file format because it is easy to get
    an arbitrary order of amino acids so we could potentially make
    any combination of small polypeptides for testing this process.
-   It should be simple to switch this to a PDB instead
+   Whole proteins can also be read from PDB or mmCIF files, these
+   are parameterized once and cut into capped windows of residues
+   (see iter_structure_windows) so big proteins don't use too much memory
 
 2. Use oeommtools to convert an OEMol to an OpenMM system which
    can be parameterized with any OpenMM XML force field
@@ -23,10 +25,8 @@ The ultimate goal is this:
    parameter that is assigned.
    For example, bond are grouped by there exact force constant
    and equilibrium force constant.
-   Note - this is done by converting parameters to strings which
-   can be used in keys of a dictionary to store atoms in that cluster.
-   No, that isn't the best or most elegant way to do this, but it worked
-   in the short time frame for wrapping up the project.
+   Note - parameters are stored as rounded numpy arrays and the
+   string versions of the parameters are only used as cluster labels.
 
 4. Convert dictionaries of {parameter: atoms} to clusters for ChemPer
    We order these clusters in a few different was as described in the
@@ -38,53 +38,1071 @@ The ultimate goal is this:
 
 import os
 import copy
+import glob
+import json
+import pickle
 import random
+import tempfile
+import itertools
+import threading
+import collections
+import multiprocessing
+import numpy as np
 import parmed
 from parmed.modeller import ResidueTemplate
 from simtk.openmm import app
-from simtk import unit
 from oeommtools import utils as oeo_utils
 from chemper.smirksify import SMIRKSifier
 from chemper.graphs.cluster_graph import ClusterGraph
 from openeye import oechem
+from parameter_cache import ParameterCache, find_forcefield_xml
+from run_store import write_run_store, write_record, mols_path
+from run_log import RunLog, get_run_log, set_run_log, configure_run_log
+from job_queue import JobQueue, add_pipeline_jobs
+from smirks_validation import SMIRKSValidator, cluster_label as _cluster_label, fragment_key as _fragment_key
+
+
+# terminal labels for charges are stored as numbers in the parameter arrays
+terminal_labels = ['X', 'N', 'C']
+
+
+def _terminal_label(value):
+    return terminal_labels[int(value)]
 
 
 class ParameterDict:
     """
-    This class makes it easier to store a custom organized dictionary
-    for any parameter type.
-    In 'd' the key is always going to be a string of the parameter
-    then we store the following information:
+    This class makes it easier to store atoms grouped by the parameter
+    they were assigned for any parameter type.
+    Each unique parameter is a row in a float array and
+    we store the following information for each row:
+
+    labels: string version of the parameter made with formats,
+            these are used as the cluster labels for ChemPer
+    atom_indices: list with a dictionary for each parameter
+                  in the form {mol_id: int32 array with shape (n atoms, fragment size)}
+
+    Parameters are grouped by their formatted strings (the same strings
+    used for the labels), so values that only differ past the precision of
+    the format end up in the same cluster and every fragment in a cluster
+    has that cluster's label. This is the same grouping as the original
+    tab separated string keys, so '-0.000' and '0.000' are different clusters.
 
-    atom_indices: this is dictionary in the form {mol_id: [ (atoms), ]}
-    parameters: since we're using strings of the parameter as a key
-                this is a set of all parameters that were actually used
-                the goal was to use this to check that there was REALLY
-                only 1 parameter added to each item, however we never
-                actually used it for anything.
-    units: units for the input parameters.
+    Parameters
+    ----------
+    formats: list of formats for each parameter column, either a string
+             like '%.3f' or a function that converts the value to a string.
+             If one string is given it is used for every column, this is used
+             for proper torsions which have a different number of
+             parameters depending on how many periodicities they have.
     """
-    def __init__(self):
-        self.d = dict()
+    def __init__(self, formats):
+        self.formats = formats
+        self.labels = list()
+        self.atom_indices = list()
+        # {tuple of formatted values: parameter index}
+        self._keys = dict()
+        self._rows = list()
+        # atom tuples already converted for ChemPer {(key index, mol_id): [(atoms), ]}
+        self._tuples = dict()
+        # keys and molecules changed since the last call to pop_changes
+        # {key index: set of mol_ids}
+        self._changes = dict()
+
+    @property
+    def parameters(self):
+        """
+        float array with one row for each parameter (the values of the
+        first fragment added with it), rows with fewer columns are padded with np.inf
+        """
+        width = max([len(r) for r in self._rows] + [0])
+        params = np.full((len(self._rows), width), np.inf)
+        for idx, row in enumerate(self._rows):
+            params[idx, :len(row)] = row
+        return params
+
+    def __len__(self):
+        return len(self.labels)
+
+    def _format(self, col):
+        if isinstance(self.formats, str):
+            return self.formats
+        return self.formats[col]
+
+    def _formatted(self, params):
+        """
+        string array with the same shape as params with each value
+        formatted like the labels, padding (np.inf) is an empty string
+        """
+        strings = np.empty(params.shape, dtype=object)
+        for col in range(params.shape[1]):
+            fmt = self._format(col)
+            if callable(fmt):
+                strings[:, col] = [fmt(v) if np.isfinite(v) else '' for v in params[:, col]]
+            else:
+                strings[:, col] = np.char.mod(fmt, params[:, col])
+                strings[np.isinf(params[:, col]), col] = ''
+        return strings.astype(str)
+
+    def add_parameters(self, mol_id, atoms, params):
+        """
+        Adds a batch of fragments from one molecule.
+
+        Parameters
+        ----------
+        mol_id: key for the molecule these atoms are in
+        atoms: int array with shape (n fragments, fragment size)
+        params: float array with shape (n fragments, n parameters),
+                rows with fewer parameters can be padded with np.inf
+        """
+        atoms = np.asarray(atoms, dtype=np.int32)
+        params = np.asarray(params, dtype=float)
+        if len(atoms) == 0:
+            return
+        if params.ndim == 1:
+            params = params.reshape(-1, 1)
+
+        formatted = self._formatted(params)
+        unique, first_idx, inverse, counts = np.unique(formatted, axis=0,
+                                                       return_index=True,
+                                                       return_inverse=True,
+                                                       return_counts=True)
+        inverse = inverse.reshape(-1)
+
+        # split atoms into groups, a stable sort keeps the
+        # fragments in each group in their original order
+        sort_idx = np.argsort(inverse, kind='stable')
+        groups = np.split(atoms[sort_idx], np.cumsum(counts)[:-1])
+
+        # add keys in the order they first show up in this molecule
+        for u in np.argsort(first_idx):
+            key = tuple([str(v) for v in unique[u] if v != ''])
+            if key not in self._keys:
+                self._keys[key] = len(self.labels)
+                self.labels.append('\t'.join(key))
+                self._rows.append(params[first_idx[u]])
+                self.atom_indices.append(dict())
+            key_idx = self._keys[key]
+            mol_atoms = self.atom_indices[key_idx]
+            if mol_id in mol_atoms:
+                mol_atoms[mol_id] = np.vstack([mol_atoms[mol_id], groups[u]])
+            else:
+                mol_atoms[mol_id] = np.ascontiguousarray(groups[u])
+            self._mark_changed(key_idx, mol_id)
+
+    def _mark_changed(self, key_idx, mol_id):
+        self._tuples.pop((key_idx, mol_id), None)
+        self._changes.setdefault(key_idx, set()).add(mol_id)
+
+    def remove_molecule(self, mol_id):
+        """
+        Removes every fragment from this molecule. Parameters which
+        are no longer used by any molecule are left out of the clusters.
+        """
+        for key_idx, mol_atoms in enumerate(self.atom_indices):
+            if mol_id in mol_atoms:
+                del mol_atoms[mol_id]
+                self._mark_changed(key_idx, mol_id)
+
+    def _mol_tuples(self, key_idx, mol_id):
+        """
+        atom tuples for one parameter and molecule, these are only
+        converted from arrays again if that molecule changed
+        """
+        if (key_idx, mol_id) not in self._tuples:
+            arr = self.atom_indices[key_idx].get(mol_id, None)
+            if arr is None:
+                return list()
+            self._tuples[(key_idx, mol_id)] = [tuple(int(i) for i in a) for a in arr]
+        return self._tuples[(key_idx, mol_id)]
+
+    def sparse_clusters(self):
+        """
+        Clusters without padding for molecules which don't have the parameter
+
+        Returns
+        -------
+        clusters: list of tuples in the form (label, {mol_id: [(atoms), ]})
+                  only parameters used by at least one molecule are included
+        """
+        clusters = list()
+        for key_idx, (label, mol_atoms) in enumerate(zip(self.labels, self.atom_indices)):
+            if len(mol_atoms) == 0:
+                continue
+            clusters.append((label, {m: self._mol_tuples(key_idx, m) for m in mol_atoms}))
+        return clusters
+
+    def pop_changes(self):
+        """
+        Returns the parameters which changed since the last call and
+        then starts tracking changes again.
+
+        Returns
+        -------
+        changes: list of tuples in the form (label, {mol_id: [(atoms), ]})
+                 for each changed parameter. Only the changed molecules
+                 are included, a molecule that was removed has an empty list.
+        """
+        changes = list()
+        for key_idx in sorted(self._changes):
+            mol_changes = {m: self._mol_tuples(key_idx, m) for m in sorted(self._changes[key_idx])}
+            changes.append((self.labels[key_idx], mol_changes))
+        self._changes = dict()
+        return changes
 
     def items(self):
-        return self.d.items()
+        """
+        (label, {'atom_indices': {mol_id: [(atoms), ]}}) for each parameter
+        """
+        for key_idx, (label, mol_atoms) in enumerate(zip(self.labels, self.atom_indices)):
+            atom_dict = {m: self._mol_tuples(key_idx, m) for m in mol_atoms}
+            yield label, {'atom_indices': atom_dict}
+
+    def clusters(self, mol_ids):
+        """
+        Makes clusters in the format ChemPer uses
+
+        Parameters
+        ----------
+        mol_ids: list of molecule keys in the order of the molecule list
+
+        Returns
+        -------
+        clusters: list of tuples in the form (label, [[(atoms), ] for each molecule])
+                  only parameters used by at least one molecule are included
+        """
+        return [(label, [mol_atoms.get(m, list()) for m in mol_ids])
+                for label, mol_atoms in self.sparse_clusters()]
+
+
+# aromaticity model used for every molecule, this is part of
+# the cache key so changing it won't reuse old molecules
+aromaticity_model = ('OEAroModel_MDL', oechem.OEAroModel_MDL)
+
+
+# structured dtypes used in parameter_arrays, each has the
+# atom index columns first followed by the parameters
+atom_dtype = np.dtype([('idx', np.int32), ('residue', np.int32), ('terminal', np.int8),
+                       ('charge', float), ('epsilon', float), ('rmin', float)])
+bond_dtype = np.dtype([('atoms', np.int32, (2,)), ('k', float), ('req', float)])
+angle_dtype = np.dtype([('atoms', np.int32, (3,)), ('k', float), ('theteq', float)])
+dihedral_dtype = np.dtype([('atoms', np.int32, (4,)), ('phi_k', float), ('phase', float),
+                           ('per', float), ('improper', bool), ('atom3_element', np.int32)])
+
+
+def _combine_propers(atoms, params):
+    """
+    Combines parameters with multiple periodicities for the same four atoms
+    so those are treated as one parameter.
+
+    Parameters
+    ----------
+    atoms: int array with shape (n terms, 4)
+    params: float array with shape (n terms, 3) with phi_k, phase, and periodicity
+
+    Returns
+    -------
+    unique_atoms: int array (n torsions, 4) in the order they first show up
+    combined: float array (n torsions, 3 * max terms), torsions
+              with fewer terms are padded with np.inf
+    """
+    if len(atoms) == 0:
+        return atoms.reshape(0, 4), np.zeros((0, 3))
+
+    unique, first_idx, inverse = np.unique(atoms, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    # renumber torsions in the order they first show up
+    order = np.argsort(first_idx)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    group = rank[inverse]
+
+    # position of each term within its torsion, keeping the original order
+    counts = np.bincount(group)
+    starts = np.cumsum(counts) - counts
+    sort_idx = np.argsort(group, kind='stable')
+    position = np.empty(len(group), dtype=int)
+    position[sort_idx] = np.arange(len(group)) - starts[group[sort_idx]]
+
+    combined = np.full((len(order), counts.max(), 3), np.inf)
+    combined[group, position] = params
+    return unique[order], combined.reshape(len(order), -1)
+
+
+def parameter_arrays(sys):
+    """
+    Pulls the parameters we cluster on out of a parmed system into
+    structured numpy arrays with one pass over each term type.
+    Everything the ParameterDicts need is stored here so these arrays
+    can be cached instead of the whole parmed system.
+
+    Parameters
+    ----------
+    sys: parmed system
+
+    Returns
+    -------
+    arrays: dictionary of structured arrays
+            'atoms': atom_dtype, terminal is the index in terminal_labels
+            'bonds': bond_dtype
+            'angles': angle_dtype
+            'impropers': dihedral_dtype with the central atom second
+            'propers': atoms and combined params for all periodicities
+    """
+    arrays = dict()
+
+    # find terminal labels for the charges, this only needs to be done per residue
+    res_terminal = np.zeros(len(sys.residues), dtype=np.int8)
+    for res in sys.residues:
+        if 'N_' in res.name:
+            res_terminal[res.idx] = terminal_labels.index('N')
+        elif 'C_' in res.name:
+            res_terminal[res.idx] = terminal_labels.index('C')
+
+    atoms = np.fromiter(((a.idx, a.residue.idx, 0, a.charge, a.epsilon, a.rmin) for a in sys.atoms),
+                        dtype=atom_dtype, count=len(sys.atoms))
+    atoms['terminal'] = res_terminal[atoms['residue']]
+    arrays['atoms'] = atoms
+
+    arrays['bonds'] = np.fromiter((((b.atom1.idx, b.atom2.idx), b.type.k, b.type.req) for b in sys.bonds),
+                                  dtype=bond_dtype, count=len(sys.bonds))
+
+    arrays['angles'] = np.fromiter((((an.atom1.idx, an.atom2.idx, an.atom3.idx), an.type.k, an.type.theteq)
+                                    for an in sys.angles),
+                                   dtype=angle_dtype, count=len(sys.angles))
+
+    dihedrals = np.fromiter((((d.atom1.idx, d.atom2.idx, d.atom3.idx, d.atom4.idx),
+                              d.type.phi_k, d.type.phase, d.type.per, d.improper, d.atom3.atomic_number)
+                             for d in sys.dihedrals),
+                            dtype=dihedral_dtype, count=len(sys.dihedrals))
+
+    # Impropers, order side atoms with the central atom second
+    impropers = dihedrals[dihedrals['improper']]
+    sides = np.sort(impropers['atoms'][:, [0, 1, 3]], axis=1)
+    impropers['atoms'] = np.column_stack([sides[:, 0], impropers['atoms'][:, 2], sides[:, 1], sides[:, 2]])
+    arrays['impropers'] = impropers
+
+    propers = dihedrals[~dihedrals['improper']]
+    prop_atoms, prop_params = _combine_propers(propers['atoms'],
+                                               np.column_stack([propers['phi_k'],
+                                                                propers['phase'],
+                                                                propers['per']]))
+    proper_dtype = np.dtype([('atoms', np.int32, (4,)), ('params', float, (prop_params.shape[1],))])
+    arrays['propers'] = np.empty(len(prop_atoms), dtype=proper_dtype)
+    arrays['propers']['atoms'] = prop_atoms
+    arrays['propers']['params'] = prop_params
+    return arrays
+
+
+def _read_fasta_records(fasta):
+    """
+    Lazily reads (header, sequence) pairs from one fasta file
+    """
+    header = None
+    lines = list()
+    with open(fasta, 'r') as fasta_file:
+        for line in fasta_file:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('>'):
+                if header is not None or lines:
+                    yield header, ''.join(lines).upper()
+                header = line[1:].strip()
+                lines = list()
+            else:
+                lines.append(line)
+    if header is not None or lines:
+        yield header, ''.join(lines).upper()
+
+
+def iter_fasta_records(inputs):
+    """
+    Lazily reads every sequence from a list of fasta files and directories.
+    Directories are searched for *.fasta files which are read in sorted order.
+
+    Molecules from files with a single sequence are named after the
+    file (like add_system_from_fasta). When a file has more than one sequence
+    the first word of each header is used instead
+    (or [file name]_[record number] if there is no header).
+
+    Parameters
+    ----------
+    inputs: str or list of str, fasta files or directories
+
+    Returns
+    -------
+    generator of (mol_id, sequence) tuples
+    """
+    if isinstance(inputs, str):
+        inputs = [inputs]
+
+    for path in inputs:
+        if os.path.isdir(path):
+            fastas = sorted(glob.glob(os.path.join(path, '*.fasta')))
+        else:
+            fastas = [path]
+
+        for fasta in fastas:
+            base = os.path.basename(os.path.abspath(fasta)).split('.')[0]
+            records = _read_fasta_records(fasta)
+            first = next(records, None)
+            if first is None:
+                continue
+            # look one record ahead to see if this file has more than one sequence
+            second = next(records, None)
+            if second is None:
+                yield base, first[1]
+                continue
+
+            for rec_idx, (header, sequence) in enumerate(itertools.chain([first, second], records)):
+                if header:
+                    mol_id = header.split()[0]
+                else:
+                    mol_id = '%s_%i' % (base, rec_idx)
+                yield mol_id, sequence
+
+
+# Loading an OpenMM ForceField parses the whole XML and builds the residue
+# template tables, so each process keeps one loaded copy of every force field
+# {xml path: ForceField}
+_forcefields = dict()
+_forcefield_lock = threading.Lock()
+
+
+def get_forcefield(openmm_xml):
+    """
+    Returns the shared ForceField for this XML, loading it the first time.
+    The ForceField also keeps its own residue template matching data,
+    so reusing it saves that work too.
+
+    Parameters
+    ----------
+    openmm_xml: str, file name or path for an OpenMM force field
+
+    Returns
+    -------
+    ff: simtk.openmm.app.ForceField
+    """
+    key = find_forcefield_xml(openmm_xml)
+    if key is None:
+        key = openmm_xml
+    with _forcefield_lock:
+        if key not in _forcefields:
+            _forcefields[key] = app.ForceField(openmm_xml)
+        return _forcefields[key]
+
+
+def _preload_forcefields(openmm_xmls, log_settings=None):
+    """
+    Pool initializer so every worker loads its force fields once at startup
+    """
+    configure_run_log(log_settings)
+    for openmm_xml in openmm_xmls:
+        get_forcefield(openmm_xml)
+
+
+def _pdb_round_trip(oemol):
+    """
+    Writes the molecule to a PDB string and reads it back in.
+    This was the original way we got a molecule oeommtools could use,
+    it is only kept to check the copy in parameterize_sequence gives the same result.
+    """
+    ofs = oechem.oemolostream()
+    ofs.SetFormat(oechem.OEFormat_PDB)
+    ofs.openstring()
+    oechem.OEWriteMolecule(ofs, oemol)
+
+    ifs = oechem.oemolistream()
+    ifs.openstring(ofs.GetString())
+    m = oechem.OEMol()
+    oechem.OEReadPDBFile(ifs, m)
+    return m
+
+
+def prepare_sequence(mol_id, sequence, pdb_round_trip=False):
+    """
+    Converts an amino acid sequence to a perceived OEMol and
+    an OpenMM topology. This only has to be done once for any
+    number of force fields.
+
+    Parameters
+    ----------
+    mol_id: str, title for the molecule
+    sequence: str, one letter amino acid sequence
+    pdb_round_trip: bool, if True use the original PDB string round trip
+                    to prepare the molecule
+
+    Returns
+    -------
+    top: OpenMM topology
+    m: perceived OEMol with the same atom order as top
+    """
+    oemol = oechem.OEMol()
+    ifs = oechem.oemolistream()
+    ifs.SetFormat(oechem.OEFormat_FASTA)
+    ifs.openstring('>%s\n%s\n' % (mol_id, sequence))
+
+    # After a lot of working on a single example
+    # this seems to be the right combination
+    # of calls to get an oemol from a fasta into the form
+    # where all bonds are fully perceived with order, etc.
+    # and that allows oeommtools to convert
+    # the molecule into an OpenMM system.
+    # I don't have justification for most of the steps.
+    oechem.OEReadFASTAFile(ifs, oemol)
+    oechem.OEAddExplicitHydrogens(oemol)
+    oechem.OEPerceiveResidues(oemol)
+    oechem.OEPDBOrderAtoms(oemol)
+    return _perceive_prepared(mol_id, oemol, pdb_round_trip)
+
+
+def _perceive_prepared(mol_id, oemol, pdb_round_trip=False):
+    """
+    Last steps shared by prepare_sequence and prepare_structure,
+    oemol has explicit hydrogens and its atoms in PDB order.
+
+    Returns
+    -------
+    top: OpenMM topology
+    m: perceived OEMol with the same atom order as top
+    """
+    # oeommtools uses the OEMol atom index as the OpenMM atom index
+    # so the indices have to be in PDB order. Originally we got this by
+    # writing a PDB string and reading it back in. Copying the molecule
+    # does the same thing, the new atoms are made in the PDB order.
+    # tests/test_preparation_paths.py checks both give the same atoms and clusters.
+    if pdb_round_trip:
+        m = _pdb_round_trip(oemol)
+    else:
+        m = oechem.OEMol(oemol)
+    m.SetTitle(mol_id)
+
+    # convert oemol to OpenMM topology
+    top = oeo_utils.oemol_to_openmmTop(m)[0]
+
+    oechem.OEAssignFormalCharges(m)
+    oechem.OEClearAromaticFlags(m)
+    # IMPORTANT!!!!
+    # use MDL aromaticity model to be consistent with SMIRNOFF
+    oechem.OEAssignAromaticFlags(m, aromaticity_model[1])
+    oechem.OEAssignHybridization(m)
+
+    return top, m
+
+
+def parameterize_topology(top, openmm_xml):
+    """
+    Parameterizes a topology from prepare_sequence with an OpenMM force field.
+
+    Returns
+    -------
+    parm: parmed system with the terminal residues labeled
+    """
+    ff = get_forcefield(openmm_xml)
+    protein_sys = ff.createSystem(top)
+
+    # save residue names in parm system
+    # We had issues with charges because they are different
+    # depending where they are in the residue chain, terminal
+    # residues have different charges than those in the
+    # main chain. More work is still require to figure out how
+    # properly handle charges
+    parm = parmed.openmm.load_topology(top, protein_sys)
+    for res in parm.residues:
+        rt = ResidueTemplate.from_residue(res)
+        if rt.tail is None and rt.head is not None:
+            res.name = 'C_'+res.name
+        elif rt.head is None and rt.tail is not None:
+            res.name = 'N_'+res.name
+
+    return parm
+
+
+def parameterize_sequence(mol_id, sequence, openmm_xml, pdb_round_trip=False):
+    """
+    Converts an amino acid sequence to an OEMol and parameterizes
+    it with an OpenMM force field.
+
+    Parameters
+    ----------
+    mol_id: str, title for the molecule
+    sequence: str, one letter amino acid sequence
+    openmm_xml: str, OpenMM force field file
+    pdb_round_trip: bool, if True use the original PDB string round trip
+                    to prepare the molecule
+
+    Returns
+    -------
+    parm: parmed system with the terminal residues labeled
+    m: perceived OEMol with the same atom order as parm
+    """
+    top, m = prepare_sequence(mol_id, sequence, pdb_round_trip)
+    return parameterize_topology(top, openmm_xml), m
+
+
+def _load_or_parameterize(mol_id, sequence, openmm_xmls, cache=None):
+    """
+    Loads a molecule and its parameter arrays for each force field from
+    the cache or parameterizes it and adds it to the cache. The molecule
+    is only prepared once no matter how many force fields are used.
+
+    Returns
+    -------
+    parms: {openmm_xml: parmed system or None if it was in the cache}
+    m: perceived OEMol
+    arrays: {openmm_xml: parameter arrays from parameter_arrays}
+    """
+    with get_run_log().job('parameterize', 'parameterize:%s' % mol_id,
+                           mol_id=mol_id, n_residues=len(sequence),
+                           n_forcefields=len(openmm_xmls)) as counts:
+        parms = dict()
+        arrays = dict()
+        cache_keys = dict()
+        m = None
+        if cache is not None:
+            for openmm_xml in openmm_xmls:
+                cache_keys[openmm_xml] = cache.key(sequence, openmm_xml, aromaticity_model[0])
+                cached = cache.load(cache_keys[openmm_xml])
+                if cached is not None:
+                    m, arrays[openmm_xml] = cached
+                    parms[openmm_xml] = None
+
+        missing = [x for x in openmm_xmls if x not in arrays]
+        if len(missing) > 0:
+            top, m = prepare_sequence(mol_id, sequence)
+            for openmm_xml in missing:
+                parms[openmm_xml] = parameterize_topology(top, openmm_xml)
+                arrays[openmm_xml] = parameter_arrays(parms[openmm_xml])
+                if openmm_xml in cache_keys:
+                    cache.save(cache_keys[openmm_xml], m, arrays[openmm_xml])
+
+        m.SetTitle(mol_id)
+        counts.update(n_cached=len(openmm_xmls) - len(missing), n_atoms=m.NumAtoms())
+        return parms, m, arrays
+
+
+def _parameterize_job(job):
+    """
+    Parameterizes one sequence with every force field in a worker process.
+    job is a tuple (mol_id, sequence, list of openmm_xmls, cache directory or None)
+    The OEMol is sent back as oeb bytes
+    """
+    mol_id, sequence, openmm_xmls, cache_dir = job
+    cache = None if cache_dir is None else ParameterCache(cache_dir)
+    _, m, arrays = _load_or_parameterize(mol_id, sequence, openmm_xmls, cache)
+    return mol_id, oechem.OEWriteMolToBytes('.oeb', m), arrays
+
+
+# Whole proteins from PDB or mmCIF files are too big to keep around
+# (a full parmed structure and OEMol for each one) and their clusters are
+# dominated by the same residue environments over and over. Instead each
+# structure is parameterized once and cut into overlapping windows of residues,
+# only the windows are kept.
+structure_extensions = ['.pdb', '.ent', '.cif', '.mmcif']
+
+# residues kept from structure files, waters, ions and ligands
+# don't have templates in the protein force fields
+protein_residue_names = set(['ALA', 'ARG', 'ASN', 'ASP', 'ASH', 'CYS', 'CYX', 'CYM', 'GLN', 'GLU', 'GLH',
+                             'GLY', 'HIS', 'HID', 'HIE', 'HIP', 'ILE', 'LEU', 'LYS', 'LYN', 'MET', 'PHE',
+                             'PRO', 'SER', 'THR', 'TRP', 'TYR', 'VAL'])
+
+
+def iter_structure_files(inputs):
+    """
+    Finds every PDB or mmCIF file in a list of files and directories.
+    Directories are searched for files with structure_extensions
+    which are read in sorted order.
+
+    Returns
+    -------
+    generator of (mol_id, path) tuples, molecules are named after the file
+    """
+    if isinstance(inputs, str):
+        inputs = [inputs]
+
+    for path in inputs:
+        if os.path.isdir(path):
+            files = sorted([f for f in glob.glob(os.path.join(path, '*'))
+                            if os.path.splitext(f)[1].lower() in structure_extensions])
+        else:
+            files = [path]
+        for structure_file in files:
+            yield os.path.basename(os.path.abspath(structure_file)).split('.')[0], structure_file
+
+
+def prepare_structure(mol_id, structure_file):
+    """
+    Reads a protein from a PDB or mmCIF file and prepares it
+    the same way as prepare_sequence. Only standard protein residues are kept
+    and hydrogens are added again so they have the names OpenMM expects.
+    The structure has to be complete (no missing residues or side chains)
+    for the force field templates to match, like the output of PDBFixer.
+
+    Parameters
+    ----------
+    mol_id: str, title for the molecule
+    structure_file: str, PDB or mmCIF file
+
+    Returns
+    -------
+    top: OpenMM topology
+    m: perceived OEMol with the same atom order as top,
+       chain IDs and residue numbers are kept from the file
+    """
+    ifs = oechem.oemolistream()
+    if not ifs.open(structure_file):
+        raise IOError("Could not open structure file %s" % structure_file)
+    oemol = oechem.OEMol()
+    if not oechem.OEReadMolecule(ifs, oemol):
+        raise ValueError("No molecule found in %s" % structure_file)
+    ifs.close()
+
+    for a in oemol.GetAtoms():
+        if oechem.OEAtomGetResidue(a).GetName().strip() not in protein_residue_names:
+            oemol.DeleteAtom(a)
+    if oemol.NumAtoms() == 0:
+        raise ValueError("No protein residues found in %s" % structure_file)
+
+    oechem.OESuppressHydrogens(oemol)
+    if oemol.NumBonds() == 0:
+        oechem.OEDetermineConnectivity(oemol)
+    oechem.OEFindRingAtomsAndBonds(oemol)
+    oechem.OEPerceiveBondOrders(oemol)
+    oechem.OEAssignImplicitHydrogens(oemol)
+    oechem.OEAssignFormalCharges(oemol)
+    oechem.OEAddExplicitHydrogens(oemol)
+    oechem.OEPerceiveResidues(oemol, oechem.OEPreserveResInfo_ChainID |
+                              oechem.OEPreserveResInfo_ResidueNumber |
+                              oechem.OEPreserveResInfo_InsertCode)
+    oechem.OEPDBOrderAtoms(oemol)
+    return _perceive_prepared(mol_id, oemol)
+
+
+def residue_windows(chains, window=5, context=2):
+    """
+    Splits each chain into windows. The cores of the windows cover
+    every residue exactly once and each window also has context residues
+    on both sides of its core (unless the chain ends there).
+
+    Parameters
+    ----------
+    chains: list with the chain ID of each residue in order
+    window: int, number of residues in the core of each window
+    context: int, number of residues added on each side of the core,
+             this needs to cover the largest fragment environment
+
+    Returns
+    -------
+    windows: list of (core start, core end, window start, window end)
+             residue indices, ends are exclusive
+    """
+    if window < 1 or context < 1:
+        raise ValueError("window and context must be at least 1 residue, got %i and %i" % (window, context))
+
+    windows = list()
+    chain_start = 0
+    for chain_end in range(1, len(chains) + 1):
+        if chain_end < len(chains) and chains[chain_end] == chains[chain_start]:
+            continue
+        for start in range(chain_start, chain_end, window):
+            end = min(start + window, chain_end)
+            windows.append((start, end, max(chain_start, start - context), min(chain_end, end + context)))
+        chain_start = chain_end
+    return windows
+
+
+# residue names for atoms added by cap_window, CAP is a plain methyl group
+# for cut bonds that aren't peptide bonds
+cap_residue_names = ['ACE', 'NME', 'CAP']
+
+# atoms in each cap as (name, element, name of the atom it is bonded to, bond order),
+# the first atom is bonded to the atom in the window
+_cap_atoms = {
+    'ACE': [('C', oechem.OEElemNo_C, None, 1),
+            ('O', oechem.OEElemNo_O, 'C', 2),
+            ('CH3', oechem.OEElemNo_C, 'C', 1),
+            ('H1', oechem.OEElemNo_H, 'CH3', 1),
+            ('H2', oechem.OEElemNo_H, 'CH3', 1),
+            ('H3', oechem.OEElemNo_H, 'CH3', 1)],
+    'NME': [('N', oechem.OEElemNo_N, None, 1),
+            ('H', oechem.OEElemNo_H, 'N', 1),
+            ('CH3', oechem.OEElemNo_C, 'N', 1),
+            ('H1', oechem.OEElemNo_H, 'CH3', 1),
+            ('H2', oechem.OEElemNo_H, 'CH3', 1),
+            ('H3', oechem.OEElemNo_H, 'CH3', 1)],
+}
+
+
+def cap_type(inside, outside):
+    """
+    Returns
+    -------
+    cap: 'ACE' if the cut bond is from an amide N in the window to the carbonyl C
+         of the residue before it, 'NME' if it is from a carbonyl C in the window to the
+         N of the next residue, otherwise 'CAP'
+    """
+    if inside.IsNitrogen() and outside.IsCarbon():
+        return 'ACE'
+    if inside.IsCarbon() and outside.IsNitrogen():
+        return 'NME'
+    return 'CAP'
+
+
+def add_cap(sub_mol, inside, outside, order=1):
+    """
+    Adds a cap to sub_mol in place of the atom outside (in the full molecule)
+    which was bonded to inside (in sub_mol). Peptide bonds get ACE or NME caps
+    so the window ends like a capped peptide, anything else gets a methyl group.
+    Every cap atom gets a copy of outside's residue with the cap's residue name.
+    """
+    cap = cap_type(inside, outside)
+    res = oechem.OEResidue(oechem.OEAtomGetResidue(outside))
+    res.SetName(cap)
+
+    if cap == 'CAP':
+        atoms = [('C', oechem.OEElemNo_C, None, order)] + \
+                [('H%i' % (h + 1), oechem.OEElemNo_H, 'C', 1) for h in range(4 - order)]
+    else:
+        atoms = _cap_atoms[cap]
+
+    cap_atoms = dict()
+    for name, element, bonded_to, bond_order in atoms:
+        atom = sub_mol.NewAtom(element)
+        atom.SetName(name)
+        atom.SetImplicitHCount(0)
+        oechem.OEAtomSetResidue(atom, res)
+        partner = inside if bonded_to is None else cap_atoms[bonded_to]
+        sub_mol.NewBond(partner, atom, bond_order)
+        cap_atoms[name] = atom
+
+
+# SetData tag with the first and last residue of each chain in the molecule
+# a window was cut from, so residue_positions can tell real chain ends from cut ends
+chain_termini_tag = 'chain_termini'
+
+
+def _residue_key(res):
+    return res.GetResidueNumber(), res.GetInsertCode()
+
+
+def chain_termini(mol):
+    """
+    Finds the first and last residue of each chain (in atom order), caps aren't counted.
+    Windows (see cap_window) keep the chain ends of the whole protein in chain_termini_tag.
+
+    Returns
+    -------
+    termini: {chain ID: ((residue number, insert code) of the first residue,
+                         (residue number, insert code) of the last residue)}
+    """
+    if mol.HasData(chain_termini_tag):
+        return {chain: (tuple(first), tuple(last))
+                for chain, first, last in json.loads(mol.GetData(chain_termini_tag))}
+
+    termini = collections.OrderedDict()
+    for a in mol.GetAtoms():
+        res = oechem.OEAtomGetResidue(a)
+        if res.GetName() in cap_residue_names:
+            continue
+        chain = res.GetChainID()
+        first = termini[chain][0] if chain in termini else _residue_key(res)
+        termini[chain] = (first, _residue_key(res))
+    return termini
+
+
+def cap_window(mol, atom_indices, title):
+    """
+    Copies some of the atoms in a molecule to a new molecule.
+    Every peptide bond that was cut is capped like a peptide with ACE/NME caps
+    (an acetyl group on the N and an N-methyl amide on the carbonyl C),
+    any other bond that was cut is capped with a methyl group (see add_cap).
+
+    Parameters
+    ----------
+    mol: perceived OEMol
+    atom_indices: sorted array of atom indices to keep
+    title: str, title for the new molecule
+
+    Returns
+    -------
+    sub_mol: OEMol with the kept atoms first (in the same order) followed by the caps,
+             the chain ends of mol are stored in chain_termini_tag
+    new_idx: array with the index in sub_mol for every atom in mol, -1 if it wasn't kept
+    """
+    new_idx = np.full(mol.GetMaxAtomIdx(), -1, dtype=np.int32)
+    new_idx[atom_indices] = np.arange(len(atom_indices))
+
+    sub_mol = oechem.OEMol()
+    sub_mol.SetTitle(title)
+    termini = chain_termini(mol)
+    sub_mol.SetData(chain_termini_tag, json.dumps([[chain, first, last] for chain, (first, last) in termini.items()]))
+    new_atoms = dict()
+    for a in mol.GetAtoms():
+        if new_idx[a.GetIdx()] >= 0:
+            new_atoms[a.GetIdx()] = sub_mol.NewAtom(a)
+            oechem.OEAtomSetResidue(new_atoms[a.GetIdx()], oechem.OEAtomGetResidue(a))
+
+    for b in mol.GetBonds():
+        bgn, end = b.GetBgnIdx(), b.GetEndIdx()
+        if bgn in new_atoms and end in new_atoms:
+            sub_mol.NewBond(new_atoms[bgn], new_atoms[end], b.GetOrder())
+        elif bgn in new_atoms:
+            add_cap(sub_mol, new_atoms[bgn], b.GetEnd(), b.GetOrder())
+        elif end in new_atoms:
+            add_cap(sub_mol, new_atoms[end], b.GetBgn(), b.GetOrder())
+
+    oechem.OEClearAromaticFlags(sub_mol)
+    oechem.OEAssignAromaticFlags(sub_mol, aromaticity_model[1])
+    oechem.OEAssignHybridization(sub_mol)
+    return sub_mol, new_idx
+
+
+def _term_atoms(terms, key):
+    """
+    atom indices with shape (n terms, n atoms) for the parameter array arrays[key]
+    """
+    if key == 'atoms':
+        return terms['idx'].reshape(-1, 1)
+    return terms['atoms']
+
+
+def iter_structure_windows(mol_id, structure_file, openmm_xmls, window=5, context=2):
+    """
+    Parameterizes a whole protein once with every force field and cuts it into
+    windows (see residue_windows). Each term (atom, bond, angle, torsion) is kept
+    in the window whose core has the lowest residue in that term, so every
+    term shows up exactly once. Residues bonded to a core residue from elsewhere
+    in the protein (like disulfide bonds) are added to that window too.
+    The full molecule, topology and parmed systems are freed once
+    the windows are made so only the windows are kept.
+
+    Parameters
+    ----------
+    mol_id: str, windows are named [mol_id]_w[first core residue]
+    structure_file: str, PDB or mmCIF file
+    openmm_xmls: list of OpenMM force field files
+    window: int, number of residues in the core of each window
+    context: int, number of residues added on each side of the core
+
+    Returns
+    -------
+    generator of (window_id, OEMol, {openmm_xml: parameter arrays})
+    """
+    with get_run_log().job('parameterize_structure', 'parameterize:%s' % mol_id,
+                           mol_id=mol_id, n_forcefields=len(openmm_xmls)) as counts:
+        top, m = prepare_structure(mol_id, structure_file)
+        full_arrays = dict()
+        for openmm_xml in openmm_xmls:
+            parm = parameterize_topology(top, openmm_xml)
+            full_arrays[openmm_xml] = parameter_arrays(parm)
+            del parm
+        del top
+        counts.update(n_atoms=m.NumAtoms())
+
+    first = full_arrays[openmm_xmls[0]]
+    atom_residues = first['atoms']['residue']
+    n_residues = atom_residues.max() + 1
+    chains = [''] * n_residues
+    for a in m.GetAtoms():
+        chains[atom_residues[a.GetIdx()]] = oechem.OEAtomGetResidue(a).GetChainID()
+
+    # residues bonded to residues more than one away, like disulfide bonds
+    bonded_residues = atom_residues[first['bonds']['atoms']]
+    crosslinks = collections.defaultdict(set)
+    for r1, r2 in bonded_residues[np.abs(bonded_residues[:, 0] - bonded_residues[:, 1]) > 1].tolist():
+        crosslinks[r1].add(r2)
+        crosslinks[r2].add(r1)
+
+    # terms sorted by their lowest residue so each core is a slice
+    sorted_terms = dict()
+    for openmm_xml, arrays in full_arrays.items():
+        sorted_terms[openmm_xml] = dict()
+        for key in arrays:
+            min_res = atom_residues[_term_atoms(arrays[key], key)].min(axis=1)
+            order = np.argsort(min_res, kind='stable')
+            sorted_terms[openmm_xml][key] = (arrays[key][order], min_res[order])
+
+    windows = residue_windows(chains, window, context)
+    window_counts = {'n_residues': int(n_residues), 'n_windows': len(windows), 'n_cut_terms': 0}
+    for core_start, core_end, start, end in windows:
+        residues = set(range(start, end))
+        for r in range(core_start, core_end):
+            residues.update(crosslinks.get(r, set()))
+        in_window = np.isin(atom_residues, list(residues))
+        window_id = '%s_w%i' % (mol_id, core_start)
+        sub_mol, new_idx = cap_window(m, np.flatnonzero(in_window), window_id)
+
+        window_arrays = dict()
+        for openmm_xml, terms in sorted_terms.items():
+            window_arrays[openmm_xml] = dict()
+            for key, (terms_array, min_res) in terms.items():
+                lo, hi = np.searchsorted(min_res, [core_start, core_end])
+                kept = terms_array[lo:hi].copy()
+                inside = in_window[_term_atoms(kept, key)].all(axis=1)
+                window_counts['n_cut_terms'] += int((~inside).sum())
+                kept = kept[inside]
+                if key == 'atoms':
+                    kept['idx'] = new_idx[kept['idx']]
+                else:
+                    kept['atoms'] = new_idx[kept['atoms']]
+                window_arrays[openmm_xml][key] = kept
+        yield window_id, sub_mol, window_arrays
+
+    get_run_log().event('structure_windows', mol_id=mol_id, **window_counts)
+
+
+def _structure_windows_job(job):
+    """
+    Makes every window for one structure in a worker process.
+    job is a tuple (mol_id, structure_file, list of openmm_xmls, window, context)
+    The OEMols are sent back as oeb bytes
+    """
+    mol_id, structure_file, openmm_xmls, window, context = job
+    return [(window_id, oechem.OEWriteMolToBytes('.oeb', m), arrays)
+            for window_id, m, arrays in iter_structure_windows(mol_id, structure_file, openmm_xmls,
+                                                               window, context)]
 
-    def add_key(self, key):
-        if key not in self.d:
-            self.d[key] = {'atom_indices': dict(), 'parameters': set(), 'units': None}
 
-    def add_atoms(self, key, mol_id, atom_tuple):
-        self.add_key(key)
-        if mol_id not in self.d[key]['atom_indices']:
-            self.d[key]['atom_indices'][mol_id] = list()
-        self.d[key]['atom_indices'][mol_id].append(tuple(atom_tuple))
+def check_preparation_paths(inputs, openmm_xml='amber99sbildn.xml'):
+    """
+    Checks that preparing molecules by copying gives the same molecules
+    and clusters as the original PDB string round trip.
 
-    def add_param(self, key, params):
-        self.add_key(key)
-        new_tuple = [x._value for x in params]
-        self.d[key]['parameters'].add(tuple(new_tuple))
-        self.d[key]['units'] = tuple([x.unit for x in params])
+    Parameters
+    ----------
+    inputs: list of fasta files or directories
+    openmm_xml: str, OpenMM force field file
+
+    Returns
+    -------
+    mismatches: list of (mol_id, reason) for every molecule that is different
+    """
+    mismatches = list()
+    for mol_id, sequence in iter_fasta_records(inputs):
+        systems = list()
+        for round_trip in [True, False]:
+            parm, m = parameterize_sequence(mol_id, sequence, openmm_xml, pdb_round_trip=round_trip)
+            system = ParameterSystem(openmm_xml=openmm_xml)
+            system.add_prepared_system(mol_id, m, parameter_arrays(parm), parm)
+            systems.append((m, system))
+
+        (old_mol, old_sys), (new_mol, new_sys) = systems
+        old_atoms = [(a.GetIdx(), a.GetAtomicNum(), oechem.OEAtomGetResidue(a).GetName())
+                     for a in old_mol.GetAtoms()]
+        new_atoms = [(a.GetIdx(), a.GetAtomicNum(), oechem.OEAtomGetResidue(a).GetName())
+                     for a in new_mol.GetAtoms()]
+        if old_atoms != new_atoms:
+            mismatches.append((mol_id, 'atoms'))
+            continue
+
+        old_clusters = old_sys.convert_for_smirksifying()[1]
+        new_clusters = new_sys.convert_for_smirksifying()[1]
+        for label in old_clusters:
+            if old_clusters[label] != new_clusters[label]:
+                mismatches.append((mol_id, label))
+    return mismatches
 
 
 class ParameterSystem:
@@ -96,154 +1114,324 @@ class ParameterSystem:
     there atoms to ParameterDicts for each fragment type.
     """
 
-    def __init__(self, openmm_xml='amber99sbildn.xml'):
-        self.openmm_xml = openmm_xml
-        self.lj_dict = ParameterDict()
-        self.charge_dict = ParameterDict()
-        self.bond_dict = ParameterDict()
-        self.angle_dict = ParameterDict()
-        self.proper_dict = ParameterDict()
-        self.improper_dict = ParameterDict()
+    def __init__(self, openmm_xml='amber99sbildn.xml', cache_dir=None):
+        """
+        Parameters
+        ----------
+        openmm_xml: str or list of str, OpenMM force fields used to parameterize molecules.
+                    Each molecule is only prepared once and then parameterized with
+                    every force field, there is a set of ParameterDicts for each one.
+                    The first force field is the default for every method
+                    that takes an openmm_xml.
+        cache_dir: str, optional directory for a ParameterCache,
+                   if provided parameterized molecules are stored there
+                   and reused the next time the same fasta is added
+        """
+        if isinstance(openmm_xml, str):
+            openmm_xml = [openmm_xml]
+        self.openmm_xmls = list(openmm_xml)
+        self.openmm_xml = self.openmm_xmls[0]
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = ParameterCache(cache_dir)
+        self._dict_sets = {x: self._new_parameter_dicts() for x in self.openmm_xmls}
         self.mol_dict = dict()
+        # molecules added and removed since the last call to cluster_delta
+        self._added = list()
+        self._removed = list()
+
+    @staticmethod
+    def _new_parameter_dicts():
+        return {
+            'lj': ParameterDict(['%.3f', '%.3f']),
+            'charge': ParameterDict(['%.5f', _terminal_label]),
+            'proper_torsion': ParameterDict('%.3f'),
+            'improper_torsion': ParameterDict(['%.3f', '%.3f', '%.3f', '%i']),
+            'angle': ParameterDict(['%.3f', '%.3f']),
+            'bond': ParameterDict(['%.3f', '%.3f']),
+        }
+
+    def parameter_dicts(self, openmm_xml=None):
+        """
+        Parameters
+        ----------
+        openmm_xml: str, force field for these dictionaries, defaults to the first one
+
+        Returns
+        -------
+        dictionaries: {fragment type: ParameterDict}
+        """
+        if openmm_xml is None:
+            openmm_xml = self.openmm_xml
+        return self._dict_sets[openmm_xml]
+
+    # dictionaries for the first force field
+    lj_dict = property(lambda self: self.parameter_dicts()['lj'])
+    charge_dict = property(lambda self: self.parameter_dicts()['charge'])
+    proper_dict = property(lambda self: self.parameter_dicts()['proper_torsion'])
+    improper_dict = property(lambda self: self.parameter_dicts()['improper_torsion'])
+    angle_dict = property(lambda self: self.parameter_dicts()['angle'])
+    bond_dict = property(lambda self: self.parameter_dicts()['bond'])
 
     def add_system_from_fasta(self, fasta):
         """
         When working with fasta files, this function does the bulk of
         the work for converting that fasta file to an OEMol and
         then making an OpenMM system and identifying parameters by atom.
+        Only the first sequence in the file is used and
+        the molecule is named after the file.
 
         For all tests in this manuscript we started with the file
         mol_files/everything.fasta
         """
         base = os.path.abspath(fasta).split('.')[0]
         mol_id = base.split('/')[-1]
+        _, sequence = next(_read_fasta_records(fasta))
+        return self.add_system_from_sequence(mol_id, sequence)
 
-        oemol = oechem.OEMol()
-        ifs = oechem.oemolistream(fasta)
-
-        # After a lot of working on a single example
-        # this seems to be the right combination
-        # of calls to get an oemol from a fasta into the form
-        # where all bonds are fully perceived with order, etc.
-        # and that allows oeommtools to convert
-        # the molecule into an OpenMM system.
-        # I don't have justification for most of the steps.
-        oechem.OEReadFASTAFile(ifs, oemol)
-        oechem.OEAddExplicitHydrogens(oemol)
-        oechem.OEPerceiveResidues(oemol)
-        oechem.OEPDBOrderAtoms(oemol)
-
-        ofs = oechem.oemolostream()
-        ofs.SetFormat(oechem.OEFormat_PDB)
-        ofs.openstring()
-        oechem.OEWriteMolecule(ofs, oemol)
-
-        ifs = oechem.oemolistream()
-        ifs.openstring(ofs.GetString())
-        m = oechem.OEMol()
-        oechem.OEReadPDBFile(ifs, m)
-        m.SetTitle(mol_id)
+    def add_system_from_sequence(self, mol_id, sequence):
+        """
+        Parameterizes one amino acid sequence (or loads it from the cache)
+        and adds it to this system.
+
+        Parameters
+        ----------
+        mol_id: str, key for this molecule, also used as the molecule title
+        sequence: str, one letter amino acid sequence
 
-        # convert oemol to OpenMM topology
-        top = oeo_utils.oemol_to_openmmTop(m)[0]
-        ff = app.ForceField(self.openmm_xml)
-        protein_sys = ff.createSystem(top)
-
-        oechem.OEAssignFormalCharges(m)
-        oechem.OEClearAromaticFlags(m)
-        # IMPORTANT!!!!
-        # use MDL aromaticity model to be consistent with SMIRNOFF
-        oechem.OEAssignAromaticFlags(m, oechem.OEAroModel_MDL)
-        oechem.OEAssignHybridization(m)
-
-        # save residue names in parm system
-        # We had issues with charges because they are different
-        # depending where they are in the residue chain, terminal
-        # residues have different charges than those in the
-        # main chain. More work is still require to figure out how
-        # properly handle charges
-        parm = parmed.openmm.load_topology(top, protein_sys)
-        for res in parm.residues:
-            rt = ResidueTemplate.from_residue(res)
-            if rt.tail is None and rt.head is not None:
-                res.name = 'C_'+res.name
-            elif rt.head is None and rt.tail is not None:
-                res.name = 'N_'+res.name
+        Returns
+        -------
+        parm: parmed system for the first force field,
+              this is None if the molecule came from the cache
+        oemol: OEMol for this sequence
+        """
+        parms, m, arrays = _load_or_parameterize(mol_id, sequence, self.openmm_xmls, self.cache)
+        self.add_prepared_system(mol_id, m, arrays, parms)
+        return parms[self.openmm_xml], m
 
+    def add_prepared_system(self, mol_id, oemol, arrays, parm=None):
+        """
+        Adds an already parameterized molecule to this system.
+
+        Parameters
+        ----------
+        mol_id: str, key for this molecule
+        oemol: perceived OEMol
+        arrays: {openmm_xml: parameter arrays from parameter_arrays} with every force field,
+                with one force field the parameter arrays can be used directly
+        parm: optional parmed system or {openmm_xml: parmed system}
+        """
+        if 'atoms' in arrays:
+            arrays = {self.openmm_xml: arrays}
+        if parm is None or not isinstance(parm, dict):
+            parm = {self.openmm_xml: parm}
+
+        if mol_id in self.mol_dict:
+            # replace the old version of this molecule
+            self.remove_system(mol_id)
+        oemol.SetTitle(mol_id)
         self.mol_dict[mol_id] = {
-            'parmed': parm,
-            'oemol': oechem.OEMol(m)
+            'parmed': parm.get(self.openmm_xml, None),
+            'parmeds': parm,
+            'oemol': oechem.OEMol(oemol)
         }
-        self._add_parameters_from_system(parm, mol_id)
+        for openmm_xml in self.openmm_xmls:
+            self._add_parameters_from_arrays(arrays[openmm_xml], mol_id, openmm_xml)
+        self._added.append(mol_id)
 
-        return parm, m
+    def remove_system(self, mol_id):
+        """
+        Removes a molecule and all of its fragments from this system.
+        The other clusters are left as they are.
+        """
+        if mol_id not in self.mol_dict:
+            raise KeyError("No molecule %s in this ParameterSystem" % mol_id)
+        del self.mol_dict[mol_id]
+        for dict_set in self._dict_sets.values():
+            for par_dict in dict_set.values():
+                par_dict.remove_molecule(mol_id)
+        if mol_id in self._added:
+            self._added.remove(mol_id)
+        else:
+            self._removed.append(mol_id)
+
+    def cluster_delta(self):
+        """
+        Reports what changed since the last time this was called
+        (or since the system was made). Only changed clusters
+        and molecules are included so this is cheap to call after adding
+        a few molecules to a big system.
 
-    def _add_parameters_from_system(self, sys, mol_id):
-        self.add_nonbonds(sys, mol_id)
-        self.add_bonds(sys, mol_id)
-        self.add_angles(sys, mol_id)
-        self.add_torsions(sys, mol_id)
+        Returns
+        -------
+        delta: dictionary with the form
+               {'added': [mol_ids], 'removed': [mol_ids],
+                'clusters': {fragment type: [(label, {mol_id: [(atoms), ]})]},
+                'forcefields': {openmm_xml: clusters in the same form}}
+               'clusters' is for the first force field,
+               removed molecules have an empty list in the clusters they used to be in
+        """
+        forcefields = dict()
+        for openmm_xml, dict_set in self._dict_sets.items():
+            forcefields[openmm_xml] = {label: par_dict.pop_changes() for label, par_dict in dict_set.items()}
+        delta = {
+            'added': self._added,
+            'removed': self._removed,
+            'clusters': forcefields[self.openmm_xml],
+            'forcefields': forcefields
+        }
+        self._added = list()
+        self._removed = list()
+        return delta
+
+    def add_systems_from_fastas(self, inputs, n_workers=1):
+        """
+        Adds every sequence from a list of fasta files and/or directories
+        of fasta files. Records are read lazily and if n_workers is more than 1
+        they are parameterized in a process pool. Either way molecules are
+        added in the same order they are in the input files.
+
+        Parameters
+        ----------
+        inputs: list of fasta files or directories with fasta files
+        n_workers: number of processes used to parameterize molecules
+
+        Returns
+        -------
+        mol_ids: list of keys for the molecules that were added
+        """
+        cache_dir = None if self.cache is None else self.cache.cache_dir
+        jobs = ((mol_id, sequence, self.openmm_xmls, cache_dir)
+                for mol_id, sequence in iter_fasta_records(inputs))
+
+        mol_ids = list()
+        run_log = get_run_log()
+        with run_log.job('add_systems', openmm_xmls=self.openmm_xmls, n_workers=n_workers) as counts:
+            if n_workers is None or n_workers <= 1:
+                for mol_id, sequence, _, _ in jobs:
+                    self.add_system_from_sequence(mol_id, sequence)
+                    mol_ids.append(mol_id)
+                counts['n_mols'] = len(mol_ids)
+                return mol_ids
+
+            # imap hands back results in the order of the input records
+            # as soon as each one (and all the ones before it) are done
+            pool = multiprocessing.Pool(processes=n_workers,
+                                        initializer=_preload_forcefields,
+                                        initargs=(self.openmm_xmls, run_log.settings))
+            try:
+                for mol_id, oeb, arrays in pool.imap(_parameterize_job, jobs):
+                    self.add_prepared_system(mol_id, mols_from_bytes([oeb])[0], arrays)
+                    mol_ids.append(mol_id)
+            finally:
+                pool.close()
+                pool.join()
+            counts['n_mols'] = len(mol_ids)
+        return mol_ids
+
+    def add_windows_from_structures(self, inputs, window=5, context=2, n_workers=1):
+        """
+        Adds windows cut from every protein in a list of PDB or mmCIF files
+        and/or directories (see iter_structure_windows). Only the windows are kept,
+        so memory depends on the window size and not the size of the proteins.
+        If n_workers is more than 1 structures are parameterized in a process pool.
 
-    def add_nonbonds(self, sys, mol_id):
+        Parameters
+        ----------
+        inputs: list of structure files or directories with structure files
+        window: int, number of residues in the core of each window
+        context: int, number of residues added on each side of the core
+        n_workers: number of processes used to parameterize structures
+
+        Returns
+        -------
+        mol_ids: list of keys for the windows that were added
+        """
+        jobs = ((mol_id, structure_file, self.openmm_xmls, window, context)
+                for mol_id, structure_file in iter_structure_files(inputs))
+
+        mol_ids = list()
+        run_log = get_run_log()
+        with run_log.job('add_structures', openmm_xmls=self.openmm_xmls, n_workers=n_workers,
+                         window=window, context=context) as counts:
+            if n_workers is None or n_workers <= 1:
+                for mol_id, structure_file, _, _, _ in jobs:
+                    for window_id, m, arrays in iter_structure_windows(mol_id, structure_file,
+                                                                       self.openmm_xmls, window, context):
+                        self.add_prepared_system(window_id, m, arrays)
+                        mol_ids.append(window_id)
+                counts['n_mols'] = len(mol_ids)
+                return mol_ids
+
+            pool = multiprocessing.Pool(processes=n_workers,
+                                        initializer=_preload_forcefields,
+                                        initargs=(self.openmm_xmls, run_log.settings))
+            try:
+                for windows in pool.imap(_structure_windows_job, jobs):
+                    for window_id, oeb, arrays in windows:
+                        self.add_prepared_system(window_id, mols_from_bytes([oeb])[0], arrays)
+                        mol_ids.append(window_id)
+            finally:
+                pool.close()
+                pool.join()
+            counts['n_mols'] = len(mol_ids)
+        return mol_ids
+
+    def _add_parameters_from_arrays(self, arrays, mol_id, openmm_xml=None):
+        self.add_nonbonds(arrays, mol_id, openmm_xml)
+        self.add_bonds(arrays, mol_id, openmm_xml)
+        self.add_angles(arrays, mol_id, openmm_xml)
+        self.add_torsions(arrays, mol_id, openmm_xml)
+
+    def add_nonbonds(self, arrays, mol_id, openmm_xml=None):
         """
         Updates LJ and charge dictionaries for this system.
         Parameters
         ----------
-        sys: parmed system
+        arrays: parameter arrays from parameter_arrays
         mol_id: key for this system to store data in the dictionaries
+        openmm_xml: force field these parameters are from, defaults to the first one
         """
         # TODO raise error if mol_id not in mol_dict
-        for a in sys.atoms:
-            # find terminal label:
-            term_label = 'X'
-            if 'N_' in a.residue.name:
-                term_label = 'N'
-            elif 'C_' in a.residue.name:
-                term_label = 'C'
-
-            # Update charge dictionary:
-            charge_str = "%.5f\t%s" % (a.charge, term_label)
-            charge_param = [a.ucharge]
-            self.charge_dict.add_param(charge_str, charge_param)
-            self.charge_dict.add_atoms(charge_str, mol_id, [a.idx])
-
-            # Update LJ dictionary
-            lj_str = "%.3f\t%.3f" % (a.epsilon, a.rmin)
-            lj_params = [a.uepsilon, a.urmin]
-            self.lj_dict.add_param(lj_str, lj_params)
-            self.lj_dict.add_atoms(lj_str, mol_id, [a.idx])
-
-    def add_bonds(self, sys, mol_id):
+        dictionaries = self.parameter_dicts(openmm_xml)
+        atoms = arrays['atoms']
+        indices = atoms['idx'].reshape(-1, 1)
+        dictionaries['charge'].add_parameters(mol_id, indices,
+                                              np.column_stack([atoms['charge'], atoms['terminal']]))
+        dictionaries['lj'].add_parameters(mol_id, indices,
+                                          np.column_stack([atoms['epsilon'], atoms['rmin']]))
+
+    def add_bonds(self, arrays, mol_id, openmm_xml=None):
         """
         Updates the bond parameter dictionary for the input system.
         Parameters
         ----------
-        sys: parmed system
+        arrays: parameter arrays from parameter_arrays
         mol_id: key for this system to store data in the dictionaries
+        openmm_xml: force field these parameters are from, defaults to the first one
         """
         # TODO raise error if mol_id not in mol_dict
-        for b in sys.bonds:
-            bond_str = "%.3f\t%.3f" % (b.type.k, b.type.req)
-            bond_params = [b.type.uk, b.type.ureq]
-            self.bond_dict.add_param(bond_str, bond_params)
-            self.bond_dict.add_atoms(bond_str, mol_id, [b.atom1.idx, b.atom2.idx])
+        dictionaries = self.parameter_dicts(openmm_xml)
+        bonds = arrays['bonds']
+        dictionaries['bond'].add_parameters(mol_id, bonds['atoms'],
+                                            np.column_stack([bonds['k'], bonds['req']]))
 
-    def add_angles(self, sys, mol_id):
+    def add_angles(self, arrays, mol_id, openmm_xml=None):
         """
         Updates the angle parameter dictionary for the input system.
         Parameters
         ----------
-        sys: parmed system
+        arrays: parameter arrays from parameter_arrays
         mol_id: key for this system to store data in the dictionaries
+        openmm_xml: force field these parameters are from, defaults to the first one
         """
         # TODO raise error if mol_id not in mol_dict
-        for an in sys.angles:
-            angle_str = "%.3f\t%.3f" % (an.type.k, an.type.theteq)
-            angle_params = [an.type.uk, an.type.utheteq]
-            self.angle_dict.add_param(angle_str, angle_params)
-            self.angle_dict.add_atoms(angle_str, mol_id, [an.atom1.idx, an.atom2.idx, an.atom3.idx])
+        dictionaries = self.parameter_dicts(openmm_xml)
+        angles = arrays['angles']
+        dictionaries['angle'].add_parameters(mol_id, angles['atoms'],
+                                             np.column_stack([angles['k'], angles['theteq']]))
 
-    def convert_for_smirksifying(self, param_type=None):
+    def convert_for_smirksifying(self, param_type=None, sparse=False, openmm_xml=None):
         """
 
         Parameters
@@ -253,6 +1441,12 @@ class ParameterSystem:
                     'improper_torsion', 'angle', 'bond']
                     If parameter type is None, a dictionary with all
                     clusters is returned instead
+        sparse: if True clusters are in the form (label, {mol index: [(atoms), ]})
+                where mol index is the position in the list of molecules,
+                molecules without that parameter are left out instead of
+                being padded with empty lists.
+        openmm_xml: force field for the clusters, defaults to the first one.
+                    The molecules are the same (and in the same order) for every force field.
 
         Returns
         -------
@@ -265,76 +1459,72 @@ class ParameterSystem:
         mol_list = list()
         cluster_types = dict()
 
-        dictionaries = {
-            'lj': self.lj_dict,
-            'charge': self.charge_dict,
-            'proper_torsion': self.proper_dict,
-            'improper_torsion': self.improper_dict,
-            'angle': self.angle_dict,
-            'bond': self.bond_dict,
-        }
+        dictionaries = self.parameter_dicts(openmm_xml)
 
         if param_type is not None:
             if param_type.lower() not in dictionaries.keys():
                 return cluster_types
             dictionaries = {param_type.lower(): dictionaries[param_type.lower()]}
 
-        for idx, me in self.mol_dict.items():
-            idx_list.append(idx)
-            mol_list.append(me['oemol'])
-
-        for label, par_dict in dictionaries.items():
-            cluster_types[label] = list()
-            for cluster_label, entry in par_dict.items():
-                atom_list = list()
-                for idx in idx_list:
-                    if idx in entry['atom_indices']:
-                        atom_list.append(entry['atom_indices'][idx])
-                    else:
-                        atom_list.append(list())
-                cluster_types[label].append((cluster_label, atom_list))
+        with get_run_log().job('convert_for_smirksifying', param_type=param_type, sparse=sparse,
+                               openmm_xml=openmm_xml or self.openmm_xml) as counts:
+            for idx, me in self.mol_dict.items():
+                idx_list.append(idx)
+                mol_list.append(me['oemol'])
+
+            positions = {idx: i for i, idx in enumerate(idx_list)}
+            for label, par_dict in dictionaries.items():
+                if sparse:
+                    cluster_types[label] = [(c_label, {positions[m]: atoms for m, atoms in mol_atoms.items()})
+                                            for c_label, mol_atoms in par_dict.sparse_clusters()]
+                else:
+                    cluster_types[label] = par_dict.clusters(idx_list)
+            counts['n_mols'] = len(mol_list)
+            counts['n_clusters'] = {label: len(c) for label, c in cluster_types.items()}
 
         if param_type is None:
             return mol_list, cluster_types
 
         return mol_list, cluster_types[param_type.lower()]
 
-    def add_torsions(self, sys, mol_id):
+    def add_torsions(self, arrays, mol_id, openmm_xml=None):
         """
         Updates the proper_torsion and improper_torsion
         parameter dictionaries for the input system.
         Parameters
         ----------
-        sys: parmed system
+        arrays: parameter arrays from parameter_arrays
         mol_id: key for this system to store data in the dictionaries
+        openmm_xml: force field these parameters are from, defaults to the first one
         """
         # TODO raise error if mol_id not in mol_dict
-        temp_dict = dict()
-        for d in sys.dihedrals:
-            # Check for Improper
-            if d.improper:
-                imp_str = "%.3f\t%.3f\t%.3f\t%i" % (d.type.phi_k, d.type.phase, d.type.per, d.atom3.atomic_number)
-                imp_params = [d.type.uphi_k, d.type.uphase, unit.Quantity(d.type.per)]
-                self.improper_dict.add_param(imp_str, imp_params)
-
-                # order side atoms:
-                sides = sorted([d.atom1.idx, d.atom2.idx, d.atom4.idx])
-                atom_indices = [sides[0], d.atom3.idx, sides[1], sides[2]]
-                self.improper_dict.add_atoms(imp_str, mol_id, atom_indices)
-            else: # proper torsion
-                atoms = tuple([d.atom1.idx, d.atom2.idx, d.atom3.idx, d.atom4.idx])
-                params = (d.type.uphi_k, d.type.uphase, unit.Quantity(d.type.per))
-                if atoms not in temp_dict:
-                    temp_dict[atoms] = list()
-                temp_dict[atoms].append(params)
-
-        # combine parameters with multiple periodicities for the
-        # same four atoms so those are treated as one parameter
-        for atoms, param_list in temp_dict.items():
-            new_params = [p for t in param_list for p in t]
-            prop_str = '\t'.join(['%.3f' % p._value for p in new_params])
-            self.proper_dict.add_param(prop_str, new_params)
-            self.proper_dict.add_atoms(prop_str, mol_id, atoms)
+        dictionaries = self.parameter_dicts(openmm_xml)
+        imps = arrays['impropers']
+        dictionaries['improper_torsion'].add_parameters(mol_id, imps['atoms'],
+                                                        np.column_stack([imps['phi_k'], imps['phase'],
+                                                                         imps['per'], imps['atom3_element']]))
+
+        props = arrays['propers']
+        dictionaries['proper_torsion'].add_parameters(mol_id, props['atoms'],
+                                                      props['params'].reshape(len(props), -1))
+
+
+def dense_clusters(sparse_clusters, n_mols):
+    """
+    Converts sparse clusters from convert_for_smirksifying(sparse=True)
+    to the padded format ChemPer uses.
+
+    Parameters
+    ----------
+    sparse_clusters: list of (label, {mol index: [(atoms), ]})
+    n_mols: number of molecules
+
+    Returns
+    -------
+    clusters: list of (label, [[(atoms), ] for each molecule])
+    """
+    return [(label, [mol_atoms.get(i, list()) for i in range(n_mols)])
+            for label, mol_atoms in sparse_clusters]
 
 
 # ==================================================
@@ -369,8 +1559,79 @@ def by_biggest_num_molecule(clusters):
     return reverse_clusters(by_smallest_num_molecule(clusters))
 
 
+class ClusterGraphCache:
+    """
+    Making a ClusterGraph for big clusters is slow and the SMIRKS ordering
+    functions need the same graphs over and over (for example
+    small_smirks and big_smirks sort the same clusters).
+    This stores the graphs (and their SMIRKS) with a least recently used
+    limit on how many are kept.
+
+    Graphs are stored by the identity of the molecules and the atom tuples
+    in the cluster. Each entry keeps a reference to its molecules so those
+    ids can't be reused by other molecules while the entry exists.
+
+    Parameters
+    ----------
+    max_size: maximum number of graphs to store
+    """
+    def __init__(self, max_size=2048):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _key(self, mols, cluster):
+        mol_ids = tuple([id(m) for m in mols])
+        atoms = tuple([tuple([tuple(a) for a in mol_atoms]) for mol_atoms in cluster])
+        return mol_ids, atoms
+
+    def _entry(self, mols, cluster):
+        key = self._key(mols, cluster)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        entry = {'mols': mols, 'graph': ClusterGraph(mols, cluster), 'smirks': None}
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def graph(self, mols, cluster):
+        """
+        Returns
+        -------
+        graph: ClusterGraph for this cluster of atoms in these molecules
+        """
+        return self._entry(mols, cluster)['graph']
+
+    def smirks(self, mols, cluster):
+        """
+        Returns
+        -------
+        smirks: str, SMIRKS pattern from the ClusterGraph for this cluster
+        """
+        entry = self._entry(mols, cluster)
+        if entry['smirks'] is None:
+            entry['smirks'] = entry['graph'].as_smirks()
+        return entry['smirks']
+
+
+# cluster graphs shared by all of the ordering functions
+cluster_graphs = ClusterGraphCache()
+
+
 def by_smallest_smirks(clusters, mols):
-    temp_c = sorted(clusters, key=lambda x: len(ClusterGraph(mols, x[1]).as_smirks()))
+    temp_c = sorted(clusters, key=lambda x: len(cluster_graphs.smirks(mols, x[1])))
     return temp_c
 
 
@@ -394,7 +1655,757 @@ def by_terminii(clusters, mols, sort_funct=by_biggest_size):
     return sort_funct(x) + sort_funct(n) + sort_funct(c)
 
 
-def change_order_smirksified(mols, cluster_types, order_type_names=None, smirks_verbose=False, include_params=None):
+# ==================================================
+# SMIRKSifier jobs
+# Each (order type, fragment) pair is an independent SMIRKSifier job.
+# These can either be run one at a time in this process or
+# be sent to a pool of worker processes.
+
+class SMIRKSifierResult:
+    """
+    Stand in for a SMIRKSifier object when the job was run in
+    a worker process. It only stores the two attributes we
+    actually use later (checks and current_smirks) so it is cheap
+    to send back to the main process.
+    """
+    def __init__(self, checks, current_smirks):
+        self.checks = checks
+        self.current_smirks = current_smirks
+
+
+def mols_to_bytes(mols):
+    """
+    Serializes OEMols to oeb bytes so they can be sent to worker processes
+    """
+    return [oechem.OEWriteMolToBytes('.oeb', m) for m in mols]
+
+
+def mols_from_bytes(mol_bytes):
+    """
+    Reverse of mols_to_bytes, creates a list of OEMols from oeb bytes
+    """
+    mols = list()
+    for b in mol_bytes:
+        m = oechem.OEMol()
+        oechem.OEReadMolFromBytes(m, '.oeb', b)
+        mols.append(m)
+    return mols
+
+
+# molecules for the current worker process, these are set once
+# by the pool initializer so they aren't shipped with every job
+_worker_mols = None
+
+
+def _init_worker_mols(mol_bytes, log_settings=None):
+    global _worker_mols
+    _worker_mols = mols_from_bytes(mol_bytes)
+    configure_run_log(log_settings)
+
+
+def make_smirksifier(mols, o_clusters, smirks_verbose=False):
+    """
+    Creates a SMIRKSifier with the settings used for all of our tests
+    """
+    return SMIRKSifier(mols, o_clusters,
+                       max_layers=10,
+                       strict_smirks=False,
+                       verbose=smirks_verbose)
+
+
+def check_type_list(type_list, mols, clusters, improper=False, validator=None):
+    """
+    Types the molecules with a list of SMIRKS and compares
+    the result to a list of clusters.
+
+    Parameters
+    ----------
+    type_list: list of (label, SMIRKS) like SMIRKSifier.current_smirks
+    mols: list of OEMols
+    clusters: list of (label, [[(atoms), ] for each molecule])
+    improper: True if these are improper torsions
+    validator: SMIRKSValidator for these molecules and clusters,
+               pass one in when checking several lists so matches for
+               patterns that didn't change are reused
+
+    Returns
+    -------
+    agreement: dictionary {cluster label: (fragments typed correctly, total fragments)}
+    """
+    if validator is None:
+        validator = SMIRKSValidator(mols, clusters, improper)
+    return validator.agreement(type_list)
+
+
+# label for the cluster with every fragment that passed with the stored SMIRKS
+warm_start_other = 'warm_start_other'
+
+
+def warm_start_clusters(o_clusters, failing):
+    """
+    Clusters for SMIRKSifier when only some clusters failed with the stored SMIRKS.
+    The fragments from every passing cluster are put in one extra cluster
+    at the start, so SMIRKSifier has to make patterns for the failing clusters
+    that don't match them. Without it the first new pattern is as generic
+    as [*:1]~[*:2] and overrides every kept pattern.
+
+    Parameters
+    ----------
+    o_clusters: ordered clusters for this fragment type
+    failing: the clusters in o_clusters that failed
+
+    Returns
+    -------
+    clusters: list of (label, [[(atoms), ] for each molecule])
+    """
+    failing_labels = set([l for l, _ in failing])
+    passing = [c for l, c in o_clusters if l not in failing_labels]
+    if len(passing) == 0:
+        return list(failing)
+    other = [list() for _ in passing[0]]
+    for mol_clusters in passing:
+        for mol_idx, fragments in enumerate(mol_clusters):
+            other[mol_idx].extend(fragments)
+    return [(warm_start_other, other)] + list(failing)
+
+
+def warm_start_smirksifier(mols, o_clusters, type_list, fragment, smirks_verbose=False):
+    """
+    Starts from a list of SMIRKS made in a previous run (for example on a
+    smaller training set). Patterns for clusters which are still typed
+    correctly are kept and SMIRKSifier is only used for clusters
+    that fail with the old SMIRKS (with the passing fragments as one
+    extra cluster, see warm_start_clusters, so the new patterns leave
+    them alone). The full search is only used if the kept and new patterns
+    still don't type every fragment correctly.
+
+    Parameters
+    ----------
+    mols: list of OEMols
+    o_clusters: ordered clusters for this fragment type
+    type_list: list of (label, SMIRKS) from a previous run
+    fragment: fragment type, such as 'bond' or 'improper_torsion'
+    smirks_verbose: verbosity input for SMIRKSifier
+
+    Returns
+    -------
+    smirksifier: SMIRKSifierResult if the stored SMIRKS could be reused,
+                 otherwise the SMIRKSifier from a full search
+    """
+    improper = 'improper' in fragment
+    validator = SMIRKSValidator(mols, o_clusters, improper)
+    agreement = check_type_list(type_list, mols, o_clusters, improper, validator)
+    failing = [(l, c) for l, c in o_clusters if agreement[l][0] != agreement[l][1]]
+    if len(failing) == 0:
+        return SMIRKSifierResult(True, [(l, s) for l, s in type_list])
+
+    # keep the old patterns for clusters that still pass and put the new
+    # ones at the end so they take priority for the fragments that failed
+    passing = set([l for l, _ in o_clusters]) - set([l for l, _ in failing])
+    kept = [(l, s) for l, s in type_list if _cluster_label(l) in passing]
+    partial = make_smirksifier(mols, warm_start_clusters(o_clusters, failing), smirks_verbose)
+    if partial.checks:
+        # the pattern for the passing fragments is dropped, the kept patterns type those
+        merged = kept + [(l, s) for l, s in partial.current_smirks
+                         if _cluster_label(l) != warm_start_other]
+        agreement = check_type_list(merged, mols, o_clusters, improper, validator)
+        if _passes_all(agreement):
+            return SMIRKSifierResult(True, merged)
+
+    # the old patterns didn't work together with the new ones,
+    # so start over
+    return make_smirksifier(mols, o_clusters, smirks_verbose)
+
+
+def json_forcefield(json_file, record, forcefields):
+    """
+    Returns the force field label for a json file from clusters_to_files.
+    Newer files save the label, for older files it is taken from the file name
+    ([label]_[order technique]_[FF]_[fragment]_[n]mol). None if it
+    doesn't match any of forcefields.
+    """
+    if record.get('forcefield', None) is not None:
+        return record['forcefield']
+    name = '_%s_' % os.path.splitext(os.path.basename(json_file))[0]
+    # the longest label wins so '14all' doesn't match a file for 'amber14all'
+    matches = sorted([f for f in forcefields if '_%s_' % f in name], key=len)
+    if len(matches) == 0:
+        return None
+    return matches[-1]
+
+
+def load_warm_start(json_files, forcefields):
+    """
+    Gets the SMIRKS lists from files created with clusters_to_files
+    which can be used to warm start change_order_smirksified.
+    Only SMIRKS lists that passed are used and SMIRKS are only
+    used for the force field they were made for.
+
+    Parameters
+    ----------
+    json_files: list of json files from clusters_to_files
+    forcefields: list of force field labels in this run
+
+    Returns
+    -------
+    warm_start: dictionary {force field: {order type: {fragment: type_list}}}
+    """
+    warm_start = dict()
+    for json_file in json_files:
+        with open(json_file, 'r') as inputf:
+            d = json.load(inputf)
+        forcefield = json_forcefield(json_file, d, forcefields)
+        if forcefield not in forcefields:
+            print("skipping %s, it isn't for any of the force fields %s" % (json_file, forcefields))
+            continue
+        for o_type, frag_dict in d['smirks_lists'].items():
+            for frag, result in frag_dict.items():
+                if result['checked']:
+                    warm_start.setdefault(forcefield, dict()).setdefault(o_type, dict())[frag] = \
+                        [(l, s) for l, s in result['type_list']]
+    return warm_start
+
+
+def atom_environment_hashes(mol, radius):
+    """
+    Hashes the environment of every atom out to radius bonds.
+    Each atom starts with the properties SMIRKSifier uses for
+    decorators (element, charge, hydrogens, connectivity, ring size, aromaticity)
+    then neighbor hashes are folded in once for every bond of radius.
+
+    Parameters
+    ----------
+    mol: OEMol
+    radius: number of bonds to include
+
+    Returns
+    -------
+    hashes: dictionary {atom index: int}
+    """
+    hashes = dict()
+    for a in mol.GetAtoms():
+        hashes[a.GetIdx()] = hash((a.GetAtomicNum(), a.GetFormalCharge(), a.GetTotalHCount(),
+                                   a.GetDegree(), oechem.OEAtomGetSmallestRingSize(a),
+                                   a.IsAromatic()))
+    for _ in range(radius):
+        new_hashes = dict()
+        for a in mol.GetAtoms():
+            neighbors = sorted([(b.GetOrder(), b.IsAromatic(), hashes[b.GetNbr(a).GetIdx()])
+                                for b in a.GetBonds()])
+            new_hashes[a.GetIdx()] = hash((hashes[a.GetIdx()], tuple(neighbors)))
+        hashes = new_hashes
+    return hashes
+
+
+def dedupe_clusters(mols, clusters, fragment, radius=3):
+    """
+    In a polypeptide the same fragment environment shows up many times.
+    This keeps one representative for each group of fragments that have
+    the same environment out to radius bonds. If equivalent fragments
+    are in different clusters all of them are kept since
+    those can't be told apart at this radius.
+
+    Parameters
+    ----------
+    mols: list of OEMols
+    clusters: list of (label, [[(atoms), ] for each molecule])
+    fragment: fragment type, such as 'bond' or 'improper_torsion'
+    radius: number of bonds included when comparing fragments
+
+    Returns
+    -------
+    reduced: clusters in the same format with only the representatives
+    classes: dictionary {(label, fragment key): [(mol index, atoms), ]}
+             with every fragment in each class, the first one is
+             the representative so the multiplicity is the length of the list
+    """
+    improper = 'improper' in fragment
+    mol_hashes = [atom_environment_hashes(m, radius) for m in mols]
+
+    classes = collections.OrderedDict()
+    key_labels = dict()
+    for label, mol_clusters in clusters:
+        for mol_idx, fragments in enumerate(mol_clusters):
+            for atoms in fragments:
+                key = _fragment_key([mol_hashes[mol_idx][a] for a in atoms], improper)
+                classes.setdefault((label, key), list()).append((mol_idx, tuple(atoms)))
+                key_labels.setdefault(key, set()).add(label)
+
+    reduced_atoms = {label: [list() for _ in mol_clusters] for label, mol_clusters in clusters}
+    for (label, key), members in classes.items():
+        if len(key_labels[key]) > 1:
+            keep = members
+        else:
+            keep = members[:1]
+        for mol_idx, atoms in keep:
+            reduced_atoms[label][mol_idx].append(atoms)
+
+    reduced = [(label, reduced_atoms[label]) for label, _ in clusters]
+    return reduced, classes
+
+
+def residue_positions(mol):
+    """
+    Labels each atom by where its residue is in its chain,
+    'N' for the N-terminal residue, 'C' for the C-terminal residue
+    and 'X' for everything else (like the charge labels).
+    The chain ends come from chain_termini, so in a window only
+    residues at the ends of the whole protein's chains are terminal,
+    not the residues next to a cut.
+
+    Returns
+    -------
+    positions: list with a label for each atom index
+    """
+    termini = chain_termini(mol)
+    positions = ['X'] * mol.GetMaxAtomIdx()
+    for a in mol.GetAtoms():
+        res = oechem.OEAtomGetResidue(a)
+        # caps added to protein windows (see cap_window) aren't part of the chain
+        # and aren't in any fragment, so they are left as 'X'
+        if res.GetName() in cap_residue_names or res.GetChainID() not in termini:
+            continue
+        first, last = termini[res.GetChainID()]
+        if _residue_key(res) == first:
+            positions[a.GetIdx()] = 'N'
+        elif _residue_key(res) == last:
+            positions[a.GetIdx()] = 'C'
+    return positions
+
+
+def subsample_clusters(mols, clusters, max_size, seed=0):
+    """
+    Picks at most max_size fragments from each cluster. Fragments are split
+    into groups by molecule and by whether they are in a terminal residue,
+    then fragments are taken from each group in turn so the subset
+    has as many molecules and positions as possible.
+
+    Parameters
+    ----------
+    mols: list of OEMols
+    clusters: list of (label, [[(atoms), ] for each molecule])
+    max_size: maximum number of fragments kept from each cluster
+    seed: seed for picking fragments in each group
+
+    Returns
+    -------
+    subset: clusters in the same format with only the picked fragments
+    """
+    mol_positions = [residue_positions(m) for m in mols]
+    rng = random.Random(seed)
+
+    subset = list()
+    for label, mol_clusters in clusters:
+        groups = collections.OrderedDict()
+        for mol_idx, fragments in enumerate(mol_clusters):
+            for atoms in fragments:
+                positions = set([mol_positions[mol_idx][a] for a in atoms])
+                position = 'N' if 'N' in positions else ('C' if 'C' in positions else 'X')
+                groups.setdefault((position, mol_idx), list()).append(tuple(atoms))
+
+        for group in groups.values():
+            rng.shuffle(group)
+        # smallest groups first, these are usually the terminal residues
+        # which are rare but are often what separates clusters
+        group_keys = sorted(groups.keys(), key=lambda k: len(groups[k]))
+
+        picked = [list() for _ in mol_clusters]
+        n_picked = 0
+        depth = 0
+        while n_picked < max_size and any([depth < len(groups[k]) for k in group_keys]):
+            for position, mol_idx in group_keys:
+                if n_picked >= max_size:
+                    break
+                group = groups[(position, mol_idx)]
+                if depth < len(group):
+                    picked[mol_idx].append(group[depth])
+                    n_picked += 1
+            depth += 1
+        subset.append((label, picked))
+    return subset
+
+
+def subsampled_smirksifier(mols, label, o_clusters, options, max_rounds=10):
+    """
+    SMIRKSifies a subset of each cluster (see subsample_clusters) and checks
+    the SMIRKS against every fragment. Fragments that are typed wrong are
+    added to the subset and it is SMIRKSified again until everything passes.
+    If it still fails after max_rounds, or SMIRKSifier fails on a subset,
+    every fragment is used.
+
+    Parameters
+    ----------
+    mols: list of OEMols
+    label: fragment type
+    o_clusters: ordered clusters
+    options: options for run_smirksifier_job, 'subsample' is the maximum
+             number of fragments from each cluster in the first subset
+    max_rounds: maximum number of times fragments are added back
+
+    Returns
+    -------
+    smirksifier: SMIRKSifier or SMIRKSifierResult
+    """
+    improper = 'improper' in label
+    no_subsample = dict(options, subsample=None)
+    validator = SMIRKSValidator(mols, o_clusters, improper)
+    subset = subsample_clusters(mols, o_clusters, options['subsample'])
+
+    # original atoms for each fragment key {(mol index, key): (cluster index, atoms)}
+    key_atoms = dict()
+    for c_idx, (c_label, mol_clusters) in enumerate(o_clusters):
+        for mol_idx, fragments in enumerate(mol_clusters):
+            for atoms in fragments:
+                key_atoms[(mol_idx, _fragment_key(atoms, improper))] = (c_idx, tuple(atoms))
+
+    run_log = get_run_log()
+    for round_idx in range(max_rounds):
+        smirksifier = run_smirksifier_job(mols, label, subset, no_subsample)
+        if not smirksifier.checks:
+            break
+
+        failing = validator.failing(smirksifier.current_smirks)
+        n_failing = sum([len(f) for f in failing])
+        run_log.event('subsample', fragment=label, round=round_idx,
+                      n_subset=sum([len(f) for _, c in subset for f in c]), n_failing=n_failing)
+        if n_failing == 0:
+            return SMIRKSifierResult(True, smirksifier.current_smirks)
+
+        for mol_idx, keys in enumerate(failing):
+            for key in keys:
+                c_idx, atoms = key_atoms[(mol_idx, key)]
+                subset[c_idx][1][mol_idx].append(atoms)
+
+    return run_smirksifier_job(mols, label, o_clusters, no_subsample)
+
+
+def deduped_smirksifier(mols, label, o_clusters, options, max_rounds=3):
+    """
+    SMIRKSifies one representative of each group of equivalent fragments
+    (see dedupe_clusters) and checks the SMIRKS against every fragment.
+    Failing fragments are mapped back to their class and every fragment
+    in those classes is added before SMIRKSifying again, since the
+    representative didn't stand for them. If it still fails after
+    max_rounds, or SMIRKSifier fails on the representatives,
+    every fragment is used.
+
+    Parameters
+    ----------
+    mols: list of OEMols
+    label: fragment type
+    o_clusters: ordered clusters
+    options: options for run_smirksifier_job, 'dedupe_radius' is the
+             radius used to compare fragments
+    max_rounds: maximum number of times classes are added back
+
+    Returns
+    -------
+    smirksifier: SMIRKSifier or SMIRKSifierResult
+    """
+    improper = 'improper' in label
+    no_dedupe = dict(options, dedupe_radius=None)
+    validator = SMIRKSValidator(mols, o_clusters, improper)
+    reduced, classes = dedupe_clusters(mols, o_clusters, label, options['dedupe_radius'])
+
+    # class for each original fragment {(mol index, fragment key): class key}
+    fragment_classes = dict()
+    for class_key, members in classes.items():
+        for mol_idx, atoms in members:
+            fragment_classes[(mol_idx, _fragment_key(atoms, improper))] = class_key
+    label_idx = dict([(c_label, c_idx) for c_idx, (c_label, _) in enumerate(reduced)])
+    expanded = set()
+
+    run_log = get_run_log()
+    for round_idx in range(max_rounds):
+        smirksifier = run_smirksifier_job(mols, label, reduced, no_dedupe)
+        if not smirksifier.checks:
+            break
+
+        failing = validator.failing(smirksifier.current_smirks)
+        failing_classes = set([fragment_classes[(mol_idx, key)]
+                               for mol_idx, keys in enumerate(failing) for key in keys])
+        run_log.event('dedupe', fragment=label, round=round_idx, n_classes=len(classes),
+                      n_reduced=sum([len(f) for _, c in reduced for f in c]),
+                      n_failing=sum([len(f) for f in failing]), n_failing_classes=len(failing_classes))
+        if len(failing_classes) == 0:
+            return SMIRKSifierResult(True, smirksifier.current_smirks)
+
+        new_classes = failing_classes - expanded
+        if len(new_classes) == 0:
+            # every fragment in these classes was already used
+            break
+        for class_key in new_classes:
+            c_label = class_key[0]
+            for mol_idx, atoms in classes[class_key]:
+                if atoms not in reduced[label_idx[c_label]][1][mol_idx]:
+                    reduced[label_idx[c_label]][1][mol_idx].append(atoms)
+        expanded.update(new_classes)
+
+    # the representatives weren't enough, use every fragment
+    return run_smirksifier_job(mols, label, o_clusters, no_dedupe)
+
+
+def _passes_all(agreement):
+    return all([correct == total for correct, total in agreement.values()])
+
+
+def run_smirksifier_job(mols, label, o_clusters, options):
+    """
+    Runs one (order type, fragment) SMIRKSifier job.
+
+    Parameters
+    ----------
+    mols: list of OEMols
+    label: fragment type
+    o_clusters: ordered clusters
+    options: dictionary with
+             'smirks_verbose': verbosity for SMIRKSifier
+             'warm_start': a SMIRKS list from a previous run or None
+             'dedupe_radius': if this is set, equivalent fragments are removed
+                              with dedupe_clusters before SMIRKSifying and the
+                              SMIRKS are then checked against every fragment
+             'subsample': if this is set, clusters are SMIRKSified with at most this
+                          many fragments with subsampled_smirksifier
+
+    Returns
+    -------
+    smirksifier: SMIRKSifier or SMIRKSifierResult
+    """
+    if options.get('dedupe_radius', None):
+        return deduped_smirksifier(mols, label, o_clusters, options)
+
+    if options.get('subsample', None):
+        return subsampled_smirksifier(mols, label, o_clusters, options)
+
+    if options.get('warm_start', None) is not None:
+        return warm_start_smirksifier(mols, o_clusters, options['warm_start'], label,
+                                      options['smirks_verbose'])
+    return make_smirksifier(mols, o_clusters, options['smirks_verbose'])
+
+
+def logged_smirksifier_job(mols, o_type, label, o_clusters, options):
+    """
+    Runs run_smirksifier_job and logs its time, memory, and size
+    as a 'smirksifier' event named smirksifier:[fragment]:[order type]
+    """
+    n_fragments = sum([len(f) for _, c in o_clusters for f in c])
+    with get_run_log().job('smirksifier', 'smirksifier:%s:%s' % (label, o_type),
+                           fragment=label, order=o_type, n_clusters=len(o_clusters),
+                           n_fragments=n_fragments,
+                           warm_start=options.get('warm_start', None) is not None,
+                           dedupe_radius=options.get('dedupe_radius', None)) as counts:
+        smirksifier = run_smirksifier_job(mols, label, o_clusters, options)
+        counts['checks'] = smirksifier.checks
+        counts['n_smirks'] = len(smirksifier.current_smirks)
+    return smirksifier
+
+
+def _smirksifier_job(job):
+    """
+    Runs a single SMIRKSifier job in a worker process.
+    job is a tuple (order type, fragment label, ordered clusters, options)
+    """
+    o_type, label, o_clusters, options = job
+    smirksifier = logged_smirksifier_job(_worker_mols, o_type, label, o_clusters, options)
+    return o_type, label, SMIRKSifierResult(smirksifier.checks, smirksifier.current_smirks)
+
+
+def write_checkpoint(path, data):
+    """
+    Pickles data to path. It is written to a temporary file first
+    and then moved, so a crash while writing never leaves
+    a broken checkpoint behind.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            pickle.dump(data, temp_file)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def read_checkpoint(path):
+    """
+    Returns
+    -------
+    data: whatever was saved with write_checkpoint or None if there is no checkpoint
+    """
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as checkpoint_file:
+        return pickle.load(checkpoint_file)
+
+
+# ordering functions by the names used for order types
+order_types_dict = {
+    'original': None,
+    'reversed': reverse_clusters,
+    'shuffle': shuffle,
+    'small_size': by_smallest_size,
+    'biggest_size': by_biggest_size,
+    'fewest_mols': by_smallest_num_molecule,
+    'most_mols': by_biggest_num_molecule,
+    'small_smirks': by_smallest_smirks,
+    'big_smirks': by_biggest_smirks}
+
+
+def numbered_orderings(order_type_names):
+    """
+    Orderings listed more than once (like 'shuffle' in the shuffle tests)
+    are run once for every time they are listed, the copies are named
+    shuffle, shuffle_1, shuffle_2, ...
+
+    Parameters
+    ----------
+    order_type_names: list of names from order_types_dict
+
+    Returns
+    -------
+    orderings: list of (order type, name in order_types_dict)
+    """
+    orderings = list()
+    for n in sorted(set(order_type_names), key=order_type_names.index):
+        orderings.append((n, n))
+        for i in range(1, order_type_names.count(n)):
+            orderings.append(('%s_%i' % (n, i), n))
+    return orderings
+
+
+def order_clusters(clusters, mols, label, o_type, o_funct):
+    """
+    Orders the clusters for one fragment type with the given ordering function.
+    Charge clusters are always sorted with the termini clusters at the end.
+    """
+    if 'charge' in label.lower():
+        return by_terminii(clusters, mols, o_funct)
+    if o_funct is None:
+        return clusters
+    if 'smirks' in o_type:
+        return o_funct(clusters, mols)
+    return o_funct(clusters)
+
+
+def smirks_list_score(type_list):
+    """
+    Used to pick between passing SMIRKS lists, fewer patterns are better
+    and then shorter (more general) patterns are better.
+    """
+    return len(type_list), sum([len(s) for l, s in type_list])
+
+
+def best_passing_order(smirks_order_types, label):
+    """
+    Returns
+    -------
+    o_type: the order type with the best passing SMIRKS list for this
+            fragment type (see smirks_list_score) or None if none passed
+    """
+    passing = [(smirks_list_score(d[label].current_smirks), o_type)
+               for o_type, d in smirks_order_types.items() if label in d and d[label].checks]
+    if len(passing) == 0:
+        return None
+    return min(passing)[1]
+
+
+def _race_job(job):
+    """
+    Runs a SMIRKSifier job for race_smirksifier_jobs in a worker process.
+    job is a tuple (cancelled, SMIRKSifier job) where cancelled is a shared
+    dictionary with the fragment labels that already have enough passing orderings,
+    jobs for those fragments are skipped and None is returned as the result.
+    """
+    cancelled, (o_type, label, o_clusters, options) = job
+    if label in cancelled:
+        return o_type, label, None
+    return _smirksifier_job((o_type, label, o_clusters, options))
+
+
+def race_smirksifier_jobs(mols, jobs, add_result, n_passing=1, n_workers=1, already_passed=None):
+    """
+    Runs the SMIRKSifier jobs for each fragment type with every
+    ordering at the same time. Once n_passing orderings have passed
+    for a fragment the rest of its jobs are skipped (jobs that are
+    already running finish, but their results are ignored).
+    Every fragment and ordering is run in one pool so the fragments overlap.
+
+    Parameters
+    ----------
+    mols: list of OEMols
+    jobs: list of (order type, fragment label, ordered clusters, options)
+    add_result: function called with (order type, fragment label, result) for each finished job
+    n_passing: number of passing orderings to wait for, more than 1
+               gives a choice of SMIRKS lists (see best_passing_order)
+    n_workers: number of processes, if this is 1 the orderings are tried one at a time
+    already_passed: {fragment label: number of passing orderings from a previous run}
+
+    Returns
+    -------
+    n_cancelled: {fragment label: number of jobs that were skipped or ignored}
+    """
+    if already_passed is None:
+        already_passed = dict()
+
+    label_jobs = collections.OrderedDict()
+    for job in jobs:
+        label_jobs.setdefault(job[1], list()).append(job)
+    needed = dict([(label, n_passing - already_passed.get(label, 0)) for label in label_jobs])
+    n_done = dict([(label, 0) for label in label_jobs])
+
+    def finished(o_type, label, result):
+        add_result(o_type, label, result)
+        n_done[label] += 1
+        needed[label] -= int(bool(result.checks))
+
+    if n_workers is None or n_workers <= 1:
+        for label, l_jobs in label_jobs.items():
+            for o_type, label, o_clusters, options in l_jobs:
+                if needed[label] <= 0:
+                    break
+                finished(o_type, label, logged_smirksifier_job(mols, o_type, label, o_clusters, options))
+    else:
+        manager = multiprocessing.Manager()
+        # {fragment label: True} for fragments with enough passing orderings
+        cancelled = manager.dict()
+        for label in label_jobs:
+            if needed[label] <= 0:
+                cancelled[label] = True
+        to_run = [(cancelled, job) for job in jobs if needed[job[1]] > 0]
+
+        pool = multiprocessing.Pool(processes=n_workers,
+                                    initializer=_init_worker_mols,
+                                    initargs=(mols_to_bytes(mols), get_run_log().settings))
+        try:
+            for o_type, label, result in pool.imap_unordered(_race_job, to_run):
+                if result is None or needed[label] <= 0:
+                    # skipped, or finished after this fragment already had enough
+                    continue
+                finished(o_type, label, result)
+                if needed[label] <= 0:
+                    cancelled[label] = True
+                    if all([n <= 0 for n in needed.values()]):
+                        # only ignored jobs are left
+                        break
+        finally:
+            pool.terminate()
+            pool.join()
+            manager.shutdown()
+
+    run_log = get_run_log()
+    n_cancelled = dict()
+    for label, l_jobs in label_jobs.items():
+        n_cancelled[label] = len(l_jobs) - n_done[label]
+        run_log.event('race', fragment=label, n_orderings=len(l_jobs), n_finished=n_done[label],
+                      n_cancelled=n_cancelled[label], passed=needed[label] <= 0)
+    return n_cancelled
+
+
+def change_order_smirksified(mols, cluster_types, order_type_names=None, smirks_verbose=False, include_params=None,
+                             n_workers=1, warm_start=None, dedupe_radius=None, checkpoint=None, race=None,
+                             subsample=None):
     """
     Creates SMIRKSifier objects for all specified order types.
 
@@ -407,6 +2418,24 @@ def change_order_smirksified(mols, cluster_types, order_type_names=None, smirks_
     smirks_verbose: verbosity input for SMIRKSifier
     include_params: which fragment types (bond, angle, etc) to include
                     if None, all fragments in cluster_types will be used
+    n_workers: number of processes to use for SMIRKSifier jobs.
+               If n_workers is greater than 1 the jobs are run in a process pool,
+               the molecules are only sent to each worker once and
+               SMIRKSifierResult objects are returned instead of SMIRKSifiers
+    warm_start: dictionary {order type: {fragment: type_list}} with SMIRKS
+                from a previous run (see load_warm_start), jobs with stored SMIRKS
+                only search for clusters the stored SMIRKS don't type correctly
+    dedupe_radius: if set, fragments with the same environment out to this many
+                   bonds are collapsed to one representative before SMIRKSifying
+                   (see dedupe_clusters), the result is still checked against every fragment
+    checkpoint: path to a checkpoint file, every finished job is saved there as soon as
+                it is done and jobs already in the checkpoint are not run again
+    race: if set, the orderings for each fragment type are run at the same time
+          and the rest are stopped once this many have passed
+          (see race_smirksifier_jobs and best_passing_order)
+    subsample: if set, SMIRKSifier starts with at most this many fragments from each cluster,
+               fragments that the SMIRKS type incorrectly are added back until
+               every fragment passes (see subsampled_smirksifier)
 
     Returns
     -------
@@ -418,34 +2447,32 @@ def change_order_smirksified(mols, cluster_types, order_type_names=None, smirks_
                             Note - these included FAILED SMIRKSifier
                             objects so it is important to check if the
                             SMIRKSifier was successful.
+                            When racing, fragments are left out for orderings
+                            that were stopped.
     """
     smirs_order_types = dict()
 
-    order_types_dict = {
-        'original': None,
-        'reversed': reverse_clusters,
-        'shuffle': shuffle,
-        'small_size': by_smallest_size,
-        'biggest_size': by_biggest_size,
-        'fewest_mols': by_smallest_num_molecule,
-        'most_mols': by_biggest_num_molecule,
-        'small_smirks': by_smallest_smirks,
-        'big_smirks': by_biggest_smirks}
-
     if order_type_names is None:
         order_type_names = ['shuffle']
 
-    order_types = list()
-    for n in set(order_type_names):
-        o_funct = order_types_dict.get(n, None)
-        order_types.append((n, o_funct))
-        for i in range(1, order_type_names.count(n)):
-            temp_n = '%s_%i' % (n, i)
-            order_types.append((temp_n, o_funct))
+    order_types = [(o_type, order_types_dict.get(n, None)) for o_type, n in numbered_orderings(order_type_names)]
 
     if include_params is None:
         include_params = list(cluster_types.keys())
 
+    finished = None
+    if checkpoint is not None:
+        finished = read_checkpoint(checkpoint)
+    if finished is None:
+        finished = dict()
+
+    def add_result(o_type, label, result):
+        smirs_order_types[o_type][label] = result
+        if checkpoint is not None:
+            finished[(o_type, label)] = (result.checks, result.current_smirks)
+            write_checkpoint(checkpoint, finished)
+
+    jobs = list()
     for o_type, o_funct in order_types:
         print(o_type)
         smirs_order_types[o_type] = dict()
@@ -455,20 +2482,52 @@ def change_order_smirksified(mols, cluster_types, order_type_names=None, smirks_
                 continue
 
             print(label)
-            if 'charge' in label.lower():
-                o_clusters = by_terminii(clusters, mols, o_funct)
-            elif o_funct is None:
-                o_clusters = clusters
-            else:
-                if 'smirks' in o_type:
-                    o_clusters = o_funct(clusters, mols)
-                else:
-                    o_clusters = o_funct(clusters)
+            if (o_type, label) in finished:
+                # this job was already done before a restart
+                checks, current_smirks = finished[(o_type, label)]
+                smirs_order_types[o_type][label] = SMIRKSifierResult(checks, current_smirks)
+                continue
+
+            o_clusters = order_clusters(clusters, mols, label, o_type, o_funct)
+            options = {
+                'smirks_verbose': smirks_verbose,
+                'warm_start': warm_start.get(o_type, dict()).get(label, None) if warm_start else None,
+                'dedupe_radius': dedupe_radius,
+                'subsample': subsample,
+            }
+            jobs.append((o_type, label, o_clusters, options))
+
+    run_log = get_run_log()
+    run_log.event('change_order_smirksified', n_jobs=len(jobs), n_finished=len(finished),
+                  n_workers=n_workers, n_mols=len(mols))
+
+    if race:
+        already_passed = dict()
+        for (o_type, label), (checks, _) in finished.items():
+            if checks and o_type in smirs_order_types:
+                already_passed[label] = already_passed.get(label, 0) + 1
+        race_smirksifier_jobs(mols, jobs, add_result, race, n_workers, already_passed)
 
-            smirs_order_types[o_type][label] = SMIRKSifier(mols, o_clusters,
-                                                           max_layers=10,
-                                                           strict_smirks=False,
-                                                           verbose=smirks_verbose)
+    elif n_workers is None or n_workers <= 1 or len(jobs) < 2:
+        for o_type, label, o_clusters, options in jobs:
+            add_result(o_type, label, logged_smirksifier_job(mols, o_type, label, o_clusters, options))
+
+    else:
+        # send jobs to a process pool, the order they finish doesn't matter
+        # since the results are put back in the dictionary by their keys
+        pool = multiprocessing.Pool(processes=min(n_workers, len(jobs)),
+                                    initializer=_init_worker_mols,
+                                    initargs=(mols_to_bytes(mols), run_log.settings))
+        try:
+            for o_type, label, result in pool.imap_unordered(_smirksifier_job, jobs):
+                add_result(o_type, label, result)
+        finally:
+            pool.close()
+            pool.join()
+
+    # put the fragments back in the order they are in cluster_types
+    for o_type, label_dict in smirs_order_types.items():
+        smirs_order_types[o_type] = {l: label_dict[l] for l in cluster_types if l in label_dict}
 
     return smirs_order_types
 
@@ -516,11 +2575,66 @@ def at_least_one_passed(smirks_order_types):
     return passed
 
 
+def build_parameter_system(list_fastas, protein_xml='amber99sbildn.xml', cache_dir=None, n_workers=1,
+                           structures=None, window=5, window_context=2):
+    """
+    Parameterizes every fasta file once and stores the results
+    in a single ParameterSystem. Everything downstream (ordering
+    and SMIRKSifying) only needs the molecules and clusters from this
+    object so there is no reason to redo this step for every job.
+
+    Parameters
+    ----------
+    list_fastas: list of str
+                 list of full paths to .fasta files with peptide sequences,
+                 files with multiple sequences and directories of fasta files
+                 can also be used
+    protein_xml: str or list of str
+                 file name or complete path to a openMM .xml file for assign protein parameters,
+                 with a list every molecule is prepared once and parameterized with each force field
+    cache_dir: str
+               optional directory for cached parameterized molecules
+    n_workers: int
+               number of processes used to parameterize molecules
+    structures: list of str
+                optional PDB or mmCIF files or directories of them, each protein
+                is cut into windows (see ParameterSystem.add_windows_from_structures)
+    window: int
+            number of residues in the core of each window
+    window_context: int
+                    number of residues added on each side of the window core
+
+    Returns
+    -------
+    store_data: ParameterSystem object with all fasta files and structure windows added
+    """
+    store_data = ParameterSystem(openmm_xml=protein_xml, cache_dir=cache_dir)
+    store_data.add_systems_from_fastas(list_fastas, n_workers=n_workers)
+    if structures:
+        store_data.add_windows_from_structures(structures, window, window_context, n_workers=n_workers)
+    return store_data
+
+
+def print_cluster_table(mols, cluster_types):
+    """
+    prints a small table with the number of clusters for each fragment type
+    """
+    table_form = "%-20s %-10s %-10s %s"
+    print('=' * 80)
+    print(table_form % ('parameter', 'mols', 'clusters', 'mols in clusters'))
+    print('-' * 80)
+    for label, clusters in cluster_types.items():
+        print(table_form % (label, len(mols), len(clusters), len(clusters[0][1])))
+    print('=' * 80)
+
+
 def everything_from_fastas(list_fastas,
-                           protein_xlm='amber99sbildn.xml',
+                           protein_xml='amber99sbildn.xml',
                            order_type_names=None,
                            verbose=True,
-                           include_params=None):
+                           include_params=None,
+                           store_data=None,
+                           n_workers=1):
     """
     Parameters
     ----------
@@ -530,6 +2644,11 @@ def everything_from_fastas(list_fastas,
     protein_xml: str
                  file name or complete path to a openMM .xml file for assign protein parameters
     order_type_names: list of str
+    store_data: ParameterSystem
+                if provided this already parameterized system is used
+                and list_fastas and protein_xml are ignored.
+    n_workers: int
+               number of processes used for SMIRKSifier jobs
 
     Returns
     -------
@@ -546,37 +2665,31 @@ def everything_from_fastas(list_fastas,
     if order_type_names is None:
         order_type_names = ['shuffle']
 
-    store_data = ParameterSystem(openmm_xml=protein_xml)
-    for fasta in list_fastas:
-        parm, oemol = store_data.add_system_from_fasta(fasta)
+    if store_data is None:
+        store_data = build_parameter_system(list_fastas, protein_xml)
     mols, cluster_types = store_data.convert_for_smirksifying()
 
     if verbose:
-        table_form = "%-20s %-10s %-10s %s"
-        print('=' * 80)
-        print(table_form % ('parameter', 'mols', 'clusters', 'mols in clusters'))
-        print('-' * 80)
-        for label, clusters in cluster_types.items():
-            print(table_form % (label, len(mols), len(clusters), len(clusters[0][1])))
-        print('=' * 80)
+        print_cluster_table(mols, cluster_types)
 
     smirs_order_types = change_order_smirksified(mols, cluster_types,
                                                  order_type_names=order_type_names,
-                                                 include_params=include_params)
+                                                 include_params=include_params,
+                                                 n_workers=n_workers)
     if verbose: print_order_type_data(smirs_order_types)
 
     return store_data, smirs_order_types, mols, cluster_types
 
 
-def clusters_to_files(mols, clusters, smirs_order_types, json_file_name, mol_dir='./mol_files/'):
+def clusters_to_files(mols, clusters, smirs_order_types, json_file_name, mol_dir='./mol_files/', store=None,
+                      forcefield=None, merge=False):
     """
     This converts the output from change_order_smirksified and
     saves the created SMIRKS patterns and molecules to output files.
 
-    Specifically the molecules are stored into oeb files which
-    are saved into the speficied directory. The clusters and
-    created SMIRKS patterns are saved into a json file so they can be
-    extracted and reused
+    The molecules and clusters are the same for every job in a run,
+    so they are saved once in a store (see run_store.py) and the json file
+    only has the created SMIRKS patterns and the name of that store.
 
     Parameters
     ----------
@@ -584,71 +2697,59 @@ def clusters_to_files(mols, clusters, smirs_order_types, json_file_name, mol_dir
     clusters: cluster dictionary in the form {fragment: cluster list}
     smirs_order_types: SMIRKSifier dictionary from change_order_smirksified
     json_file_name: str, name of json file to save data
-    mol_dir: directory to save output files
+    mol_dir: directory to save the store if one isn't provided
+    store: str, prefix of a store already made with write_run_store for
+           these molecules and clusters. If None a new store is saved in mol_dir
+           named after the json file.
+    forcefield: str, label of the force field for these clusters, it is saved
+                in the json file so warm starts only use SMIRKS from the same force field
+    merge: if True the SMIRKS lists are added to the ones already in json_file_name
+           (for jobs from a queue that share one json file)
     """
-    directory = os.path.abspath(mol_dir)
-
-    mfile_names = list()
-    for midx, mol in enumerate(mols):
-        file_name = mol.GetTitle() + '.oeb'
-        mfile_names.append(file_name)
-
-        for param, par_clusters in clusters.items():
-            for label, cluster in par_clusters:
-                key = param + '_' + label
-                if len(cluster[midx]) == 0:
-                    entry = 'None'
-                else:
-                    entry = tuple(['-'.join([str(i) for i in a]) for a in cluster[midx]])
-                mol.SetData(key, entry)
-
-        ofs_name = os.path.join(directory, file_name)
-        ofs = oechem.oemolostream(ofs_name)
-        oechem.OEWriteMolecule(ofs, mol)
-        ofs.close()
-
-    order_data = dict()
-    for types, smirksifier_dict in smirs_order_types.items():
-        order_data[types] = dict()
-        for param_type, smirksifier in smirksifier_dict.items():
-            order_data[types][param_type] = {
-                'checked': smirksifier.checks,
-                'type_list': smirksifier.current_smirks
-            }
-
-    to_j = {
-        'mol_files': mfile_names,
-        'smiles': [mol_to_idx_smi(m) for m in mols],
-        'clusters': clusters,
-        'smirks_lists': order_data
-    }
+    with get_run_log().job('clusters_to_files', json_file=os.path.basename(json_file_name),
+                           n_mols=len(mols), wrote_store=store is None):
+        if store is None:
+            name = os.path.splitext(os.path.basename(json_file_name))[0]
+            store = os.path.join(os.path.abspath(mol_dir), name)
+            write_run_store(store, mols, clusters, [mol_to_idx_smi(m) for m in mols])
+
+        order_data = dict()
+        for types, smirksifier_dict in smirs_order_types.items():
+            order_data[types] = dict()
+            for param_type, smirksifier in smirksifier_dict.items():
+                order_data[types][param_type] = {
+                    'checked': smirksifier.checks,
+                    'type_list': smirksifier.current_smirks
+                }
 
-    with open(json_file_name, 'w') as output:
-        json.dump(to_j, output)
+        write_record(json_file_name, store, order_data, forcefield, merge)
 
 
 def mol_to_idx_smi(m):
     """
     make a molecule with atom map indices with the atoms
-    current indices
+    current indices.
+    This works on a copy so the map indices don't leak into
+    the molecules which are reused for other SMIRKSifier jobs.
     """
+    m = oechem.OEMol(m)
     for a in m.GetAtoms():
         a.SetMapIdx(a.GetIdx() + 1)
     return oechem.OEMolToSmiles(m)
 
 
 if __name__ == '__main__':
-    import glob
-    import itertools
-    import json
     from optparse import OptionParser
 
     parser = OptionParser()
 
     parser.add_option('-f', '--fastas',
                       action='store', type='string', dest='fastas',
-                      default='everything.fasta',
-                      help="This is a search for fasta files in the provided directory")
+                      default=None,
+                      help="""This is a search for fasta files in the provided directory,
+                      files can have more than one sequence and matching directories
+                      are searched for .fasta files. Defaults to everything.fasta
+                      unless --structures is used""")
 
     parser.add_option('-d', '--directory',
                       action='store', type='string', dest='directory',
@@ -659,52 +2760,221 @@ if __name__ == '__main__':
     parser.add_option('-x', '--xmls',
                       action='store', type='string', dest='xmls',
                       default='99sbildn',
-                      help="Which force fields to test, current options are 14all or 99sbildn or all")
+                      help="""Which force fields to test, current options are 14all or 99sbildn or all,
+                      a comma separated list of these or OpenMM xml files can also be used""")
+
+    parser.add_option('--structures',
+                      action='store', type='string', dest='structures',
+                      default=None,
+                      help="""search for PDB or mmCIF files in the provided directory,
+                      each protein is parameterized once and cut into windows of residues.
+                      When this is used fasta files are only added if -f is given""")
+
+    parser.add_option('--window',
+                      action='store', type='int', dest='window',
+                      default=5,
+                      help="number of residues in the core of each window cut from a structure")
+
+    parser.add_option('--window_context',
+                      action='store', type='int', dest='window_context',
+                      default=2,
+                      help="""number of residues added on each side of a window core,
+                      this needs to cover the largest fragment environment""")
 
     parser.add_option('-n', '--sim_name',
                       action='store', type='string', dest='sim_name',
                       default='',
                       help="a custom label for this run")
 
+    parser.add_option('-w', '--n_workers',
+                      action='store', type='int', dest='n_workers',
+                      default=1,
+                      help="number of processes used to parameterize molecules and run SMIRKSifier jobs")
+
+    parser.add_option('-c', '--cache_dir',
+                      action='store', type='string', dest='cache_dir',
+                      default=None,
+                      help="directory to cache parameterized molecules so they can be reused in later runs")
+
+    parser.add_option('-s', '--warm_start',
+                      action='store', type='string', dest='warm_start',
+                      default=None,
+                      help="""search for json files from a previous run in the provided directory,
+                      their SMIRKS are used as a starting point for this run. Each force field
+                      only uses the files made for it""")
+
+    parser.add_option('-r', '--dedupe_radius',
+                      action='store', type='int', dest='dedupe_radius',
+                      default=None,
+                      help="""collapse fragments with the same environment out to this many bonds
+                      before SMIRKSifying, by default every fragment is used""")
+
+    parser.add_option('--resume',
+                      action='store_true', dest='resume',
+                      default=False,
+                      help="""skip SMIRKSifier jobs that were finished in a previous run
+                      which was stopped before it was done""")
+
+    parser.add_option('--subsample',
+                      action='store', type='int', dest='subsample',
+                      default=None,
+                      help="""SMIRKSify at most this many fragments from each cluster
+                      (picked across molecules and terminal/middle residues), fragments
+                      that fail are added back until every fragment passes""")
+
+    parser.add_option('--race',
+                      action='store', type='int', dest='race',
+                      default=None,
+                      help="""run the orderings for each fragment at the same time and stop
+                      once this many have passed, by default every ordering is finished""")
+
+    parser.add_option('-l', '--log',
+                      action='store', type='string', dest='log',
+                      default=None,
+                      help="""json lines file for timing and memory use of every step,
+                      by default nothing is logged""")
+
+    parser.add_option('--queue',
+                      action='store', type='string', dest='queue',
+                      default=None,
+                      help="""SQLite file for a job queue, instead of running the SMIRKSifier jobs
+                      here every SMIRKSify and Reduce job is added to the queue
+                      to be run with queue_worker.py""")
+
+    parser.add_option('--profile',
+                      action='store', type='string', dest='profile',
+                      default=None,
+                      help="""comma separated patterns for jobs to profile with cProfile,
+                      such as 'smirksifier:bond:*' or 'parameterize:*'""")
+
     (opt,args) = parser.parse_args()
 
-    # Find which protein forcefields we are considering
-    xml_dict = {'99sbildn':'amber99sbildn.xml', '14all':'amber14-all.xml'}
-    if opt.xmls not in xml_dict.keys() and opt.xmls.lower() != 'all':
-        parser.print_help()
-        parser.error("xml must be in [99sbildn, 14all, all]")
+    if opt.log is not None or opt.profile is not None:
+        profile = None if opt.profile is None else opt.profile.split(',')
+        set_run_log(RunLog(opt.log, profile))
 
-    if opt.xmls.lower() == 'both':
-        xml_keys = xml_dict.keys()
+    # Find which protein forcefields we are considering,
+    # a comma separated list of keys or OpenMM xml files can be used too
+    xml_dict = {'99sbildn':'amber99sbildn.xml', '14all':'amber14-all.xml'}
+    if opt.xmls.lower() in ['all', 'both']:
+        xml_keys = list(xml_dict.keys())
     else:
-        xml_keys = [opt.xmls]
-
-    xmls = [(k, xml_dict[k]) for k in xml_keys]
+        xml_keys = [x for x in opt.xmls.split(',') if x]
+    for k in xml_keys:
+        if k not in xml_dict and not k.endswith('.xml'):
+            parser.print_help()
+            parser.error("xml must be in [99sbildn, 14all, all] or an OpenMM xml file")
+
+    xmls = [(k, xml_dict[k]) if k in xml_dict else (os.path.splitext(os.path.basename(k))[0], k)
+            for k in xml_keys]
     simulation_name = opt.sim_name
 
     directory = os.path.abspath(opt.directory)
-    fastas = glob.glob(os.path.join(directory, opt.fastas))
-    fastas = [f for f in fastas if '.fasta' in f]
+    fastas = list()
+    if opt.fastas is None and opt.structures is None:
+        opt.fastas = 'everything.fasta'
+    if opt.fastas is not None:
+        fastas = glob.glob(os.path.join(directory, opt.fastas))
+        fastas = sorted([f for f in fastas if '.fasta' in f or os.path.isdir(f)])
+    structures = None
+    if opt.structures is not None:
+        structures = sorted(glob.glob(os.path.join(directory, opt.structures)))
 
     all_params = ['charge', 'angle', 'improper_torsion', 'proper_torsion', 'lj', 'bond']
     names_sets = [('big', ['biggest_size', 'most_mols', 'big_smirks'] ),
             ( 'small', ['small_size', 'fewest_mols', 'small_smirks'] ),
             ('shuffle', ['original', 'shuffle', 'shuffle'])]
 
-    for name_lab, names in names_sets:
-        print(name_lab)
+    # Every molecule is prepared once and parameterized with every force field,
+    # the molecules and clusters are the same for every ordering and fragment job
+    store_data = build_parameter_system(fastas, [x for _, x in xmls], cache_dir=opt.cache_dir,
+                                        n_workers=opt.n_workers, structures=structures,
+                                        window=opt.window, window_context=opt.window_context)
+
+    # SMIRKSifier jobs for every force field are run together,
+    # clusters are labeled [xml label]/[fragment]
+    all_clusters = dict()
+    include_params = list()
+    stores = dict()
+    mols = None
+    for xml_label, protein_xml in xmls:
+        print(xml_label)
+        mols, clusters = store_data.convert_for_smirksifying(openmm_xml=protein_xml)
+        print_cluster_table(mols, clusters)
+        for param in all_params:
+            all_clusters['%s/%s' % (xml_label, param)] = clusters[param]
+            include_params.append('%s/%s' % (xml_label, param))
+
+        # molecules and clusters are stored once and shared by every json file,
+        # the molecule file is also shared by every force field
+        stores[xml_label] = '%s/%s_%s_%imols' % (directory, simulation_name, xml_label, len(mols))
+        mols_file = None
+        if xml_label != xmls[0][0]:
+            mols_file = mols_path(stores[xmls[0][0]])
+        write_run_store(stores[xml_label], mols, clusters, [mol_to_idx_smi(m) for m in mols], mols_file)
+
+    warm_start = None
+    stored_smirks = None
+    if opt.warm_start is not None:
+        stored_smirks = load_warm_start(glob.glob(os.path.join(directory, opt.warm_start)), [x for x, _ in xmls])
+        # each force field only starts from its own SMIRKS
+        warm_start = dict()
+        for x, order_dict in stored_smirks.items():
+            for o, d in order_dict.items():
+                for f, t in d.items():
+                    warm_start.setdefault(o, dict())['%s/%s' % (x, f)] = t
+
+    if opt.queue is not None:
+        # jobs are run later by queue_worker.py, most expensive first
+        job_queue = JobQueue(opt.queue)
+        options = {'dedupe_radius': opt.dedupe_radius, 'subsample': opt.subsample}
+        # the same orderings (and json files) as the loop below
+        orderings = [(o_type, n, name_lab) for name_lab, names in names_sets
+                     for o_type, n in numbered_orderings(names)]
         for xml_label, protein_xml in xmls:
-            print(xml_label)
-            for param in all_params:
-                print(param)
-                _, smirks_order_types, mols, clusters = everything_from_fastas(fastas, verbose=False,
-                                                                               order_type_names=names,
-                                                                               protein_xml=protein_xml,
-                                                                               include_params=[param])
-                if at_least_one_passed(smirks_order_types):
-                    print('Something PASSED --  ', param)
-                else:
-                    print('ALL FAILED --  ', param)
-                json_file = '%s/%s_%s_%s_%s_%imols.json' % (directory, simulation_name, name_lab, xml_label, param, len(fastas))
-                clusters_to_files(mols, clusters, smirks_order_types, json_file)
-
+            clusters = dict([(param, all_clusters['%s/%s' % (xml_label, param)]) for param in all_params])
+            stored = None
+            if stored_smirks is not None:
+                stored = stored_smirks.get(xml_label, dict())
+            json_format = '%s/%s_%%(name)s_%s_%%(fragment)s_%imols.json' % (directory, simulation_name,
+                                                                             xml_label, len(mols))
+            add_pipeline_jobs(job_queue, xml_label, stores[xml_label], mols, clusters, orderings,
+                              json_format, options, stored)
+        print('jobs in %s:' % opt.queue, job_queue.counts())
+        job_queue.close()
+    else:
+        xml_names = '_'.join([x for x, _ in xmls])
+        for name_lab, names in names_sets:
+            print(name_lab)
+            # finished jobs are saved here so a stopped run can be resumed
+            checkpoint = '%s/%s_%s_%s_checkpoint.p' % (directory, simulation_name, name_lab, xml_names)
+            if not opt.resume and os.path.isfile(checkpoint):
+                os.remove(checkpoint)
+
+            # all force fields and fragment types are sent together so the process pool
+            # has every (order, fragment) job available at once
+            all_order_types = change_order_smirksified(mols, all_clusters,
+                                                       order_type_names=names,
+                                                       include_params=include_params,
+                                                       n_workers=opt.n_workers,
+                                                       warm_start=warm_start,
+                                                       dedupe_radius=opt.dedupe_radius,
+                                                       checkpoint=checkpoint,
+                                                       race=opt.race,
+                                                       subsample=opt.subsample)
+            for xml_label, protein_xml in xmls:
+                for param in all_params:
+                    key = '%s/%s' % (xml_label, param)
+                    print(xml_label, param)
+                    # orderings stopped while racing don't have results
+                    smirks_order_types = {o: {param: d[key]} for o, d in all_order_types.items() if key in d}
+                    if opt.race:
+                        print('best ordering', best_passing_order(smirks_order_types, param))
+                    if at_least_one_passed(smirks_order_types):
+                        print('Something PASSED --  ', param)
+                    else:
+                        print('ALL FAILED --  ', param)
+                    json_file = '%s/%s_%s_%s_%s_%imols.json' % (directory, simulation_name, name_lab, xml_label, param, len(mols))
+                    clusters = {param: all_clusters[key]}
+                    clusters_to_files(mols, clusters, smirks_order_types, json_file, store=stores[xml_label],
+                                      forcefield=xml_label)
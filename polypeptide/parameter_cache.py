@@ -0,0 +1,200 @@
+"""
+parameter_cache.py
+
+Turning a fasta file into a parameterized OEMol is by far the slowest
+part of setting up these tests (see making_proteins.py for all of the steps).
+The input fasta files basically never change, so this module stores
+the results on disk so they only have to be made once.
+
+Each entry is a single .npz file which holds
+* the perceived OEMol as oeb bytes
+* the parameter arrays from making_proteins.parameter_arrays
+
+The file name is a hash of everything that goes into making an entry:
+the amino acid sequence, the OpenMM XML name and its contents (along with
+every file it includes), the OpenMM version, and the aromaticity model.
+If any force field file changes the hash changes too, so old entries
+are never used again.
+"""
+
+import os
+import hashlib
+import tempfile
+import xml.etree.ElementTree as etree
+import numpy as np
+from openeye import oechem
+from simtk.openmm import app, Platform
+
+# bump this if the format of the stored arrays changes
+CACHE_VERSION = 2
+
+# name of the key used to store the OEMol in each .npz file
+_oemol_key = 'oemol_oeb'
+
+# forcefield file hashes {(path, modification time, size): (hash, included files)}
+_xml_hashes = dict()
+
+
+def find_forcefield_xml(openmm_xml):
+    """
+    Finds the file OpenMM will use for this force field name.
+    ForceField looks in the current directory first and then in
+    the data directory shipped with OpenMM.
+
+    Returns
+    -------
+    path: str or None if the file couldn't be found
+    """
+    if os.path.isfile(openmm_xml):
+        return os.path.abspath(openmm_xml)
+    data_path = os.path.join(os.path.dirname(app.__file__), 'data', openmm_xml)
+    if os.path.isfile(data_path):
+        return data_path
+    return None
+
+
+def _file_hash(path):
+    """
+    Hash of the contents of one file and the list of files it includes,
+    these are only found again if the file changes
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_mtime, stat.st_size)
+    if key not in _xml_hashes:
+        with open(path, 'rb') as xml_file:
+            contents = xml_file.read()
+        _xml_hashes[key] = (hashlib.sha256(contents).hexdigest(), included_xmls(path, contents))
+    return _xml_hashes[key]
+
+
+def included_xmls(path, contents=None):
+    """
+    Finds the files in <Include file="..."/> tags of a force field XML file.
+    Like ForceField, includes are looked for next to the including
+    file first and then like any other force field name.
+
+    Returns
+    -------
+    includes: list of paths, or the name from the tag if it couldn't be found
+    """
+    try:
+        if contents is None:
+            root = etree.parse(path).getroot()
+        else:
+            root = etree.fromstring(contents)
+    except etree.ParseError:
+        return list()
+
+    includes = list()
+    for include in root.findall('Include'):
+        name = include.attrib['file']
+        local = os.path.join(os.path.dirname(path), name)
+        if os.path.isfile(local):
+            includes.append(os.path.abspath(local))
+        else:
+            includes.append(find_forcefield_xml(name) or name)
+    return includes
+
+
+def forcefield_hash(openmm_xml):
+    """
+    Hash of the contents of an OpenMM force field XML file and every file
+    it includes (wrappers such as amber14-all.xml only include other files).
+    If a file can't be found only its name is hashed.
+    """
+    h = hashlib.sha256()
+    seen = set()
+    to_hash = [find_forcefield_xml(openmm_xml) or openmm_xml]
+    while len(to_hash) > 0:
+        path = to_hash.pop(0)
+        if path in seen:
+            continue
+        seen.add(path)
+        if not os.path.isfile(path):
+            h.update(path.encode())
+            h.update(b'\0')
+            continue
+        file_hash, includes = _file_hash(path)
+        h.update(os.path.basename(path).encode())
+        h.update(file_hash.encode())
+        to_hash.extend(includes)
+    return h.hexdigest()
+
+
+class ParameterCache:
+    """
+    Content addressed cache of prepared molecules and parameter arrays.
+
+    Parameters
+    ----------
+    cache_dir: str
+               directory where the cache entries are stored,
+               it is created if it doesn't exist
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(cache_dir)
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def key(self, sequence, openmm_xml, aromaticity_model):
+        """
+        Parameters
+        ----------
+        sequence: str, amino acid sequence
+        openmm_xml: str, OpenMM force field file
+        aromaticity_model: str, name of the aromaticity model used
+                           (the OpenMM version is always included too)
+
+        Returns
+        -------
+        key: str, hex hash for this combination
+        """
+        h = hashlib.sha256()
+        for entry in [str(CACHE_VERSION), sequence, os.path.basename(openmm_xml),
+                      forcefield_hash(openmm_xml), Platform.getOpenMMVersion(), aromaticity_model]:
+            h.update(entry.encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def load(self, key):
+        """
+        Returns
+        -------
+        (oemol, arrays) if there is an entry for this key, otherwise None
+        arrays is a dictionary of numpy arrays
+        """
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+
+        with np.load(path) as data:
+            arrays = {k: data[k] for k in data.files if k != _oemol_key}
+            oeb = data[_oemol_key].tobytes()
+
+        mol = oechem.OEMol()
+        if not oechem.OEReadMolFromBytes(mol, '.oeb', oeb):
+            return None
+        return mol, arrays
+
+    def save(self, key, oemol, arrays):
+        """
+        Stores a molecule and its parameter arrays. The file is written
+        to a temporary name first so other processes never see half
+        written entries.
+        """
+        oeb = oechem.OEWriteMolToBytes('.oeb', oemol)
+        to_save = dict(arrays)
+        to_save[_oemol_key] = np.frombuffer(oeb, dtype=np.uint8)
+
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                np.savez(temp_file, **to_save)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
@@ -0,0 +1,286 @@
+"""
+queue_worker.py
+
+Runs SMIRKSifier and Reducer jobs from a JobQueue (see job_queue.py).
+The queue is filled by making_proteins.py with --queue, which saves the
+run stores for every force field and adds a job for each
+(force field, fragment, ordering, stage).
+
+Start this script on as many nodes as you like, every worker claims the
+most expensive job that is ready, runs it, and saves its result in the queue.
+Workers stop once there is nothing left to run.
+
+SMIRKSify jobs write the same json files as making_proteins.py
+(one for each set of orderings, force field, and fragment) and reduce jobs save
+the best SMIRKS for each point in the Reducer schedule in the queue.
+
+Example:
+python making_proteins.py -n allin1 -x all --queue mol_files/allin1_queue.db
+python queue_worker.py -q mol_files/allin1_queue.db -w 16
+python queue_worker.py -q mol_files/allin1_queue.db --status
+"""
+
+import sys
+import time
+import random
+import threading
+import traceback
+import multiprocessing
+from making_proteins import order_types_dict, order_clusters, logged_smirksifier_job, clusters_to_files
+from reducing_protein_smirks import new_chain_state, next_chunk, pick_best_chain, _reducer_chunk
+from run_store import open_store, load_mols, load_job
+from run_log import RunLog, get_run_log, set_run_log, configure_run_log
+from job_queue import JobQueue, default_worker_name
+
+
+def run_smirksify_job(job):
+    """
+    Runs SMIRKSifier for one (force field, fragment, ordering) job
+    and writes its json file.
+
+    Returns
+    -------
+    result: dictionary with 'checked', 'n_smirks', and 'json_file'
+    """
+    payload = job['payload']
+    fragment = job['fragment']
+    order = job['ordering']
+
+    mols = load_mols(payload['store'])
+    clusters = open_store(payload['store']).clusters(fragment)
+    # copies of an ordering (shuffle, shuffle_1) use the same function with their own seed
+    random.seed(payload['order_seed'])
+    o_clusters = order_clusters(clusters, mols, fragment, order, order_types_dict[payload['order_function']])
+
+    options = {'smirks_verbose': False, 'warm_start': None}
+    options.update(payload['options'])
+    smirksifier = logged_smirksifier_job(mols, order, fragment, o_clusters, options)
+
+    # every ordering in the same set shares a json file like making_proteins.py
+    clusters_to_files(mols, {fragment: clusters}, {order: {fragment: smirksifier}},
+                      payload['json_file'], store=payload['store'], forcefield=job['forcefield'], merge=True)
+    return {
+        'checked': smirksifier.checks,
+        'n_smirks': len(smirksifier.current_smirks),
+        'json_file': payload['json_file']
+    }
+
+
+def run_reduce_job(job):
+    """
+    Runs every Reducer chain for one job and keeps the best passing
+    chain for each point in the schedule (like reducing_protein_smirks.py).
+
+    Returns
+    -------
+    result: dictionary with 'checked', the 'initial' SMIRKS and the best SMIRKS
+            (or None) and its seed for each output in the schedule
+    """
+    payload = job['payload']
+    fragment = job['fragment']
+    order = job['ordering']
+
+    source, smirks, clusters = load_job(payload['json_file'], fragment, order)
+    type_list = [(l, s) for l, s in smirks['type_list']]
+    if not smirks['checked']:
+        # SMIRKSifier didn't find working SMIRKS so there is nothing to reduce
+        return {'checked': False, 'initial': type_list}
+
+    schedule = [(key, total) for key, total in payload['schedule']]
+    chains = list()
+    for seed in payload['seeds']:
+        state = new_chain_state(seed, type_list)
+        n_iterations = next_chunk(state, schedule, payload['chunk'])
+        while n_iterations > 0:
+            _, _, state = _reducer_chunk((fragment, order, state, source, n_iterations))
+            for key, total in schedule:
+                if state['iterations'] == total:
+                    state['outputs'][key] = state['smirks']
+            n_iterations = next_chunk(state, schedule, payload['chunk'])
+        chains.append((seed, state['outputs']))
+
+    result = pick_best_chain(chains, load_mols(source), clusters, fragment)
+    result.update(checked=True, initial=type_list)
+    return result
+
+
+def run_job(job):
+    if job['stage'] == 'smirksify':
+        return run_smirksify_job(job)
+    return run_reduce_job(job)
+
+
+def _heartbeat_loop(queue_path, job_id, stop, heartbeat_time):
+    """
+    Saves a heartbeat for a job until stop is set, this runs in a thread
+    with its own connection so jobs don't have to do anything
+    """
+    job_queue = JobQueue(queue_path)
+    try:
+        while not stop.wait(heartbeat_time):
+            job_queue.heartbeat(job_id)
+    finally:
+        job_queue.close()
+
+
+def run_worker(queue_path, worker=None, stage=None, max_jobs=None, poll_time=30., log_settings=None,
+               heartbeat_time=60.):
+    """
+    Claims and runs jobs until there is nothing left that can be run.
+    When every ready job is taken but others are still running this
+    waits for them since they may unlock more jobs.
+
+    Parameters
+    ----------
+    queue_path: str, SQLite file for the JobQueue
+    worker: str, name for this worker, defaults to host:pid
+    stage: str, only run jobs for this stage
+    max_jobs: int, stop after this many jobs
+    poll_time: float, seconds to wait before looking for new jobs
+    log_settings: RunLog.settings for this process
+    heartbeat_time: float, seconds between heartbeats while a job is running
+
+    Returns
+    -------
+    n_jobs: number of jobs this worker ran
+    """
+    configure_run_log(log_settings)
+    if worker is None:
+        worker = default_worker_name()
+    job_queue = JobQueue(queue_path)
+    run_log = get_run_log()
+
+    n_jobs = 0
+    try:
+        while max_jobs is None or n_jobs < max_jobs:
+            job = job_queue.claim(worker, stage)
+            if job is None:
+                if not job_queue.unfinished():
+                    break
+                time.sleep(poll_time)
+                continue
+
+            print(worker, 'started', job['job_id'])
+            n_jobs += 1
+            stop = threading.Event()
+            heartbeat = threading.Thread(target=_heartbeat_loop,
+                                         args=(queue_path, job['job_id'], stop, heartbeat_time))
+            heartbeat.daemon = True
+            heartbeat.start()
+            try:
+                with run_log.job('queue_job', job['job_id'], worker=worker,
+                                 stage=job['stage'], cost=job['cost'], attempt=job['attempts']):
+                    result = run_job(job)
+            except Exception:
+                job_queue.fail(job['job_id'], traceback.format_exc())
+                print(worker, 'FAILED', job['job_id'])
+                continue
+            finally:
+                stop.set()
+                heartbeat.join()
+            job_queue.finish(job['job_id'], result)
+            print(worker, 'finished', job['job_id'])
+    finally:
+        job_queue.close()
+    return n_jobs
+
+
+def print_status(job_queue):
+    table_form = "%-55s %-8s %12s %10s %s"
+    print('=' * 100)
+    print(table_form % ('job', 'status', 'cost', 'time', 'worker'))
+    print('-' * 100)
+    for job in job_queue.jobs():
+        wall = ''
+        if job['finished'] is not None:
+            wall = '%.1f' % (job['finished'] - job['claimed'])
+        elif job['claimed'] is not None:
+            wall = '%.1f+' % (time.time() - job['claimed'])
+        print(table_form % (job['job_id'], job['status'], '%.4g' % job['cost'], wall, job['worker'] or ''))
+    print('=' * 100)
+    print(', '.join(['%s: %i' % (s, n) for s, n in sorted(job_queue.counts().items())]))
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser()
+
+    parser.add_option('-q', '--queue',
+                      action='store', type='string', dest='queue',
+                      default='./mol_files/queue.db',
+                      help="SQLite queue file made by making_proteins.py --queue")
+
+    parser.add_option('-w', '--n_workers',
+                      action='store', type='int', dest='n_workers',
+                      default=1,
+                      help="number of worker processes to start on this node")
+
+    parser.add_option('--stage',
+                      action='store', type='string', dest='stage',
+                      default=None,
+                      help="only run jobs for this stage (smirksify or reduce)")
+
+    parser.add_option('--max_jobs',
+                      action='store', type='int', dest='max_jobs',
+                      default=None,
+                      help="each worker stops after this many jobs")
+
+    parser.add_option('--poll_time',
+                      action='store', type='float', dest='poll_time',
+                      default=30.,
+                      help="seconds to wait for running jobs before checking for new jobs")
+
+    parser.add_option('--requeue_stale',
+                      action='store', type='float', dest='requeue_stale',
+                      default=None,
+                      help="""put running jobs without a heartbeat for this many seconds back
+                      in the queue before starting (for workers that were killed)""")
+
+    parser.add_option('--retry_failed',
+                      action='store_true', dest='retry_failed',
+                      default=False,
+                      help="put failed jobs back in the queue before starting")
+
+    parser.add_option('--status',
+                      action='store_true', dest='status',
+                      default=False,
+                      help="print every job in the queue instead of running jobs")
+
+    parser.add_option('-l', '--log',
+                      action='store', type='string', dest='log',
+                      default=None,
+                      help="json lines file for timing and memory use of every job")
+
+    parser.add_option('--profile',
+                      action='store', type='string', dest='profile',
+                      default=None,
+                      help="comma separated patterns for jobs to profile with cProfile, such as 'smirksify:*'")
+
+    (opt, args) = parser.parse_args()
+
+    if opt.log is not None or opt.profile is not None:
+        profile = None if opt.profile is None else opt.profile.split(',')
+        set_run_log(RunLog(opt.log, profile))
+
+    job_queue = JobQueue(opt.queue)
+    if opt.requeue_stale is not None or opt.retry_failed:
+        print('requeued', job_queue.requeue(opt.requeue_stale, opt.retry_failed), 'jobs')
+    if opt.status:
+        print_status(job_queue)
+        job_queue.close()
+        sys.exit(0)
+    job_queue.close()
+
+    # each process opens its own connection to the queue
+    log_settings = get_run_log().settings
+    worker_args = (opt.queue, None, opt.stage, opt.max_jobs, opt.poll_time, log_settings)
+    if opt.n_workers <= 1:
+        run_worker(*worker_args)
+    else:
+        workers = [multiprocessing.Process(target=run_worker, args=worker_args)
+                   for w in range(opt.n_workers)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
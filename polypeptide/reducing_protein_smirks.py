@@ -1,23 +1,42 @@
 import os
 from openeye import oechem
-import pickle
 import copy
 import glob
+import time
+import queue
+import random
 import itertools
+import multiprocessing
+import numpy as np
 from chemper.chemper_utils import check_smirks_to_reference, get_typed_molecules, create_tuples_for_clusters
-from making_proteins import everything_from_fastas, print_order_type_data, at_least_one_passed, ParameterSystem, by_biggest_size, by_biggest_smirks
+from making_proteins import everything_from_fastas, print_order_type_data, at_least_one_passed, ParameterSystem, by_biggest_size, by_biggest_smirks, check_type_list, write_checkpoint, read_checkpoint, smirks_list_score
 import cmiles
 import json
 from parmed.modeller import ResidueTemplate
 from chemper.smirksify import Reducer, print_smirks
+from run_store import open_store, load_mols, load_job, record_source
+from smirks_validation import SMIRKSValidator
+from run_log import RunLog, get_run_log, set_run_log, configure_run_log
+from results_db import ResultsDB, add_reduced_dict
 
 
-def convert_json_and_oeb(json_file, mol_dir='./mol_files/'):
+def convert_json_and_oeb(json_file, mol_dir='./mol_files/', fragment=None, order=None):
     """
     Takes a json file created during the making_proteins step.
-    Finds the oeb files associated with that dictionary
+    Finds the molecules and clusters associated with that file
     and extracts the OEMol objects.
 
+    Molecules are shared by every json file from the same run,
+    use load_job in run_store.py to load one fragment without
+    reading the molecules.
+
+    Parameters
+    ----------
+    json_file: str
+    mol_dir: directory with the oeb files for json files in the original format
+    fragment: str, only load this fragment type
+    order: str, only load SMIRKS for this ordering
+
     Returns
     -------
     mols: list of OEMols
@@ -25,88 +44,414 @@ def convert_json_and_oeb(json_file, mol_dir='./mol_files/'):
                  different fragment types
     clusters: atom indice clusters used to make the SMIRKS patterns
     """
+    if fragment is not None:
+        source, smirks, clusters = load_job(json_file, fragment, order, mol_dir)
+        if order is None:
+            smirks_dict = {o: {fragment: d} for o, d in smirks.items()}
+        else:
+            smirks_dict = {order: {fragment: smirks}}
+        return load_mols(source), smirks_dict, {fragment: clusters}
+
     with open(json_file, 'r') as inputf:
         d = json.load(inputf)
 
-    mol_dir = os.path.abspath(mol_dir)
-    mol_files = [os.path.join(mol_dir, m) for m in d['mol_files']]
-    mols = list()
-    for mol_file in mol_files:
-        mol = oechem.OEMol()
-        ifs = oechem.oemolistream(mol_file)
-        while oechem.OEReadMolecule(ifs,mol):
-            mols.append(oechem.OEMol(mol))
-
-    return mols, d['smirks_lists'], d['clusters']
-
-
-# create dictionary to store final SMIRKS
-final_dict = dict()
-
-# list to find all relevant files
-file_keys = [
-    ('big', ['big_smirks', 'biggest_size']),
-    ('small', ['small_smirks', 'small_size'])
-]
-
-# loop over both big and small order types
-for fn_label, cluster_orders in file_keys:
-    # find files for that order type
-    fns = glob.glob('./mol_files/allIn1_%s_99sbildn_*_1mols.json' % fn_label)
-    print('='*80)
-    print(' '*20,fn_label)
-    print('='*80)
-    for f in fns:
-        frag = f.split('_')[-2]
-        # if its a torsion parameter type find proper or improper
-        if frag == 'torsion':
-            prefix = f.split('_')[-3]
-            frag = '%s_%s' % (prefix, frag)
-        print('-'*80)
-        print(' '*30,frag)
-        print('-'*80)
-        # convert json file to get SMIRKS and molecules
-        mols, dsmirks, dclusters = convert_json_and_oeb(f)
-
-        # if we haven't made a dictionary for this fragment
-        # make a subdictionary
-        if frag not in final_dict:
-            final_dict[frag] = dict()
-
-        for order in cluster_orders:
-            final_dict[frag][order] = dict()
-            d = dsmirks[order][frag]
-            type_list = [(l, s) for l,s in d['type_list']]
-            final_dict[frag][order]['initial'] = type_list
-
-            print('ORIGINAL', order)
-            print_smirks(type_list)
-
-            if not d['checked']:
-                # wasn't able to make SMIRKS for this order
-                # and fragment type combination
-                # note: this means there's an incorrect key in the dict.
-                #       I forgot to switch this to output_5k instead of 10
-                final_dict[frag][order]['output_10k'] = None
-                continue
+    source = record_source(json_file, d, mol_dir)
+    if isinstance(source, str):
+        store = open_store(source)
+        clusters = {frag: store.clusters(frag) for frag in d['fragments']}
+    else:
+        clusters = d['clusters']
+
+    smirks_dict = d['smirks_lists']
+    if order is not None:
+        smirks_dict = {order: smirks_dict[order]}
+    return load_mols(source), smirks_dict, clusters
+
+
+# ==================================================
+# Reducer jobs
+# The Reducer is a random search, so each (fragment, order) job is
+# run as several independent chains with different seeds and
+# we keep the best result.
+
+def _get_worker_mols(source):
+    # load_mols only reads each store once per process
+    return load_mols(source)
+
+
+# validators in this worker process {(molecule source, fragment): SMIRKSValidator}
+# every chain of a fragment checks against the same fragments so the matches are shared
+_worker_validators = dict()
+
+
+def _get_worker_validator(source, frag, type_list):
+    if (source, frag) not in _worker_validators:
+        _worker_validators[(source, frag)] = SMIRKSValidator.from_type_list(
+            type_list, _get_worker_mols(source), 'improper' in frag)
+    return _worker_validators[(source, frag)]
+
+
+class ValidatedReducer(Reducer):
+    """
+    Reducer that checks each new SMIRKS list with a SMIRKSValidator
+    instead of typing every molecule from scratch, so only the
+    pattern that was just changed is matched again.
+
+    Parameters
+    ----------
+    smirks_list: list of (label, SMIRKS) to reduce
+    mols: list of OEMols
+    validator: SMIRKSValidator with the fragments typed by smirks_list as the reference
+    verbose: verbosity for the Reducer
+    """
+    def __init__(self, smirks_list, mols, validator, verbose=False):
+        Reducer.__init__(self, smirks_list, mols, verbose=verbose)
+        self.validator = validator
+
+    def types_match_reference(self, current_types=None):
+        if current_types is None:
+            current_types = self.current_smirks
+        return self.validator.passes(current_types)
+
+
+# Reducers in this worker process {(molecule source, fragment, order): ValidatedReducer}
+# setting up a Reducer goes through every molecule so it is only done once,
+# each chunk just sets the SMIRKS list (and _reducer_chunk sets the random state)
+_worker_reducers = dict()
+
+
+def _get_worker_reducer(source, frag, order, type_list):
+    key = (source, frag, order)
+    if key not in _worker_reducers:
+        validator = _get_worker_validator(source, frag, type_list)
+        _worker_reducers[key] = ValidatedReducer(type_list, _get_worker_mols(source), validator, verbose=False)
+    reducer = _worker_reducers[key]
+    reducer.current_smirks = [(l, s) for l, s in type_list]
+    return reducer
+
+
+def new_chain_state(seed, type_list):
+    """
+    State for a Reducer chain that hasn't started yet.
+    Chains are run in chunks and this is everything needed to continue
+    a chain after a restart:
+    seed: seed for this chain
+    smirks: current SMIRKS list
+    iterations: number of iterations done so far
+    rng: python and numpy random states at the end of the last chunk
+    outputs: SMIRKS lists saved at each point in the iteration schedule
+    wall_time: seconds spent running this chain
+    """
+    return {'seed': seed, 'smirks': type_list, 'iterations': 0, 'rng': None, 'outputs': dict(), 'wall_time': 0.}
+
+
+def _reducer_chunk(job):
+    """
+    Runs one chunk of iterations for a Reducer chain in a worker process.
+    job is a tuple (fragment, order, chain state, molecule source, iterations)
+    Returns the fragment, order, and updated chain state.
+    """
+    frag, order, state, source, iterations = job
+    if state['rng'] is None:
+        random.seed(state['seed'])
+        np.random.seed(state['seed'] % 2**32)
+    else:
+        random.setstate(state['rng'][0])
+        np.random.set_state(state['rng'][1])
+
+    with get_run_log().job('reducer', 'reducer:%s:%s:%i' % (frag, order, state['seed']),
+                           fragment=frag, order=order, seed=state['seed'],
+                           start_iteration=state['iterations'], iterations=iterations,
+                           n_smirks_start=len(state['smirks'])) as counts:
+        start = time.perf_counter()
+        red = _get_worker_reducer(source, frag, order, state['smirks'])
+        smirks = red.run(iterations)
+        counts['n_smirks'] = len(smirks)
+
+    new_state = dict(state)
+    new_state['smirks'] = smirks
+    new_state['iterations'] = state['iterations'] + iterations
+    # chains from older checkpoints don't have a wall time
+    new_state['wall_time'] = state.get('wall_time', 0.) + time.perf_counter() - start
+    new_state['rng'] = (random.getstate(), np.random.get_state())
+    return frag, order, new_state
+
+
+def next_chunk(state, schedule, chunk_size):
+    """
+    Number of iterations for the next chunk of a chain, chunks stop at each
+    point in the schedule so those outputs can be saved.
+    Returns 0 if the chain is finished.
+    """
+    for key, total in schedule:
+        if state['iterations'] < total:
+            return min(chunk_size, total - state['iterations'])
+    return 0
+
+
+def pick_best_chain(chains, mols, clusters, frag):
+    """
+    Parameters
+    ----------
+    chains: list of (seed, outputs) where outputs is {output key: SMIRKS list}
+    mols: list of OEMols
+    clusters: reference clusters for this fragment type
+    frag: fragment type
+
+    Returns
+    -------
+    best: dictionary {output key: SMIRKS list} with the best passing
+          chain for each output key and the seed for that chain in 'seed_[key]'
+    """
+    # one validator for every chain so patterns they share are only matched once
+    validator = SMIRKSValidator(mols, clusters, 'improper' in frag)
+    best = dict()
+    for key in chains[0][1].keys():
+        candidates = list()
+        for seed, outputs in chains:
+            agreement = check_type_list(outputs[key], mols, clusters, 'improper' in frag, validator)
+            if all([c == t for c, t in agreement.values()]):
+                candidates.append((smirks_list_score(outputs[key]), seed, outputs[key]))
+        if len(candidates) == 0:
+            best[key] = None
+            continue
+        score, seed, type_list = min(candidates, key=lambda x: (x[0], x[1]))
+        best[key] = type_list
+        best['seed_%s' % key] = seed
+    return best
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser()
+
+    parser.add_option('-w', '--n_workers',
+                      action='store', type='int', dest='n_workers',
+                      default=1,
+                      help="number of processes used to run Reducer chains")
+
+    parser.add_option('-k', '--chains',
+                      action='store', type='int', dest='chains',
+                      default=1,
+                      help="number of independent Reducer chains run for each fragment and order")
+
+    parser.add_option('-s', '--seed',
+                      action='store', type='int', dest='seed',
+                      default=0,
+                      help="seed for the first chain, chain i uses seed + i")
+
+    parser.add_option('-c', '--checkpoint',
+                      action='store', type='string', dest='checkpoint',
+                      default='./mol_files/reduced_smirks_checkpoint.p',
+                      help="file where progress is saved so the run can be resumed")
+
+    parser.add_option('--chunk',
+                      action='store', type='int', dest='chunk',
+                      default=500,
+                      help="number of Reducer iterations run between checkpoints of each chain")
+
+    parser.add_option('--checkpoint_time',
+                      action='store', type='float', dest='checkpoint_time',
+                      default=60.,
+                      help="minimum number of seconds between writing checkpoints")
+
+    parser.add_option('--resume',
+                      action='store_true', dest='resume',
+                      default=False,
+                      help="continue from the checkpoint of a run that was stopped")
+
+    parser.add_option('-l', '--log',
+                      action='store', type='string', dest='log',
+                      default=None,
+                      help="json lines file for timing and memory use of every Reducer chunk")
+
+    parser.add_option('-r', '--results',
+                      action='store', type='string', dest='results',
+                      default='./mol_files/results.db',
+                      help="SQLite database where the results are saved (see results_db.py)")
+
+    parser.add_option('-n', '--run',
+                      action='store', type='string', dest='run',
+                      default='reduced_smirks_5k',
+                      help="name for this run in the results database")
+
+    parser.add_option('--profile',
+                      action='store', type='string', dest='profile',
+                      default=None,
+                      help="comma separated patterns for jobs to profile with cProfile, such as 'reducer:bond:*'")
+
+    (opt, args) = parser.parse_args()
 
-            # make a Reducer to generalize the SMIRKS patterns
-            red = Reducer(type_list, mols, verbose=False)
+    if opt.log is not None or opt.profile is not None:
+        profile = None if opt.profile is None else opt.profile.split(',')
+        set_run_log(RunLog(opt.log, profile))
 
-            # Run 1k iterations and save and print the SMIRKS
-            final_dict[frag][order]['output_1k'] = red.run(1000)
-            print('REDUCED 1k ', order)
-            print_smirks(final_dict[frag][order]['output_1k'])
+    # create dictionary to store final SMIRKS
+    final_dict = dict()
 
-            # Run 4k more iterations (5k total)
-            # save and print the SMIRKS
-            final_dict[frag][order]['output_5k'] = red.run(4000)
-            print('REDUCED 5k ', order)
-            print_smirks(final_dict[frag][order]['output_5k'])
+    # list to find all relevant files
+    file_keys = [
+        ('big', ['big_smirks', 'biggest_size']),
+        ('small', ['small_smirks', 'small_size'])
+    ]
 
+    # Run 1k iterations then 4k more (5k total),
+    # these are the total number of iterations for each output
+    schedule = [('output_1k', 1000), ('output_5k', 5000)]
 
+    # progress from a previous run
+    # chains: {(fragment, order, seed): chain state}
+    # finished: {(fragment, order): best outputs}
+    progress = None
+    if opt.resume:
+        progress = read_checkpoint(opt.checkpoint)
+    if progress is None:
+        progress = {'chains': dict(), 'finished': dict()}
+    chains = progress['chains']
+    finished = progress['finished']
 
-# Pickle dictionary for posterity
-pickle.dump(final_dict, open('./mol_files/reduced_smirks_dict_5k.p', 'wb'))
+    # loop over both big and small order types to find the chains
+    references = dict()
+    for fn_label, cluster_orders in file_keys:
+        # find files for that order type
+        fns = glob.glob('./mol_files/allIn1_%s_99sbildn_*_1mols.json' % fn_label)
+        for f in fns:
+            frag = f.split('_')[-2]
+            # if its a torsion parameter type find proper or improper
+            if frag == 'torsion':
+                prefix = f.split('_')[-3]
+                frag = '%s_%s' % (prefix, frag)
 
+            # only this fragment is loaded and the molecules
+            # are shared by every json file from the same run
+            source, frag_smirks, clusters = load_job(f, frag)
+            references[frag] = (source, clusters)
+
+            # if we haven't made a dictionary for this fragment
+            # make a subdictionary
+            if frag not in final_dict:
+                final_dict[frag] = dict()
+
+            for order in cluster_orders:
+                if order not in frag_smirks:
+                    # this ordering was stopped in a race (making_proteins.py --race)
+                    continue
+                final_dict[frag][order] = dict()
+                dsmirks = frag_smirks[order]
+                type_list = [(l, s) for l,s in dsmirks['type_list']]
+                final_dict[frag][order]['initial'] = type_list
+
+                if not dsmirks['checked']:
+                    # wasn't able to make SMIRKS for this order
+                    # and fragment type combination
+                    # note: this means there's an incorrect key in the dict.
+                    #       I forgot to switch this to output_5k instead of 10
+                    final_dict[frag][order]['output_10k'] = None
+                    continue
+
+                if (frag, order) in finished:
+                    continue
+
+                for seed in range(opt.seed, opt.seed + opt.chains):
+                    if (frag, order, seed) not in chains:
+                        chains[(frag, order, seed)] = new_chain_state(seed, type_list)
+
+    # Each chain is run in chunks, after every chunk the next chunk for that
+    # chain is submitted so chains never wait on each other
+    results = queue.Queue()
+    pool = None
+    if opt.n_workers > 1:
+        pool = multiprocessing.Pool(processes=opt.n_workers,
+                                    initializer=configure_run_log,
+                                    initargs=(get_run_log().settings,))
+
+    def submit(chain_key):
+        frag, order, seed = chain_key
+        state = chains[chain_key]
+        job = (frag, order, state, references[frag][0], next_chunk(state, schedule, opt.chunk))
+        if pool is None:
+            # errors go through the results queue like the pool's error_callback
+            # so both paths write a checkpoint before raising
+            try:
+                results.put(_reducer_chunk(job))
+            except Exception as e:
+                results.put(e)
+        else:
+            pool.apply_async(_reducer_chunk, (job,), callback=results.put, error_callback=results.put)
+
+    def finish_job(frag, order):
+        job_chains = [(k[2], state['outputs']) for k, state in chains.items() if k[:2] == (frag, order)]
+        source, clusters = references[frag]
+        with get_run_log().job('pick_best_chain', 'pick_best_chain:%s:%s' % (frag, order),
+                               fragment=frag, order=order, n_chains=len(job_chains)) as counts:
+            best = pick_best_chain(sorted(job_chains), _get_worker_mols(source), clusters, frag)
+            counts['passed'] = {k: best[k] is not None for k, _ in schedule}
+        best['wall_time'] = sum([state.get('wall_time', 0.) for k, state in chains.items()
+                                 if k[:2] == (frag, order)])
+        finished[(frag, order)] = best
+        for k in [k for k in chains if k[:2] == (frag, order)]:
+            del chains[k]
+        print('finished', frag, order)
+
+    pending = 0
+    for chain_key, state in list(chains.items()):
+        if next_chunk(state, schedule, opt.chunk) > 0:
+            submit(chain_key)
+            pending += 1
+
+    # jobs where every chain finished right before the last checkpoint
+    for frag, order in set([k[:2] for k in chains]):
+        if all([next_chunk(s, schedule, opt.chunk) == 0 for k, s in chains.items() if k[:2] == (frag, order)]):
+            finish_job(frag, order)
+
+    last_checkpoint = time.time()
+    while pending > 0:
+        item = results.get()
+        pending -= 1
+        if isinstance(item, BaseException):
+            write_checkpoint(opt.checkpoint, progress)
+            raise item
+
+        frag, order, state = item
+        for key, total in schedule:
+            if state['iterations'] == total:
+                state['outputs'][key] = state['smirks']
+        chains[(frag, order, state['seed'])] = state
+
+        if next_chunk(state, schedule, opt.chunk) > 0:
+            submit((frag, order, state['seed']))
+            pending += 1
+        elif all([next_chunk(s, schedule, opt.chunk) == 0 for k, s in chains.items() if k[:2] == (frag, order)]):
+            finish_job(frag, order)
+
+        if time.time() - last_checkpoint >= opt.checkpoint_time:
+            write_checkpoint(opt.checkpoint, progress)
+            last_checkpoint = time.time()
+
+    write_checkpoint(opt.checkpoint, progress)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    for (frag, order), best in sorted(finished.items()):
+        print('-'*80)
+        print(' '*30,frag, order)
+        print('-'*80)
+        final_dict[frag][order].update(best)
+
+        print('ORIGINAL', order)
+        print_smirks(final_dict[frag][order]['initial'])
+        for key, _ in schedule:
+            if best[key] is None:
+                print('NO PASSING CHAIN', key, order)
+                continue
+            print('REDUCED %s' % key.split('_')[-1], order)
+            print_smirks(best[key])
 
+    # Save every result to the results database,
+    # use results_db.py to look at them or make tables
+    results_db = ResultsDB(opt.results)
+    run_id = results_db.add_run(opt.run, source=os.path.abspath(opt.checkpoint), settings=vars(opt))
+    print('saved', add_reduced_dict(results_db, run_id, final_dict, '99sbildn'), 'results to', opt.results)
+    results_db.close()
@@ -0,0 +1,579 @@
+"""
+results_db.py
+
+Indexed database for reduced SMIRKS.
+
+reducing_protein_smirks.py used to pickle one nested dictionary
+(mol_files/reduced_smirks_dict_5k.p) with the form
+{fragment: {order: {'initial': SMIRKS list, 'output_1k': SMIRKS list, ...}}}
+so getting one table (like SMIRKS_to_LaTeX.ipynb does) meant loading every
+result, and comparing runs meant loading every pickle.
+
+Here every result is one row in a SQLite table with the columns
+(run, force field, fragment, ordering, stage, iterations) where stage
+is 'smirksify' for the SMIRKS from making_proteins.py (iterations is 0)
+or 'reduce' for the Reducer output after that many iterations.
+Each row also has if the SMIRKS passed, the seed of the chain it came from,
+the time it took (when it is known), and the number of SMIRKS.
+The SMIRKS are stored in a second table with their cluster label and the
+parameter values from that label, so only the rows that are asked for are read.
+
+Old pickles can be imported with import_reduced_pickle and results from a job
+queue (see job_queue.py) with import_queue. Tables for the paper are written
+with write_latex_table which streams rows straight from the database.
+
+Example:
+python results_db.py -r mol_files/results.db --import_pickle mol_files/reduced_smirks_dict_5k.p -n allin1
+python results_db.py -r mol_files/results.db --summary
+python results_db.py -r mol_files/results.db -n allin1 --latex protein_smirks.tex
+"""
+
+import os
+import json
+import time
+import pickle
+import sqlite3
+import contextlib
+from job_queue import JobQueue
+
+# bump this if the tables change
+RESULTS_VERSION = 1
+
+_schema = """
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    created REAL NOT NULL,
+    source TEXT,
+    settings TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    result_id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    forcefield TEXT NOT NULL,
+    fragment TEXT NOT NULL,
+    ordering TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    iterations INTEGER NOT NULL,
+    passed INTEGER,
+    seed INTEGER,
+    wall_time REAL,
+    n_smirks INTEGER NOT NULL,
+    UNIQUE (run_id, forcefield, fragment, ordering, stage, iterations)
+);
+CREATE TABLE IF NOT EXISTS smirks (
+    result_id INTEGER NOT NULL REFERENCES results (result_id),
+    position INTEGER NOT NULL,
+    label TEXT NOT NULL,
+    smirks TEXT NOT NULL,
+    parameters TEXT NOT NULL,
+    PRIMARY KEY (result_id, position)
+);
+CREATE INDEX IF NOT EXISTS results_by_job ON results (forcefield, fragment, ordering, stage, iterations);
+"""
+
+# columns of the results table returned by ResultsDB.results
+result_columns = ['result_id', 'run', 'forcefield', 'fragment', 'ordering', 'stage',
+                  'iterations', 'passed', 'seed', 'wall_time', 'n_smirks']
+
+
+def label_parameters(label):
+    """
+    Parameter values in a cluster label (as strings with the rounding
+    used for the label), for example 'zz_0.123\t1.500' gives ['0.123', '1.500']
+    """
+    # SMIRKSifier adds 'zz_' to the start of each label
+    if label.startswith('zz_'):
+        label = label[3:]
+    return label.split('\t')
+
+
+def output_iterations(key):
+    """
+    Number of Reducer iterations for an output key like 'output_5k'
+    """
+    count = key.split('_')[-1]
+    if count.endswith('k'):
+        return int(count[:-1]) * 1000
+    return int(count)
+
+
+class ResultsDB:
+    """
+    SMIRKS results for any number of runs in one SQLite file.
+
+    Parameters
+    ----------
+    path: str, SQLite file, it is created if it doesn't exist
+    timeout: float, seconds to wait for another process's lock
+    """
+    def __init__(self, path, timeout=120.):
+        self.path = os.path.abspath(path)
+        self.connection = sqlite3.connect(self.path, timeout=timeout, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(_schema)
+        with self.transaction() as db:
+            db.execute("INSERT OR IGNORE INTO settings VALUES ('version', ?)", (str(RESULTS_VERSION),))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    def close(self):
+        self.connection.close()
+
+    def add_run(self, name, source=None, settings=None):
+        """
+        Returns the id for the run with this name, adding it if it is new
+
+        Parameters
+        ----------
+        name: str, label for this run
+        source: str, where the results came from (like a pickle or queue file)
+        settings: dictionary with the settings used for this run
+        """
+        with self.transaction() as db:
+            db.execute("INSERT OR IGNORE INTO runs (name, created, source, settings) VALUES (?, ?, ?, ?)",
+                       (name, time.time(), source, json.dumps(settings)))
+            return db.execute("SELECT run_id FROM runs WHERE name = ?", (name,)).fetchone()[0]
+
+    def runs(self):
+        """
+        Returns
+        -------
+        runs: list of dictionaries with the columns of the runs table
+        """
+        runs = list()
+        for row in self.connection.execute("SELECT * FROM runs ORDER BY run_id"):
+            run = dict(row)
+            run['settings'] = json.loads(run['settings'])
+            runs.append(run)
+        return runs
+
+    def add_result(self, run_id, forcefield, fragment, ordering, stage, iterations, type_list,
+                   passed=None, seed=None, wall_time=None):
+        """
+        Saves one SMIRKS list, a result with the same
+        (run, force field, fragment, ordering, stage, iterations) is replaced.
+
+        Parameters
+        ----------
+        run_id: int, from add_run
+        forcefield: str, force field label
+        fragment: str, fragment type
+        ordering: str, ordering type
+        stage: str, 'smirksify' or 'reduce'
+        iterations: int, Reducer iterations, 0 for SMIRKSifier results
+        type_list: list of (label, SMIRKS) or None if there is no result
+        passed: bool or None if it isn't known
+        seed: int, seed for the Reducer chain
+        wall_time: float, seconds it took to make this result
+
+        Returns
+        -------
+        result_id: int
+        """
+        if type_list is None:
+            type_list = list()
+        passed = None if passed is None else int(bool(passed))
+        with self.transaction() as db:
+            old = db.execute("SELECT result_id FROM results WHERE run_id = ? AND forcefield = ? AND fragment = ? "
+                             "AND ordering = ? AND stage = ? AND iterations = ?",
+                             (run_id, forcefield, fragment, ordering, stage, iterations)).fetchone()
+            if old is not None:
+                db.execute("DELETE FROM smirks WHERE result_id = ?", (old[0],))
+                db.execute("DELETE FROM results WHERE result_id = ?", (old[0],))
+            cursor = db.execute("INSERT INTO results (run_id, forcefield, fragment, ordering, stage, iterations, "
+                                "passed, seed, wall_time, n_smirks) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                (run_id, forcefield, fragment, ordering, stage, int(iterations),
+                                 passed, seed, wall_time, len(type_list)))
+            result_id = cursor.lastrowid
+            db.executemany("INSERT INTO smirks VALUES (?, ?, ?, ?, ?)",
+                           [(result_id, pos, label, smirks, json.dumps(label_parameters(label)))
+                            for pos, (label, smirks) in enumerate(type_list)])
+        return result_id
+
+    def results(self, run=None, forcefield=None, fragment=None, ordering=None, stage=None,
+                iterations=None, passed=None):
+        """
+        Finds results, any argument left as None matches everything.
+        The SMIRKS aren't loaded, use smirks with the result_id for those.
+
+        Parameters
+        ----------
+        run: str, name of the run
+
+        Returns
+        -------
+        generator of dictionaries with result_columns
+        """
+        conditions = list()
+        args = list()
+        for column, value in [('runs.name', run), ('forcefield', forcefield), ('fragment', fragment),
+                              ('ordering', ordering), ('stage', stage), ('iterations', iterations)]:
+            if value is not None:
+                conditions.append('%s = ?' % column)
+                args.append(value)
+        if passed is not None:
+            conditions.append('passed = ?')
+            args.append(int(bool(passed)))
+
+        query = ("SELECT result_id, runs.name AS run, forcefield, fragment, ordering, stage, iterations, "
+                 "passed, seed, wall_time, n_smirks FROM results JOIN runs ON runs.run_id = results.run_id")
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += " ORDER BY runs.run_id, forcefield, fragment, ordering, stage, iterations"
+        for row in self.connection.execute(query, args):
+            yield dict(row)
+
+    def smirks(self, result_id):
+        """
+        Returns
+        -------
+        generator of (label, SMIRKS, parameter values) in the order of the SMIRKS list
+        """
+        for row in self.connection.execute("SELECT label, smirks, parameters FROM smirks "
+                                           "WHERE result_id = ? ORDER BY position", (result_id,)):
+            yield row[0], row[1], json.loads(row[2])
+
+    def type_list(self, run, forcefield, fragment, ordering, stage='reduce', iterations=5000):
+        """
+        Returns
+        -------
+        type_list: list of (label, SMIRKS) for one result
+                   or None if there is no passing result
+        """
+        for result in self.results(run, forcefield, fragment, ordering, stage, iterations):
+            if result['n_smirks'] == 0:
+                return None
+            return [(label, smirks) for label, smirks, _ in self.smirks(result['result_id'])]
+        return None
+
+
+class _BuiltinsUnpickler(pickle.Unpickler):
+    """
+    The old results only have dictionaries, lists, tuples, strings, and numbers
+    so nothing ever needs to be imported to load them. Refusing every import
+    means a pickle can't run code when it is loaded.
+    """
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError("%s.%s is not allowed in a results pickle" % (module, name))
+
+
+def load_reduced_pickle(pickle_file):
+    with open(pickle_file, 'rb') as pickle_input:
+        return _BuiltinsUnpickler(pickle_input).load()
+
+
+def add_reduced_dict(results_db, run_id, final_dict, forcefield='99sbildn'):
+    """
+    Saves the results from reducing_protein_smirks.py in the form
+    {fragment: {order: {'initial': SMIRKS list, 'output_[n]k': SMIRKS list or None,
+                        'seed_output_[n]k': seed, 'wall_time': seconds}}}
+
+    Jobs where SMIRKSifier failed have an 'output_10k' key
+    set to None, so the initial SMIRKS for those are saved as not passing.
+
+    Returns
+    -------
+    n_results: number of results saved
+    """
+    n_results = 0
+    for fragment, order_dict in final_dict.items():
+        for ordering, outputs in order_dict.items():
+            checked = outputs.get('output_10k', True) is not None
+            results_db.add_result(run_id, forcefield, fragment, ordering, 'smirksify', 0,
+                                  outputs.get('initial', None), checked)
+            n_results += 1
+            if not checked:
+                continue
+            for key, type_list in outputs.items():
+                if not key.startswith('output_'):
+                    continue
+                results_db.add_result(run_id, forcefield, fragment, ordering, 'reduce', output_iterations(key),
+                                      type_list, type_list is not None, outputs.get('seed_%s' % key, None),
+                                      outputs.get('wall_time', None))
+                n_results += 1
+    return n_results
+
+
+def import_reduced_pickle(results_db, pickle_file, run_name, forcefield='99sbildn'):
+    """
+    Imports a pickle made by an older version of reducing_protein_smirks.py
+    (see add_reduced_dict for the format)
+
+    Returns
+    -------
+    n_results: number of results saved
+    """
+    final_dict = load_reduced_pickle(pickle_file)
+    run_id = results_db.add_run(run_name, source=os.path.abspath(pickle_file),
+                                settings={'forcefield': forcefield})
+    return add_reduced_dict(results_db, run_id, final_dict, forcefield)
+
+
+def import_queue(results_db, job_queue, run_name):
+    """
+    Imports every finished job from a JobQueue (see job_queue.py).
+    SMIRKS from smirksify jobs are read from their json files.
+
+    Returns
+    -------
+    n_results: number of results saved
+    """
+    run_id = results_db.add_run(run_name, source=job_queue.path)
+    n_results = 0
+    for job in job_queue.jobs('done'):
+        wall_time = job['finished'] - job['claimed']
+        result = job['result']
+        if job['stage'] == 'smirksify':
+            with open(result['json_file'], 'r') as record_file:
+                smirks = json.load(record_file)['smirks_lists'][job['ordering']][job['fragment']]
+            results_db.add_result(run_id, job['forcefield'], job['fragment'], job['ordering'], 'smirksify', 0,
+                                  smirks['type_list'], smirks['checked'], wall_time=wall_time)
+            n_results += 1
+            continue
+
+        if not result['checked']:
+            continue
+        for key, type_list in result.items():
+            if not key.startswith('output_'):
+                continue
+            results_db.add_result(run_id, job['forcefield'], job['fragment'], job['ordering'], 'reduce',
+                                  output_iterations(key), type_list, type_list is not None,
+                                  result.get('seed_%s' % key, None), wall_time)
+            n_results += 1
+    return n_results
+
+
+# ==================================================
+# Tables
+# Each fragment type has its own columns, these are the tables
+# from SMIRKS_to_LaTeX.ipynb
+
+def latex_smirks(smirks):
+    new_smirks = smirks.replace('~', '$\\sim$')
+    new_smirks = new_smirks.replace('#', '\\#')
+    return '\\texttt{%s}' % new_smirks
+
+
+def _two_values(params):
+    return [params[:2]]
+
+
+def _improper_values(params):
+    # labels are [u, w, n, atom3 element], tables are n, w, u
+    u, w, n = params[:3]
+    return [(n.split('.')[0], w.split('.')[0], u)]
+
+
+def _proper_values(params):
+    # one (n, w, u) for each periodicity, padded terms are 'inf'
+    rows = list()
+    for idx in range(0, len(params), 3):
+        u, w, n = params[idx:idx + 3]
+        if u == 'inf':
+            continue
+        rows.append((n.split('.')[0], w.split('.')[0], u))
+    return rows
+
+
+def _charge_values(params):
+    return [params[:1]]
+
+
+# {fragment: (title, name in the caption, column headers, column widths, function for parameter rows)}
+latex_tables = {
+    'bond': ('Bond', 'bond', ['$k$', '$l$'], [.2, .2, .5], _two_values),
+    'angle': ('Angle', 'angle', ['$k$', '$\\theta$'], [.2, .2, .5], _two_values),
+    'improper_torsion': ('Improper Torsion', 'improper torsion', ['$n$', '$\\omega$', '$u$'],
+                         [.05, .07, .12, .72], _improper_values),
+    'proper_torsion': ('Proper Torsion', 'proper torsion', ['$n$', '$\\omega$', '$u$'],
+                       [.05, .07, .12, .72], _proper_values),
+    'lj': ('Lennard-Jones', 'Lennard-Jones', ['$\\epsilon$', '$r_{min}$'], [.2, .2, .5], _two_values),
+    'charge': ('Charge', 'charge', ['$q$'], [.2, .75], _charge_values),
+}
+
+
+def table_rows(results_db, result_id, fragment):
+    """
+    Returns
+    -------
+    generator of (list of parameter rows, SMIRKS) for one result,
+    proper torsions can have more than one parameter row
+    """
+    values = latex_tables[fragment][4]
+    for label, smirks, params in results_db.smirks(result_id):
+        yield values(params), smirks
+
+
+def write_latex_table(results_db, output, run, forcefield, fragment, ordering, stage='reduce', iterations=5000):
+    """
+    Writes a longtable for one result to an open file, rows are
+    written as they are read from the database.
+
+    Returns
+    -------
+    written: True if the result was found and the table was written
+    """
+    results = list(results_db.results(run, forcefield, fragment, ordering, stage, iterations))
+    if len(results) == 0 or results[0]['n_smirks'] == 0:
+        return False
+
+    title, caption, headers, widths, _ = latex_tables[fragment]
+    n_cols = len(headers) + 1
+    output.write('\\begin{longtable}{%s} \n' % ' '.join(['>{\\baselineskip=10pt}p{%s\\textwidth}' % w
+                                                          for w in widths]))
+    output.write('\\hline \n')
+    output.write('\\multicolumn{%i}{c}{%s Parameters} \\\\ \n' % (n_cols, title))
+    output.write('\\hline \n')
+    output.write('%s \\\\ \n' % ' & '.join(['\\textbf{%s}' % h for h in headers + ['\\texttt{SMIRKS}']]))
+    output.write('\\hline \n')
+    output.write('\\endhead')
+
+    for param_rows, smirks in table_rows(results_db, results[0]['result_id'], fragment):
+        if len(param_rows) == 1:
+            output.write('%s & %s \\\\ \n' % (' & '.join(param_rows[0]), latex_smirks(smirks)))
+            continue
+        output.write('%s & \\multirow[t]{%i}{*}{%s} \\\\ \n' % (' & '.join(param_rows[0]), len(param_rows),
+                                                              latex_smirks(smirks)))
+        for row in param_rows[1:]:
+            output.write('%s & \\\\ \n' % ' & '.join(row))
+
+    output.write('\\hline')
+    output.write('\\caption{These are the %s parameters from the reference force field with the associated '
+                 '\\texttt{SMIRKS} patterns created with ChemPer} \n' % caption)
+    output.write('\\label{tab:protein_%s}\n' % fragment.split('_')[0])
+    output.write('\\end{longtable}\n\n\n')
+    return True
+
+
+def write_text_table(results_db, output, run, forcefield, fragment, ordering, stage='reduce', iterations=5000):
+    """
+    Same as write_latex_table, but tab separated text
+    """
+    results = list(results_db.results(run, forcefield, fragment, ordering, stage, iterations))
+    if len(results) == 0 or results[0]['n_smirks'] == 0:
+        return False
+
+    output.write('# %s %s %s %s %s %i\n' % (run, forcefield, fragment, ordering, stage, iterations))
+    for param_rows, smirks in table_rows(results_db, results[0]['result_id'], fragment):
+        for row_idx, row in enumerate(param_rows):
+            output.write('%s\t%s\n' % ('\t'.join(row), smirks if row_idx == 0 else ''))
+    output.write('\n')
+    return True
+
+
+def print_summary(results_db, **filters):
+    table_form = "%-10s %-10s %-18s %-14s %-10s %6s %6s %6s %9s"
+    print('=' * 100)
+    print(table_form % ('run', 'ff', 'fragment', 'ordering', 'stage', 'iters', 'passed', 'smirks', 'time'))
+    print('-' * 100)
+    for r in results_db.results(**filters):
+        wall = '' if r['wall_time'] is None else '%.1f' % r['wall_time']
+        passed = '' if r['passed'] is None else str(bool(r['passed']))
+        print(table_form % (r['run'], r['forcefield'], r['fragment'], r['ordering'], r['stage'],
+                            r['iterations'], passed, r['n_smirks'], wall))
+    print('=' * 100)
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser()
+
+    parser.add_option('-r', '--results',
+                      action='store', type='string', dest='results',
+                      default='./mol_files/results.db',
+                      help="SQLite results database")
+
+    parser.add_option('-n', '--run',
+                      action='store', type='string', dest='run',
+                      default=None,
+                      help="name of the run to import or export")
+
+    parser.add_option('-x', '--forcefield',
+                      action='store', type='string', dest='forcefield',
+                      default='99sbildn',
+                      help="force field label for imported pickles and exported tables")
+
+    parser.add_option('--import_pickle',
+                      action='store', type='string', dest='import_pickle',
+                      default=None,
+                      help="reduced SMIRKS pickle from an older run of reducing_protein_smirks.py")
+
+    parser.add_option('--import_queue',
+                      action='store', type='string', dest='import_queue',
+                      default=None,
+                      help="job queue file (see queue_worker.py) with finished jobs")
+
+    parser.add_option('--summary',
+                      action='store_true', dest='summary',
+                      default=False,
+                      help="print every result (for the run if -n is given)")
+
+    parser.add_option('--latex',
+                      action='store', type='string', dest='latex',
+                      default=None,
+                      help="write LaTeX tables for the run to this file")
+
+    parser.add_option('--text',
+                      action='store', type='string', dest='text',
+                      default=None,
+                      help="write tab separated tables for the run to this file")
+
+    parser.add_option('--tables',
+                      action='store', type='string', dest='tables',
+                      default='bond,angle,improper_torsion,proper_torsion,lj,charge:biggest_size',
+                      help="""comma separated fragments for the tables, [fragment]:[ordering]
+                      uses a different ordering than -o for that fragment""")
+
+    parser.add_option('-o', '--ordering',
+                      action='store', type='string', dest='ordering',
+                      default='big_smirks',
+                      help="ordering used for the tables")
+
+    parser.add_option('-i', '--iterations',
+                      action='store', type='int', dest='iterations',
+                      default=5000,
+                      help="Reducer iterations for the tables, 0 for the SMIRKSifier output")
+
+    (opt, args) = parser.parse_args()
+
+    results_db = ResultsDB(opt.results)
+    if opt.import_pickle is not None:
+        run = opt.run if opt.run is not None else os.path.splitext(os.path.basename(opt.import_pickle))[0]
+        print('imported', import_reduced_pickle(results_db, opt.import_pickle, run, opt.forcefield), 'results')
+
+    if opt.import_queue is not None:
+        run = opt.run if opt.run is not None else os.path.splitext(os.path.basename(opt.import_queue))[0]
+        job_queue = JobQueue(opt.import_queue)
+        print('imported', import_queue(results_db, job_queue, run), 'results')
+        job_queue.close()
+
+    if opt.summary:
+        print_summary(results_db, run=opt.run)
+
+    stage = 'reduce' if opt.iterations > 0 else 'smirksify'
+    for output_file, write_table in [(opt.latex, write_latex_table), (opt.text, write_text_table)]:
+        if output_file is None:
+            continue
+        if opt.run is None:
+            parser.error("a run (-n) is needed to write tables")
+        with open(output_file, 'w') as output:
+            for table in opt.tables.split(','):
+                fragment, ordering = (table.split(':') + [opt.ordering])[:2]
+                if not write_table(results_db, output, opt.run, opt.forcefield, fragment, ordering,
+                                   stage, opt.iterations):
+                    print('No passing result for', fragment, ordering)
+    results_db.close()
@@ -0,0 +1,224 @@
+"""
+run_log.py
+
+Structured logging for long runs. Each step of the pipeline
+(parameterizing molecules, each (fragment, order) SMIRKSifier job,
+writing files, Reducer chunks) writes one json line with
+its wall time, CPU time, memory use, and counts like the number
+of clusters or iterations.
+
+The memory for a job (job_peak_rss_mb) is the largest resident memory
+seen while sampling the process every RunLog.sample_time seconds during the
+job, so a short spike can be missed. process_peak_rss_mb is the peak for the
+whole process so far, it only ever grows and isn't specific to one job.
+Worker processes write to the same file so a whole run ends up in one log.
+
+Jobs can also be profiled with cProfile by giving patterns (like
+"smirksifier:bond:*") which are matched to the job names.
+The stats are saved next to the log and can be read with pstats.
+
+Logging is off until a RunLog with a path is set with set_run_log.
+"""
+
+import os
+import sys
+import json
+import time
+import fnmatch
+import cProfile
+import threading
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def current_rss_mb():
+    """
+    Returns
+    -------
+    rss: float, resident memory used by this process right now in MB
+         or None if it isn't available
+    """
+    try:
+        # linux, this is much faster than psutil
+        with open('/proc/self/statm', 'r') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1024. ** 2
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 1024. ** 2
+    return None
+
+
+class _MemorySampler:
+    """
+    Samples current_rss_mb in a thread until stop is called
+    and keeps the largest value
+    """
+    def __init__(self, sample_time):
+        self.peak = current_rss_mb()
+        self._stop = threading.Event()
+        self._thread = None
+        if self.peak is not None:
+            self._thread = threading.Thread(target=self._sample, args=(sample_time,))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _sample(self, sample_time):
+        while not self._stop.wait(sample_time):
+            self.peak = max(self.peak, current_rss_mb())
+
+    def stop(self):
+        """
+        Returns
+        -------
+        peak: float, largest resident memory seen in MB or None if it isn't available
+        """
+        if self._thread is None:
+            return None
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss_mb())
+        return self.peak
+
+
+def peak_rss_mb():
+    """
+    Returns
+    -------
+    peak: float, largest resident memory used by this process so far in MB
+          or None if it isn't available. This is for the whole life of the
+          process, not one job.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports KB and macOS reports bytes
+    if sys.platform == 'darwin':
+        return peak / 1024. ** 2
+    return peak / 1024.
+
+
+class RunLog:
+    """
+    Writes json lines events to a file.
+
+    Parameters
+    ----------
+    path: str, json lines file to append to, if None nothing is written
+    profile: list of patterns for job names to profile with cProfile
+    profile_dir: directory for the profile stats, defaults to the log directory
+    sample_time: float, seconds between memory samples while a job is running
+    """
+    def __init__(self, path=None, profile=None, profile_dir=None, sample_time=0.1):
+        self.path = None if path is None else os.path.abspath(path)
+        self.sample_time = sample_time
+        self.profile = list() if profile is None else list(profile)
+        if profile_dir is None:
+            profile_dir = '.' if path is None else os.path.dirname(self.path)
+        self.profile_dir = os.path.abspath(profile_dir)
+
+    @property
+    def settings(self):
+        """
+        Arguments to make the same RunLog in another process
+        """
+        return self.path, self.profile, self.profile_dir, self.sample_time
+
+    def event(self, event, **fields):
+        """
+        Writes one event to the log
+        """
+        if self.path is None:
+            return
+        record = {'time': time.time(), 'pid': os.getpid(), 'event': event}
+        record.update(fields)
+        line = json.dumps(record, default=str) + '\n'
+        # each line is a single write to a file opened for appending
+        # so lines from different processes don't get mixed together
+        with open(self.path, 'a') as log_file:
+            log_file.write(line)
+
+    def should_profile(self, name):
+        if name is None:
+            return False
+        return any([fnmatch.fnmatch(name, p) for p in self.profile])
+
+    @contextlib.contextmanager
+    def job(self, event, name=None, **fields):
+        """
+        Times the with block and writes an event when it finishes.
+        This yields a dictionary, anything added to it (like counts)
+        is included in the event.
+
+        Parameters
+        ----------
+        event: str, type of event
+        name: str, name of this job used to decide if it is profiled
+        fields: anything else to include in the event
+        """
+        counts = dict()
+        profiler = None
+        if self.should_profile(name):
+            profiler = cProfile.Profile()
+
+        # memory is only sampled when something is logged
+        sampler = None
+        if self.path is not None:
+            sampler = _MemorySampler(self.sample_time)
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        status = 'error'
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield counts
+            status = 'ok'
+        finally:
+            job_peak = None if sampler is None else sampler.stop()
+            if profiler is not None:
+                profiler.disable()
+                file_name = '%s_%i.prof' % (name.replace(':', '_').replace('/', '_'), os.getpid())
+                counts['profile'] = os.path.join(self.profile_dir, file_name)
+                profiler.dump_stats(counts['profile'])
+
+            record = dict(fields)
+            record.update(counts)
+            self.event(event, name=name, status=status,
+                       wall_time=time.perf_counter() - wall,
+                       cpu_time=time.process_time() - cpu,
+                       job_peak_rss_mb=job_peak,
+                       process_peak_rss_mb=peak_rss_mb(),
+                       **record)
+
+
+# log used by every function in this process
+_run_log = RunLog()
+
+
+def get_run_log():
+    return _run_log
+
+
+def set_run_log(run_log):
+    global _run_log
+    _run_log = run_log
+
+
+def configure_run_log(settings):
+    """
+    Sets the log from RunLog.settings, used to start worker processes
+    """
+    if settings is not None:
+        set_run_log(RunLog(*settings))
@@ -0,0 +1,427 @@
+"""
+run_store.py
+
+Output format for the results of making_proteins.py.
+
+Originally every json file had all of the clusters for every fragment type
+and every molecule was written to its own oeb file with every cluster
+stamped on as SetData tags. Now everything that is the same for a whole
+run is stored once:
+
+* [prefix]_mols.bin - every molecule as oeb bytes one after another
+* [prefix]_clusters.npz - offsets into the molecule file, the indexed
+  SMILES, and a table of cluster atom indices for each fragment type
+
+and the json file for each (ordering, fragment) job is a small record
+with the SMIRKS lists and the name of the store it refers to.
+
+Stores are opened with open_store so every json file from the same run
+shares one store and one list of molecules. Molecules are read from a
+memory mapped file the first time they are used and only the clusters
+for the requested fragment types are loaded.
+
+For each fragment the cluster table has one row per fragment (set of atoms):
+* [fragment].labels - label for each cluster
+* [fragment].cluster - index of the cluster for each row
+* [fragment].mol - index of the molecule for each row
+* [fragment].atoms - atom indices for each row
+"""
+
+import os
+import json
+import fcntl
+import tempfile
+import collections.abc
+import numpy as np
+from openeye import oechem
+
+# bump this if the arrays in the store change
+STORE_VERSION = 1
+
+# stores opened in this process {absolute prefix: RunStore}
+_stores = dict()
+
+# molecules from json files in the original format {tuple of oeb files: list of OEMols}
+_oeb_mols = dict()
+
+
+def _write_atomic(path, write_function):
+    """
+    Writes to a temporary file in the same directory and then moves it
+    into place so nothing ever reads a half written file.
+    write_function is called with the open temporary file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            write_function(temp_file)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def mols_path(prefix):
+    return prefix + '_mols.bin'
+
+
+def clusters_path(prefix):
+    return prefix + '_clusters.npz'
+
+
+def cluster_columns(fragment, frag_clusters):
+    """
+    Converts the clusters for one fragment type to columns
+
+    Parameters
+    ----------
+    fragment: str, fragment type
+    frag_clusters: list of (label, cluster) where the cluster has a list
+                   of atom tuples for each molecule
+
+    Returns
+    -------
+    columns: dictionary of numpy arrays for this fragment
+    """
+    labels = list()
+    cluster_ids = list()
+    mol_ids = list()
+    atoms = list()
+    for c_idx, (label, cluster) in enumerate(frag_clusters):
+        labels.append(label)
+        for m_idx, mol_tuples in enumerate(cluster):
+            for atom_tuple in mol_tuples:
+                cluster_ids.append(c_idx)
+                mol_ids.append(m_idx)
+                atoms.append(tuple(atom_tuple))
+
+    n_atoms = len(atoms[0]) if len(atoms) > 0 else 0
+    return {
+        fragment + '.labels': np.array(labels, dtype=str),
+        fragment + '.cluster': np.array(cluster_ids, dtype=np.int32),
+        fragment + '.mol': np.array(mol_ids, dtype=np.int32),
+        fragment + '.atoms': np.array(atoms, dtype=np.int32).reshape(len(atoms), n_atoms),
+    }
+
+
+def write_run_store(prefix, mols, clusters, smiles, mols_file=None):
+    """
+    Saves the molecules and clusters shared by every job in a run
+
+    Parameters
+    ----------
+    prefix: str, path and start of the file names for this store
+    mols: list of OEMols
+    clusters: cluster dictionary in the form {fragment: cluster list}
+    smiles: list of SMILES with atom map indices for each molecule
+    mols_file: str, molecule file from another store in the same directory
+               with the same molecules (like one for another force field).
+               If this is given it is used instead of writing a new molecule file.
+    """
+    oebs = [oechem.OEWriteMolToBytes('.oeb', m) for m in mols]
+    offsets = np.zeros(len(oebs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in oebs])
+
+    def write_mols(output):
+        for b in oebs:
+            output.write(b)
+
+    arrays = {
+        'version': np.array(STORE_VERSION),
+        'mol_offsets': offsets,
+        'mol_titles': np.array([m.GetTitle() for m in mols], dtype=str),
+        'smiles': np.array(smiles, dtype=str),
+        'fragments': np.array(sorted(clusters.keys()), dtype=str),
+    }
+    if mols_file is not None:
+        arrays['mols_file'] = np.array(os.path.basename(mols_file))
+    for fragment, frag_clusters in clusters.items():
+        arrays.update(cluster_columns(fragment, frag_clusters))
+
+    if mols_file is None:
+        _write_atomic(mols_path(prefix), write_mols)
+    _write_atomic(clusters_path(prefix), lambda output: np.savez_compressed(output, **arrays))
+
+
+class MoleculeList(collections.abc.Sequence):
+    """
+    Molecules from a store. The molecule file is memory mapped and
+    each molecule is only read from it the first time it is used.
+
+    Parameters
+    ----------
+    path: str, molecule file from write_run_store
+    offsets: array with the start of each molecule in the file and the file length
+    """
+    def __init__(self, path, offsets):
+        self.path = path
+        self.offsets = offsets
+        self._data = None
+        self._mols = [None] * (len(offsets) - 1)
+
+    def __len__(self):
+        return len(self._mols)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if self._mols[idx] is None:
+            if self._data is None:
+                self._data = np.memmap(self.path, dtype=np.uint8, mode='r')
+            start, end = self.offsets[idx], self.offsets[idx + 1]
+            mol = oechem.OEMol()
+            oechem.OEReadMolFromBytes(mol, '.oeb', self._data[start:end].tobytes())
+            self._mols[idx] = mol
+        return self._mols[idx]
+
+
+class RunStore:
+    """
+    Reads a store made with write_run_store. Nothing is read until
+    it is needed and only the arrays for the requested fragment
+    types are loaded. Use open_store so stores are shared.
+
+    Parameters
+    ----------
+    prefix: str, path and start of the file names for this store
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._arrays = None
+        self._mol_list = None
+        self._clusters = dict()
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = np.load(clusters_path(self.prefix))
+        return self._arrays
+
+    @property
+    def n_mols(self):
+        return len(self.mol_list)
+
+    @property
+    def fragments(self):
+        return [str(f) for f in self.arrays['fragments']]
+
+    @property
+    def smiles(self):
+        return [str(s) for s in self.arrays['smiles']]
+
+    @property
+    def mol_list(self):
+        """
+        MoleculeList which reads molecules as they are used
+        """
+        if self._mol_list is None:
+            path = mols_path(self.prefix)
+            if 'mols_file' in self.arrays.files:
+                # the molecules are shared with another store
+                path = os.path.join(os.path.dirname(self.prefix), str(self.arrays['mols_file']))
+            self._mol_list = MoleculeList(path, self.arrays['mol_offsets'])
+        return self._mol_list
+
+    def molecule(self, idx):
+        return self.mol_list[idx]
+
+    def molecules(self):
+        """
+        Returns
+        -------
+        mols: MoleculeList with the OEMols in the order they were stored,
+              it can be indexed and iterated like a list but each molecule
+              is only read when it is first used. The same OEMols are returned
+              every time. Use molecule(idx) if only a few molecules are needed.
+        """
+        return self.mol_list
+
+    def clusters(self, fragment):
+        """
+        Returns
+        -------
+        clusters: list of (label, cluster) for this fragment type
+                  where each cluster has a list of atom tuples for each molecule
+        """
+        if fragment in self._clusters:
+            return self._clusters[fragment]
+
+        labels = self.arrays[fragment + '.labels']
+        dense = [(str(l), [list() for i in range(self.n_mols)]) for l in labels]
+        cluster_ids = self.arrays[fragment + '.cluster'].tolist()
+        mol_ids = self.arrays[fragment + '.mol'].tolist()
+        atoms = self.arrays[fragment + '.atoms'].tolist()
+        for c_idx, m_idx, atom_tuple in zip(cluster_ids, mol_ids, atoms):
+            dense[c_idx][1][m_idx].append(tuple(atom_tuple))
+        self._clusters[fragment] = dense
+        return dense
+
+    def close(self):
+        if self._arrays is not None:
+            self._arrays.close()
+            self._arrays = None
+
+
+def open_store(prefix):
+    """
+    Returns the RunStore for this prefix, each store is only opened once
+    per process so its molecules and clusters are shared.
+    """
+    prefix = os.path.abspath(prefix)
+    if prefix not in _stores:
+        _stores[prefix] = RunStore(prefix)
+    return _stores[prefix]
+
+
+def read_mol_files(mol_files):
+    """
+    Reads every molecule from a list of oeb files
+    """
+    mols = list()
+    for mol_file in mol_files:
+        mol = oechem.OEMol()
+        ifs = oechem.oemolistream(mol_file)
+        while oechem.OEReadMolecule(ifs,mol):
+            mols.append(oechem.OEMol(mol))
+    return mols
+
+
+def load_mols(source):
+    """
+    Molecules for a source from record_source, these are only read
+    once per process.
+
+    Returns
+    -------
+    mols: MoleculeList for a store (molecules are read when they are first used)
+          or a list of OEMols for json files in the original format
+    """
+    if isinstance(source, str):
+        return open_store(source).molecules()
+    if source not in _oeb_mols:
+        _oeb_mols[source] = read_mol_files(source)
+    return _oeb_mols[source]
+
+
+def write_record(json_file, prefix, order_data, forcefield=None, merge=False):
+    """
+    Saves the SMIRKS lists for one job
+
+    Parameters
+    ----------
+    json_file: str, name of the json file to save
+    prefix: str, store with the molecules and clusters for this job
+    order_data: {order: {fragment: {'checked': bool, 'type_list': SMIRKS list}}}
+    forcefield: str, label of the force field these clusters came from
+    merge: if True the SMIRKS lists are added to the ones already in json_file,
+           this is used when several jobs (like queue workers) write to the same file
+    """
+    if merge:
+        _merge_record(json_file, prefix, order_data, forcefield)
+        return
+
+    fragments = set()
+    for frag_data in order_data.values():
+        fragments.update(frag_data.keys())
+
+    record = {
+        'store': os.path.relpath(prefix, os.path.dirname(os.path.abspath(json_file))),
+        'store_version': STORE_VERSION,
+        'fragments': sorted(fragments),
+        'smirks_lists': order_data
+    }
+    if forcefield is not None:
+        record['forcefield'] = forcefield
+    with open(json_file, 'w') as output:
+        json.dump(record, output)
+
+
+def _merge_record(json_file, prefix, order_data, forcefield):
+    """
+    Adds SMIRKS lists to a json file while holding a lock on [json_file].lock
+    so jobs writing to the same file at the same time don't lose each other's results
+    """
+    with open(json_file + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            merged = dict()
+            if os.path.isfile(json_file):
+                with open(json_file, 'r') as inputf:
+                    merged = json.load(inputf)['smirks_lists']
+            for order, frag_data in order_data.items():
+                merged.setdefault(order, dict()).update(frag_data)
+
+            temp_file = json_file + '.%i.tmp' % os.getpid()
+            write_record(temp_file, prefix, merged, forcefield)
+            os.replace(temp_file, json_file)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def record_store(json_file, record):
+    """
+    Returns
+    -------
+    prefix: str, path to the store for a record from write_record
+            or None for json files in the original format
+    """
+    if 'store' not in record:
+        return None
+    return os.path.join(os.path.dirname(os.path.abspath(json_file)), record['store'])
+
+
+def record_source(json_file, record, mol_dir='./mol_files/'):
+    """
+    Where to find the molecules for a json file. This is the store prefix
+    or a tuple of oeb files for json files in the original format.
+    Either one can be passed to load_mols, even in another process.
+    """
+    prefix = record_store(json_file, record)
+    if prefix is not None:
+        return prefix
+    mol_dir = os.path.abspath(mol_dir)
+    return tuple([os.path.join(mol_dir, m) for m in record['mol_files']])
+
+
+def load_job(json_file, fragment, order=None, mol_dir='./mol_files/'):
+    """
+    Loads the results for one fragment type from a json file
+    made with making_proteins. The molecules aren't read, use load_mols
+    on the returned source when they are needed.
+
+    Parameters
+    ----------
+    json_file: str
+    fragment: str, fragment type
+    order: str, ordering type, if None the results for every ordering are returned
+    mol_dir: directory with the oeb files for json files in the original format
+
+    Returns
+    -------
+    source: molecule source for load_mols
+    smirks: {'checked': bool, 'type_list': SMIRKS list} for this ordering
+            or {order: that dictionary} if order is None
+    clusters: list of (label, cluster) for this fragment
+    """
+    with open(json_file, 'r') as inputf:
+        record = json.load(inputf)
+
+    source = record_source(json_file, record, mol_dir)
+    if order is None:
+        smirks = {o: d[fragment] for o, d in record['smirks_lists'].items() if fragment in d}
+    else:
+        smirks = record['smirks_lists'][order][fragment]
+
+    if isinstance(source, str):
+        clusters = open_store(source).clusters(fragment)
+    else:
+        clusters = record['clusters'][fragment]
+    return source, smirks, clusters
@@ -0,0 +1,198 @@
+"""
+smirks_validation.py
+
+Checking a list of SMIRKS against reference clusters with ChemPer
+(get_typed_molecules or check_smirks_to_reference) runs a substructure
+search for every pattern on every molecule each time.
+When SMIRKS lists are checked over and over, like the Reducer does,
+almost every pattern is the same as the last time.
+
+SMIRKSValidator keeps the matches for each (SMIRKS, molecule) so only
+patterns that changed are searched again. Each SMIRKS is only
+compiled to an OESubSearch once.
+Typing works the same way as ChemPer, patterns later in
+the list override earlier ones.
+"""
+
+import collections
+from openeye import oechem
+
+# compiled patterns shared by every validator {SMIRKS: OESubSearch}
+_compiled = collections.OrderedDict()
+_max_compiled = 4096
+
+
+def cluster_label(smirks_label):
+    """
+    SMIRKSifier adds 'zz_' to the start of each cluster label,
+    this gets the original cluster label back
+    """
+    if smirks_label.startswith('zz_'):
+        return smirks_label[3:]
+    return smirks_label
+
+
+def fragment_key(atoms, improper=False):
+    """
+    SMIRKS can match a fragment in either direction (or with the side atoms
+    of an improper in any order) so fragments are compared with this key
+    """
+    atoms = tuple([int(a) for a in atoms])
+    if improper:
+        return (atoms[1],) + tuple(sorted(atoms[:1] + atoms[2:]))
+    return min(atoms, atoms[::-1])
+
+
+def compile_smirks(smirks):
+    """
+    Returns
+    -------
+    ss: OESubSearch for this SMIRKS, each SMIRKS is only compiled once
+    """
+    if smirks in _compiled:
+        _compiled.move_to_end(smirks)
+        return _compiled[smirks]
+
+    ss = oechem.OESubSearch()
+    if not ss.Init(smirks):
+        raise ValueError("Could not parse SMIRKS %s" % smirks)
+    ss.SetMaxMatches(0)
+
+    _compiled[smirks] = ss
+    if len(_compiled) > _max_compiled:
+        _compiled.popitem(last=False)
+    return ss
+
+
+def match_smirks(smirks, mol):
+    """
+    OEPrepareSearch can change the ring and aromaticity perception of mol,
+    so only use this on a copy of a molecule that is used anywhere else.
+
+    Returns
+    -------
+    matches: list of atom index tuples in the order of the SMIRKS map indices
+    """
+    ss = compile_smirks(smirks)
+    oechem.OEPrepareSearch(mol, ss)
+    matches = list()
+    for match in ss.Match(mol, False):
+        indexed = dict()
+        for ma in match.GetAtoms():
+            map_idx = ma.pattern.GetMapIdx()
+            if map_idx != 0:
+                indexed[map_idx] = ma.target.GetIdx()
+        matches.append(tuple([indexed[i] for i in sorted(indexed)]))
+    return matches
+
+
+class SMIRKSValidator:
+    """
+    Compares lists of SMIRKS to reference clusters.
+
+    Parameters
+    ----------
+    mols: list of OEMols
+    clusters: list of (label, [[(atoms), ] for each molecule])
+    improper: True if these are improper torsions
+    max_patterns: number of SMIRKS to keep matches for
+    """
+    def __init__(self, mols, clusters, improper=False, max_patterns=4096):
+        # searches are run on copies, preparing a search can re-perceive
+        # aromaticity which would change the molecules SMIRKSifier and the Reducer use
+        self.mols = [oechem.OEMol(m) for m in mols]
+        self.improper = improper
+        self.max_patterns = max_patterns
+        self.labels = [l for l, _ in clusters]
+        # {SMIRKS: [set of fragment keys for each molecule]}
+        self._matches = collections.OrderedDict()
+
+        # reference label for each fragment {mol_idx: {fragment key: label}}
+        self.reference = [dict() for m in mols]
+        self.totals = dict()
+        for label, mol_clusters in clusters:
+            self.totals[label] = 0
+            for mol_idx, fragments in enumerate(mol_clusters):
+                for atoms in fragments:
+                    self.reference[mol_idx][fragment_key(atoms, improper)] = label
+                    self.totals[label] += 1
+
+    @classmethod
+    def from_type_list(cls, type_list, mols, improper=False, max_patterns=4096):
+        """
+        Uses the fragments typed by a list of SMIRKS as the reference,
+        this is what the Reducer compares to.
+        """
+        validator = cls(mols, list(), improper, max_patterns)
+        for mol_idx, mol_types in enumerate(validator.typed(type_list)):
+            validator.reference[mol_idx] = mol_types
+            for label in mol_types.values():
+                validator.totals[label] = validator.totals.get(label, 0) + 1
+        validator.labels = sorted(validator.totals)
+        return validator
+
+    def matches(self, smirks):
+        """
+        Returns
+        -------
+        matches: list with a set of matched fragment keys for each molecule
+        """
+        if smirks in self._matches:
+            self._matches.move_to_end(smirks)
+            return self._matches[smirks]
+
+        mol_matches = [set([fragment_key(m, self.improper) for m in match_smirks(smirks, mol)])
+                       for mol in self.mols]
+        self._matches[smirks] = mol_matches
+        if len(self._matches) > self.max_patterns:
+            self._matches.popitem(last=False)
+        return mol_matches
+
+    def typed(self, type_list):
+        """
+        Returns
+        -------
+        typed: list with {fragment key: cluster label} for each molecule
+        """
+        typed = [dict() for m in self.mols]
+        for label, smirks in type_list:
+            label = cluster_label(label)
+            for mol_types, keys in zip(typed, self.matches(smirks)):
+                for key in keys:
+                    mol_types[key] = label
+        return typed
+
+    def agreement(self, type_list):
+        """
+        Returns
+        -------
+        agreement: dictionary {cluster label: (fragments typed correctly, total fragments)}
+        """
+        correct = dict([(l, 0) for l in self.totals])
+        for mol_types, mol_reference in zip(self.typed(type_list), self.reference):
+            for key, label in mol_reference.items():
+                if mol_types.get(key, None) == label:
+                    correct[label] += 1
+        return dict([(l, (correct[l], self.totals[l])) for l in self.totals])
+
+    def passes(self, type_list):
+        """
+        True if every fragment is typed correctly
+        """
+        for mol_types, mol_reference in zip(self.typed(type_list), self.reference):
+            for key, label in mol_reference.items():
+                if mol_types.get(key, None) != label:
+                    return False
+        return True
+
+    def failing(self, type_list):
+        """
+        Returns
+        -------
+        failing: list with the set of fragment keys typed incorrectly for each molecule
+        """
+        failing = list()
+        for mol_types, mol_reference in zip(self.typed(type_list), self.reference):
+            failing.append(set([key for key, label in mol_reference.items()
+                                if mol_types.get(key, None) != label]))
+        return failing
@@ -0,0 +1,53 @@
+"""
+Checks that ParameterDict groups parameters the same way as the original
+tab separated string keys, every cluster's label matches all of its fragments.
+
+making_proteins.py needs OpenEye, OpenMM, oeommtools, parmed and ChemPer
+to be imported, so this is skipped if they aren't available.
+"""
+
+import os
+import sys
+import pytest
+
+for module in ['openeye.oechem', 'simtk.openmm', 'oeommtools', 'parmed', 'chemper']:
+    pytest.importorskip(module)
+
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import making_proteins as mp
+
+
+def old_key(row, formats):
+    return '\t'.join([f(v) if callable(f) else f % v for v, f in zip(row, formats)])
+
+
+def test_labels_match_members():
+    formats = ['%.3f', mp._terminal_label]
+    # values on .5 boundaries of the format and both signs of zero
+    rows = [[0.0015, 0], [0.0025, 0], [0.0005, 0], [-0.0004, 0], [0.0004, 0], [-0.0, 0],
+            [0.1235, 0], [0.1245, 0], [0.1235, 1], [0.12351, 0]]
+    pd = mp.ParameterDict(formats)
+    pd.add_parameters('m', np.arange(len(rows)).reshape(-1, 1), rows)
+
+    expected = dict()
+    for idx, row in enumerate(rows):
+        expected.setdefault(old_key(row, formats), list()).append(idx)
+
+    assert sorted(pd.labels) == sorted(expected)
+    for label, mol_atoms in zip(pd.labels, pd.atom_indices):
+        assert mol_atoms['m'].reshape(-1).tolist() == expected[label]
+
+
+def test_negative_zero_is_its_own_cluster():
+    pd = mp.ParameterDict(['%.3f'])
+    pd.add_parameters('m', [[0], [1], [2]], [[-0.0004], [0.0004], [0.0]])
+    assert pd.labels == ['-0.000', '0.000']
+    assert pd.atom_indices[1]['m'].reshape(-1).tolist() == [1, 2]
+
+
+def test_padded_rows():
+    pd = mp.ParameterDict('%.3f')
+    pd.add_parameters('m', [[0, 1, 2, 3], [1, 2, 3, 4], [2, 3, 4, 5]],
+                      [[1., 2., np.inf], [1.0001, 2., np.inf], [1., 2., 3.]])
+    assert pd.labels == ['1.000\t2.000', '1.000\t2.000\t3.000']
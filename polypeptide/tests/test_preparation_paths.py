@@ -0,0 +1,57 @@
+"""
+Checks that preparing molecules by copying them (making_proteins._perceive_prepared)
+gives the same atom indices and clusters as the original PDB string round trip.
+
+This needs OpenEye (with a license), OpenMM, oeommtools, parmed and ChemPer,
+it is skipped if they aren't available. Run from the polypeptide folder with
+
+python -m pytest tests
+"""
+
+import os
+import sys
+import pytest
+
+oechem = pytest.importorskip('openeye.oechem')
+for module in ['simtk.openmm', 'oeommtools', 'parmed', 'chemper']:
+    pytest.importorskip(module)
+if not oechem.OEChemIsLicensed():
+    pytest.skip('OpenEye license not found', allow_module_level=True)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import making_proteins as mp
+
+# short sequences with aromatic rings (H, W, F, Y), proline, cysteine
+# and charged side chains, each one has both termini
+sequences = {
+    'HW': 'HW',
+    'ACDEFG': 'ACDEFG',
+    'PKRYS': 'PKRYS',
+    'every_residue': 'ACDEFGHIKLMNPQRSTVWY',
+}
+
+
+@pytest.fixture(scope='module')
+def fasta_file(tmpdir_factory):
+    path = tmpdir_factory.mktemp('fasta').join('preparation.fasta')
+    path.write(''.join(['>%s\n%s\n' % (mol_id, seq) for mol_id, seq in sequences.items()]))
+    return str(path)
+
+
+@pytest.mark.parametrize('mol_id', sorted(sequences))
+def test_same_atoms(mol_id):
+    _, old_mol = mp.prepare_sequence(mol_id, sequences[mol_id], pdb_round_trip=True)
+    _, new_mol = mp.prepare_sequence(mol_id, sequences[mol_id], pdb_round_trip=False)
+
+    def atoms(m):
+        return [(a.GetIdx(), a.GetAtomicNum(), a.GetName().strip(), a.IsAromatic(),
+                 oechem.OEAtomGetResidue(a).GetName(), oechem.OEAtomGetResidue(a).GetResidueNumber())
+                for a in m.GetAtoms()]
+
+    assert atoms(old_mol) == atoms(new_mol)
+    # atom indices are what oeommtools uses as the OpenMM atom indices
+    assert [a.GetIdx() for a in new_mol.GetAtoms()] == list(range(new_mol.NumAtoms()))
+
+
+def test_same_clusters(fasta_file):
+    assert mp.check_preparation_paths([fasta_file]) == []
@@ -0,0 +1,57 @@
+"""
+Checks that residue_positions labels the ends of every chain in a molecule
+and that windows cut out of a protein (making_proteins.cap_window) only have
+terminal residues where the whole protein's chains end.
+
+This needs OpenEye (with a license), OpenMM, oeommtools, parmed and ChemPer,
+it is skipped if they aren't available.
+"""
+
+import os
+import sys
+import pytest
+
+oechem = pytest.importorskip('openeye.oechem')
+for module in ['simtk.openmm', 'oeommtools', 'parmed', 'chemper']:
+    pytest.importorskip(module)
+if not oechem.OEChemIsLicensed():
+    pytest.skip('OpenEye license not found', allow_module_level=True)
+
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import making_proteins as mp
+
+# (chain ID, residue number, insert code) for each residue, one carbon atom per residue
+residues = [('A', 3, ' '), ('A', 4, ' '), ('A', 5, ' '), ('A', 6, ' '),
+            ('B', 1, ' '), ('B', 2, ' '), ('B', 2, 'A'), ('B', 3, ' ')]
+
+
+def chain_mol():
+    mol = oechem.OEMol()
+    previous = None
+    for chain, number, insert_code in residues:
+        atom = mol.NewAtom(oechem.OEElemNo_C)
+        res = oechem.OEResidue()
+        res.SetName('ALA')
+        res.SetChainID(chain)
+        res.SetResidueNumber(number)
+        res.SetInsertCode(insert_code)
+        oechem.OEAtomSetResidue(atom, res)
+        if previous is not None and oechem.OEAtomGetResidue(previous).GetChainID() == chain:
+            mol.NewBond(previous, atom, 1)
+        previous = atom
+    return mol
+
+
+def test_every_chain_has_termini():
+    assert mp.residue_positions(chain_mol()) == ['N', 'X', 'X', 'C', 'N', 'X', 'X', 'C']
+
+
+def test_window_keeps_protein_termini():
+    mol = chain_mol()
+    # the middle of chain A and the end of chain B, both cut ends get caps
+    window, new_idx = mp.cap_window(mol, np.array([1, 2, 6, 7]), 'window')
+    positions = mp.residue_positions(window)
+    assert [positions[i] for i in new_idx[[1, 2, 6, 7]]] == ['X', 'X', 'X', 'C']
+    # caps are never terminal
+    assert set(positions[4:]) == {'X'}